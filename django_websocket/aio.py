@@ -0,0 +1,292 @@
+'''
+A websocket for asyncio streams, for Python 3.
+
+:class:`WebSocket` needs a thread for every open connection, because
+``wait()`` blocks until the client sends something. :class:`AsyncWebSocket`
+offers the same methods as awaitables instead, so one event loop can serve
+many connections. It uses the same parsers and frame packers as
+:class:`~django_websocket.websocket.WebSocket`::
+
+    async def echo(reader, writer):
+        # ... read the upgrade request and build the handshake reply ...
+        websocket = AsyncWebSocket(reader, writer, handshake_reply=reply)
+        websocket.send_handshake()
+        async for message in websocket:
+            await websocket.send(message)
+
+The methods return futures rather than being ``async def`` coroutines, so
+that this module can be byte-compiled together with the rest of the package
+on Python 2. Awaiting them works the same.
+'''
+import asyncio
+import collections
+from django_websocket.framing import HixieParser, HybiParser, OPCODE_TEXT, \
+    OPCODE_BINARY, OPCODE_CLOSE, OPCODE_PING, OPCODE_PONG, CLOSE_NORMAL, \
+    CLOSE_PROTOCOL_ERROR, CLOSE_POLICY_VIOLATION, pack_hixie_message, \
+    pack_hybi_frame, pack_hybi_header, pack_close_payload, \
+    unpack_close_payload
+from django_websocket.websocket import _encode_message
+
+
+# Maximum number of bytes requested from the stream per read.
+READ_SIZE = 64 * 1024
+
+# Number of queued messages at which reading pauses until the application
+# catches up, if ``max_queued_messages`` isn't set.
+MAX_READ_AHEAD = 1000
+
+
+def _done(result=None):
+    future = asyncio.get_event_loop().create_future()
+    future.set_result(result)
+    return future
+
+
+class AsyncWebSocket(object):
+    '''
+    A websocket on top of an ``asyncio.StreamReader`` and
+    ``asyncio.StreamWriter`` pair.
+
+    :meth:`send`, :meth:`wait`, :meth:`read`, :meth:`has_messages` and
+    :meth:`close` return awaitables. ``async for message in websocket``
+    iterates over the messages until the websocket gets closed.
+
+    Incoming data is read in the background as soon as one of the reading
+    methods was called, so pings are answered while the application is busy.
+    Reading pauses while ``max_queued_messages`` (or :data:`MAX_READ_AHEAD`)
+    messages wait for the application and resumes once it reads them.
+    '''
+
+    def __init__(self, reader, writer, protocol=None, version=13,
+        handshake_reply=None, handshake_sent=None, deflate=None,
+        max_message_size=None, max_buffer_size=None,
+        max_queued_messages=None, decode=True):
+        '''
+        Takes the same arguments as
+        :class:`~django_websocket.websocket.HybiWebSocket`, except that the
+        socket is replaced by the ``reader`` and ``writer`` of an asyncio
+        stream. Versions 75 and 76 use the framing of the hixie drafts.
+        '''
+        self.reader = reader
+        self.writer = writer
+        self.protocol = protocol
+        self.version = version
+        self.deflate = deflate
+        self.max_message_size = max_message_size
+        self.max_buffer_size = max_buffer_size
+        self.max_queued_messages = max_queued_messages
+        self.decode = decode
+        self.handshake_reply = handshake_reply
+        if handshake_sent is None:
+            self._handshake_sent = not bool(handshake_reply)
+        else:
+            self._handshake_sent = handshake_sent
+        self.closed = False
+        self.close_code = None
+        if self.is_hixie:
+            self._parser = HixieParser(max_message_size=max_message_size,
+                max_buffer_size=max_buffer_size)
+        else:
+            self._parser = HybiParser(deflate=deflate,
+                max_message_size=max_message_size,
+                max_buffer_size=max_buffer_size)
+        self._message_queue = collections.deque()
+        self._waiters = collections.deque()
+        self._reading = None
+        self._eof = False
+
+    @property
+    def is_hixie(self):
+        return self.version in (75, 76)
+
+    def send_handshake(self):
+        self.writer.write(self.handshake_reply)
+        self._handshake_sent = True
+
+    def _frame(self, opcode, payload):
+        if self.is_hixie:
+            if opcode != OPCODE_TEXT:
+                raise ValueError("WebSocket protocol version %s doesn't "
+                    "support binary messages." % self.version)
+            return pack_hixie_message(payload)
+        compressed = False
+        if self.deflate is not None and len(payload) >= self.deflate.min_size:
+            payload = self.deflate.compress(payload)
+            compressed = True
+        return pack_hybi_header(opcode, len(payload), rsv1=compressed) + \
+            payload
+
+    def send(self, message, binary=False):
+        '''
+        Sends a message to the client. The returned awaitable waits until
+        the write buffer of the transport drained.
+        '''
+        opcode = OPCODE_BINARY if binary else OPCODE_TEXT
+        self.writer.write(self._frame(opcode, _encode_message(message)))
+        return self.writer.drain()
+
+    def _decode_message(self, message):
+        opcode, payload = message
+        if self.decode and opcode == OPCODE_TEXT:
+            return payload.decode('utf-8', 'replace')
+        return payload
+
+    def has_messages(self):
+        '''
+        Resolves to ``True`` if a message is queued, without waiting for the
+        client.
+        '''
+        self._start_reading()
+        return _done(bool(self._message_queue))
+
+    def count_messages(self):
+        '''
+        Resolves to the number of queued messages.
+        '''
+        self._start_reading()
+        return _done(len(self._message_queue))
+
+    def read(self, fallback=None):
+        '''
+        Resolves to the next queued message or ``fallback`` if none is
+        available, without waiting for the client.
+        '''
+        if self._message_queue:
+            message = self._decode_message(self._message_queue.popleft())
+        else:
+            message = fallback
+        self._start_reading()
+        return _done(message)
+
+    def wait(self):
+        '''
+        Resolves to the next message once it's available, or ``None`` if the
+        websocket got closed.
+        '''
+        return self._wait(False)
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        return self._wait(True)
+
+    def _wait(self, stop):
+        # A closed websocket resolves the waiter to ``None``, or raises
+        # StopAsyncIteration if *stop* is true. A cancelled waiter, e.g. after
+        # a timeout of ``asyncio.wait_for()``, is skipped when messages
+        # arrive, so it doesn't take one with it.
+        if self._message_queue:
+            message = self._decode_message(self._message_queue.popleft())
+            self._start_reading()
+            return _done(message)
+        waiter = asyncio.get_event_loop().create_future()
+        if self.closed or self._eof:
+            self._end(waiter, stop)
+            return waiter
+        self._waiters.append((waiter, stop))
+        self._start_reading()
+        return waiter
+
+    def _end(self, waiter, stop):
+        if stop:
+            waiter.set_exception(StopAsyncIteration())
+        else:
+            waiter.set_result(None)
+
+    def _start_reading(self):
+        limit = self.max_queued_messages
+        if limit is None:
+            limit = MAX_READ_AHEAD
+        if len(self._message_queue) >= limit:
+            # Resumed by the next read of the application.
+            return
+        if self._reading is None and not self._eof and not self.closed:
+            self._reading = asyncio.ensure_future(self.reader.read(
+                max(READ_SIZE, min(self._parser.wanted, 4 * READ_SIZE))))
+            self._reading.add_done_callback(self._data_read)
+
+    def _data_read(self, reading):
+        self._reading = None
+        if reading.cancelled():
+            return
+        if reading.exception() is not None or not reading.result():
+            # The connection was lost or closed without a closing frame.
+            self._eof = True
+            self.closed = True
+        else:
+            self._parser.feed(reading.result())
+            self._parse_message_queue()
+            if self.max_queued_messages is not None and \
+                len(self._message_queue) > self.max_queued_messages:
+                self._fail_connection(CLOSE_POLICY_VIOLATION)
+        self._wake_waiters()
+        self._start_reading()
+
+    def _parse_message_queue(self):
+        try:
+            frames = self._parser.parse()
+        except ValueError as e:
+            # A FrameError, or any other parser error, which would otherwise
+            # get lost in the callback and leave the waiters hanging.
+            self._fail_connection(getattr(e, 'code', CLOSE_PROTOCOL_ERROR))
+            return
+        for frame in frames:
+            if frame[0] == OPCODE_TEXT or frame[0] == OPCODE_BINARY:
+                self._message_queue.append(frame)
+            else:
+                self._handle_control_frame(*frame)
+
+    def _wake_waiters(self):
+        waiters = self._waiters
+        while waiters and (self._message_queue or self.closed):
+            waiter, stop = waiters.popleft()
+            if waiter.done():
+                continue
+            if self._message_queue:
+                waiter.set_result(
+                    self._decode_message(self._message_queue.popleft()))
+            else:
+                self._end(waiter, stop)
+
+    def _handle_control_frame(self, opcode, payload):
+        if opcode == OPCODE_PING:
+            self.writer.write(pack_hybi_frame(OPCODE_PONG, payload))
+        elif opcode == OPCODE_CLOSE:
+            if self.is_hixie:
+                self.closed = True
+                return
+            self.close_code, reason = unpack_close_payload(payload)
+            self._send_closing_frame(self.close_code)
+
+    def _fail_connection(self, code):
+        self._send_closing_frame(code)
+        self.closed = True
+        self.writer.close()
+
+    def _send_closing_frame(self, code=CLOSE_NORMAL, reason=b''):
+        if self.closed:
+            return
+        if self.is_hixie:
+            if self.version == 76:
+                self.writer.write(b'\xff\x00')
+        elif code is None:
+            self.writer.write(pack_hybi_frame(OPCODE_CLOSE, b''))
+        else:
+            self.writer.write(pack_hybi_frame(OPCODE_CLOSE,
+                pack_close_payload(code, reason)))
+        self.closed = True
+
+    def close(self, code=CLOSE_NORMAL):
+        '''
+        Sends the closing frame and closes the connection once all queued
+        data is written. Resolves when the connection is closed.
+        '''
+        self._send_closing_frame(code)
+        self._wake_waiters()
+        if self._reading is not None:
+            self._reading.cancel()
+        self.writer.close()
+        if hasattr(self.writer, 'wait_closed'):
+            return self.writer.wait_closed()
+        return _done()
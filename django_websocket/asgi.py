@@ -0,0 +1,468 @@
+'''
+Serve websocket views with an ASGI server, for Python 3.
+
+:func:`~django_websocket.websocket.setup_websocket` needs the socket of the
+WSGI server and a thread for every connection. :class:`WebSocketASGIHandler`
+is an ASGI application that runs the same views, decorated with
+``accept_websocket`` or ``require_websocket``, on an ASGI server instead.
+The server speaks the websocket protocol, the views get a
+:class:`ASGIWebSocket` as ``request.websocket``, which has the same methods
+as :class:`~django_websocket.websocket.WebSocket`, though streamed messages
+are held in memory as a whole.
+
+Views are ordinary blocking functions, so they run in a bounded thread pool
+while the connections themselves are managed by the event loop of the
+server. Other requests can be passed on to another ASGI application::
+
+    # asgi.py
+    import django
+    django.setup()
+
+    from django.core.asgi import get_asgi_application
+    from django_websocket.asgi import WebSocketASGIHandler
+
+    application = WebSocketASGIHandler(get_asgi_application(), max_workers=64)
+
+Like :mod:`django_websocket.aio`, the module uses futures instead of
+``async def``, so the package still byte-compiles on Python 2.
+'''
+import asyncio
+import collections
+import io
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from socket import error as SocketError
+from django_websocket.framing import OPCODE_TEXT, OPCODE_BINARY, \
+    CLOSE_NORMAL, CLOSE_GOING_AWAY
+from django_websocket.handlers import RequestHandler
+from django_websocket.outbound import SlowConsumer
+from django_websocket.websocket import STREAM_CHUNK_SIZE, _encode_message, \
+    _file_size, _stream_chunks, text_type
+
+
+# Close code of ASGI disconnect events without a code.
+CLOSE_ABNORMAL = 1006
+
+DEFAULT_MAX_WORKERS = 32
+
+
+def _headers_to_environ(environ, headers):
+    for name, value in headers:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name == 'CONTENT_TYPE' or name == 'CONTENT_LENGTH':
+            key = name
+        else:
+            key = 'HTTP_' + name
+        value = value.decode('latin-1')
+        if key in environ:
+            value = environ[key] + ',' + value
+        environ[key] = value
+
+
+def scope_to_environ(scope):
+    '''
+    Returns a WSGI environ for the ASGI websocket connection *scope*, with the
+    headers of the upgrade request.
+    '''
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    secure = scope.get('scheme') in ('wss', 'https')
+    environ = {
+        'REQUEST_METHOD': 'GET',
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        # WSGI paths are byte strings decoded as latin-1.
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': str(server[0]),
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': str(client[0]),
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'https' if secure else 'http',
+        'wsgi.input': io.BytesIO(),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    _headers_to_environ(environ, scope.get('headers', ()))
+    # Marks the request as websocket request for the middleware, even if
+    # the server left out the headers of the upgrade.
+    environ.setdefault('HTTP_UPGRADE', 'websocket')
+    return environ
+
+
+class ASGIWebSocket(object):
+    '''
+    The ``request.websocket`` of views that are run by
+    :class:`WebSocketASGIHandler`. It has the same methods as
+    :class:`~django_websocket.websocket.WebSocket` and must be used from the
+    thread of the view, not from the event loop.
+
+    Messages are received on the event loop in the background and queued.
+    Once ``max_queued_messages`` are waiting, receiving pauses until the view
+    catches up.
+
+    ASGI servers pass on whole messages only. :meth:`send_stream`,
+    :meth:`send_file` and :meth:`wait_stream` therefore take the same
+    arguments, but hold the whole message in memory.
+    '''
+    # Broadcasts that may wait for the server before the websocket is
+    # closed as too slow.
+    max_queued_sends = 1000
+
+    def __init__(self, loop, receive, send, protocol=None,
+        max_queued_messages=None, decode=True):
+        self.protocol = protocol
+        self.version = 13
+        self.closed = False
+        self.close_code = None
+        self.max_queued_messages = max_queued_messages
+        self.decode = decode
+        self._loop = loop
+        self._receive = receive
+        self._send = send
+        self._handshake_sent = False
+        self._message_queue = collections.deque()
+        self._condition = threading.Condition()
+        self._receiving = None
+        self._disconnected = False
+        self._outbox = collections.deque()
+        self._sending = None
+
+    # Running on the event loop.
+
+    def _receive_next(self):
+        if self._receiving is not None or self._disconnected:
+            return
+        if self.max_queued_messages is not None and \
+            len(self._message_queue) >= self.max_queued_messages:
+            return
+        self._receiving = asyncio.ensure_future(self._receive())
+        self._receiving.add_done_callback(self._received)
+
+    def _received(self, receiving):
+        self._receiving = None
+        if receiving.cancelled() or receiving.exception() is not None:
+            event = {'type': 'websocket.disconnect', 'code': CLOSE_ABNORMAL}
+        else:
+            event = receiving.result()
+        with self._condition:
+            if event['type'] == 'websocket.receive':
+                if event.get('text') is not None:
+                    self._message_queue.append((OPCODE_TEXT, event['text']))
+                else:
+                    self._message_queue.append(
+                        (OPCODE_BINARY, event.get('bytes') or b''))
+            elif event['type'] == 'websocket.disconnect':
+                self._disconnected = True
+                self.closed = True
+                if self.close_code is None:
+                    self.close_code = event.get('code', CLOSE_ABNORMAL)
+            self._condition.notify_all()
+        self._receive_next()
+
+    def _stop(self):
+        if self._receiving is not None:
+            self._receiving.cancel()
+        self._disconnected = True
+        self._outbox.clear()
+
+    def _send_next(self):
+        if self._sending is not None or not self._outbox:
+            return
+        self._sending = asyncio.ensure_future(
+            self._send(self._outbox.popleft()))
+        self._sending.add_done_callback(self._sent)
+
+    def _sent(self, sending):
+        self._sending = None
+        if sending.cancelled() or sending.exception() is not None:
+            self._outbox.clear()
+            return
+        self._send_next()
+
+    # Running in the thread of the view.
+
+    def _call(self, event):
+        try:
+            asyncio.run_coroutine_threadsafe(self._send(event),
+                self._loop).result()
+        except Exception as e:
+            raise SocketError(str(e))
+
+    def send_handshake(self):
+        if self._handshake_sent:
+            return
+        self._call({'type': 'websocket.accept'})
+        self._handshake_sent = True
+        self._loop.call_soon_threadsafe(self._receive_next)
+
+    @classmethod
+    def _pack_message(cls, message, binary=False):
+        '''
+        Returns the ASGI event that sends *message*. Used by the broadcaster
+        to build the event once for all members.
+        '''
+        if binary:
+            return {'type': 'websocket.send', 'bytes': _encode_message(message)}
+        if not isinstance(message, text_type):
+            message = _encode_message(message).decode('utf-8')
+        return {'type': 'websocket.send', 'text': message}
+
+    def _write(self, event):
+        if self.closed:
+            raise SocketError("The websocket is closed.")
+        self._call(event)
+
+    def _queue_frame(self, event):
+        # Called by the broadcaster, which must not wait for the server.
+        if self.closed:
+            raise SocketError("The websocket is closed.")
+        if len(self._outbox) >= self.max_queued_sends:
+            with self._condition:
+                self.closed = True
+                self._condition.notify_all()
+            raise SlowConsumer(
+                "More than %d messages queued for the client." %
+                self.max_queued_sends)
+        self._outbox.append(event)
+
+    def _send_queued(self):
+        self._loop.call_soon_threadsafe(self._send_next)
+
+    def send(self, message, binary=False):
+        '''
+        Send a message to the client. *message* should be convertable to a
+        string; unicode objects should be encodable as utf-8.
+
+        Pass ``binary=True`` to send *message* as binary message.
+        '''
+        self._write(self._pack_message(message, binary))
+
+    def send_many(self, messages, binary=False):
+        '''
+        Send all messages of the iterable *messages* to the client.
+        '''
+        for message in messages:
+            self.send(message, binary)
+
+    def send_stream(self, data, binary=False, chunk_size=STREAM_CHUNK_SIZE):
+        '''
+        Send a message whose payload is read from the file-like object
+        *data*, *chunk_size* bytes at a time, or made up of the chunks of
+        the iterable *data*. The chunks are joined and sent as one message.
+        '''
+        self.send(b''.join(_stream_chunks(data, chunk_size)), binary)
+
+    def send_file(self, fileobj, offset=0, count=None, binary=True):
+        '''
+        Send *count* bytes of the file *fileobj*, starting at *offset*, as
+        one message; *count* defaults to the rest of the file. The file is
+        read into memory, as ASGI has no way to pass it on to the server.
+        Raises an ``IOError`` if the file ends early.
+        '''
+        if count is None:
+            count = _file_size(fileobj) - offset
+        fileobj.seek(offset)
+        payload = fileobj.read(count)
+        if len(payload) < count:
+            raise IOError('The file ended after %d of %d bytes.' %
+                (len(payload), count))
+        self.send(payload, binary)
+
+    def _decode_message(self, message, decode=None):
+        opcode, payload = message
+        if decode is None:
+            decode = self.decode
+        if opcode == OPCODE_TEXT and not decode:
+            return payload.encode('utf-8')
+        return payload
+
+    def _pop_message(self, block):
+        with self._condition:
+            while block and not self._message_queue and not self.closed:
+                self._condition.wait()
+            if not self._message_queue:
+                return None
+            message = self._message_queue.popleft()
+        if self.max_queued_messages is not None:
+            self._loop.call_soon_threadsafe(self._receive_next)
+        return message
+
+    def count_messages(self):
+        '''
+        Returns the number of queued messages.
+        '''
+        return len(self._message_queue)
+
+    def has_messages(self):
+        '''
+        Returns ``True`` if new messages from the client are available, else
+        ``False``.
+        '''
+        return bool(self._message_queue)
+
+    def read(self, fallback=None):
+        '''
+        Return new message or ``fallback`` if no message is available.
+        '''
+        message = self._pop_message(False)
+        if message is None:
+            return fallback
+        return self._decode_message(message)
+
+    def read_bytes(self, fallback=None):
+        '''
+        Like :meth:`read`, but returns text messages as utf-8 encoded byte
+        string.
+        '''
+        message = self._pop_message(False)
+        if message is None:
+            return fallback
+        return self._decode_message(message, False)
+
+    def wait(self):
+        '''
+        Waits for and returns the next message, or ``None`` if the websocket
+        got closed.
+        '''
+        message = self._pop_message(True)
+        if message is None:
+            return None
+        return self._decode_message(message)
+
+    def wait_bytes(self):
+        '''
+        Like :meth:`wait`, but returns text messages as utf-8 encoded byte
+        string.
+        '''
+        message = self._pop_message(True)
+        if message is None:
+            return None
+        return self._decode_message(message, False)
+
+    def wait_stream(self):
+        '''
+        Waits for the next message and yields its payload as one chunk, as
+        utf-8 encoded byte string for text messages. Nothing is yielded if
+        the websocket gets closed.
+        '''
+        message = self._pop_message(True)
+        if message is not None:
+            yield self._decode_message(message, False)
+
+    def __iter__(self):
+        while True:
+            message = self.wait()
+            if message is None:
+                return
+            yield message
+
+    # The server buffers outgoing data and answers pings.
+
+    buffered_amount = 0
+    metrics = None
+
+    def enable_write_buffer(self, **kwargs):
+        pass
+
+    def flush(self, timeout=0):
+        return True
+
+    def _send_closing_frame(self, ignore_send_errors=False,
+        code=CLOSE_NORMAL, reason=''):
+        if self.closed:
+            return
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+        try:
+            self._call({'type': 'websocket.close', 'code': code})
+        except SocketError:
+            if not ignore_send_errors:
+                raise
+
+    def close(self):
+        '''
+        Close the websocket.
+        '''
+        self._send_closing_frame()
+
+
+class WebSocketASGIHandler(object):
+    '''
+    ASGI application that runs Django views for websocket connections.
+
+    The request passes through the middleware configured in the settings,
+    like with the WSGI handler of Django. Views run in a thread pool of
+    ``max_workers`` threads; connections beyond that wait for a free thread.
+    Connections that are rejected by the view, e.g. because it isn't
+    decorated with ``accept_websocket``, are closed before the handshake,
+    which the server answers with status 403.
+
+    Other scopes are passed on to ``application``, if given.
+    '''
+    # ``__call__`` returns a future instead of being a coroutine function,
+    # which servers would take for an ASGI 2 application.
+    _asgi_single_callable = True
+
+    def __init__(self, application=None, max_workers=DEFAULT_MAX_WORKERS,
+        max_queued_messages=1000):
+        self.application = application
+        self.max_queued_messages = max_queued_messages
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.handler = RequestHandler()
+
+    def __call__(self, scope, receive, send):
+        if scope['type'] != 'websocket':
+            if self.application is None:
+                raise ValueError(
+                    "Unsupported ASGI scope type: %s" % scope['type'])
+            return self.application(scope, receive, send)
+        loop = asyncio.get_event_loop()
+        done = loop.create_future()
+        connect = asyncio.ensure_future(receive())
+        connect.add_done_callback(
+            lambda future: self._connected(future, scope, receive, send, done))
+        return done
+
+    def _connected(self, connect, scope, receive, send, done):
+        if connect.cancelled() or connect.exception() is not None:
+            done.set_result(None)
+            return
+        if connect.result()['type'] != 'websocket.connect':
+            done.set_result(None)
+            return
+        loop = asyncio.get_event_loop()
+        websocket = ASGIWebSocket(loop, receive, send,
+            protocol=', '.join(scope.get('subprotocols') or ()) or None,
+            max_queued_messages=self.max_queued_messages)
+        environ = scope_to_environ(scope)
+        view = loop.run_in_executor(self.executor, self.get_response,
+            environ, websocket)
+        view.add_done_callback(
+            lambda future: self._finished(future, websocket, done))
+
+    def _finished(self, view, websocket, done):
+        websocket._stop()
+        if view.exception() is not None:
+            done.set_exception(view.exception())
+        else:
+            done.set_result(None)
+
+    def get_response(self, environ, websocket):
+        '''
+        Runs the view for *environ* in the current thread, with *websocket*
+        as ``request.websocket``.
+        '''
+        try:
+            self.handler.get_response(environ, self.__class__, websocket)
+        finally:
+            if websocket._handshake_sent:
+                websocket._send_closing_frame(True)
+            elif not websocket.closed:
+                # Rejects the connection.
+                websocket._send_closing_frame(True, code=CLOSE_GOING_AWAY)
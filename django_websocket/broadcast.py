@@ -0,0 +1,197 @@
+'''
+Send the same message to groups of websockets.
+
+Views add their websocket to one or more named groups; a message broadcast to
+a group is encoded and framed only once and the resulting bytes are queued
+for every member::
+
+    from django_websocket.broadcast import broadcaster
+
+    @require_websocket
+    def notifications(request):
+        broadcaster.add('news', request.websocket)
+        try:
+            for message in request.websocket:
+                pass
+        finally:
+            broadcaster.discard(request.websocket)
+
+    # somewhere else
+    broadcaster.broadcast('news', u'Hello everybody!')
+
+Broadcasts never block on a slow client. The frames are queued in the write
+buffer of every member, which :meth:`Broadcaster.add` enables with the
+default settings if the view didn't, and sent as far as the socket takes
+them; the flusher thread sends the rest later. A member that falls more than
+the high watermark of its write buffer behind is closed, unless the buffer
+drops frames with ``POLICY_DROP``.
+
+A ``Broadcaster`` with a :class:`~django_websocket.replay.ReplayBuffer`
+remembers the recent messages of every group and replays the ones a
+reconnecting client missed in :meth:`Broadcaster.resume`.
+'''
+import threading
+from socket import error as SocketError
+from django_websocket.websocket import _encode_message
+
+
+class Broadcaster(object):
+    '''
+    Keeps track of groups of websockets and sends messages to all members of
+    a group.
+
+    Members whose socket fails while sending, that fall too far behind, or
+    that are already closed, are removed from all groups. Websockets that negotiated permessage-deflate
+    receive broadcasts uncompressed, because the shared frame can't depend on
+    the compression state of a single connection.
+    '''
+
+    def __init__(self, replay=None):
+        self._groups = {}
+        self._lock = threading.Lock()
+        # A ``django_websocket.replay.ReplayBuffer`` that keeps the recent
+        # messages of every group for :meth:`resume`.
+        self.replay = replay
+
+    def add(self, group, websocket):
+        '''
+        Add *websocket* to *group*. Enables its write buffer if it has none.
+        '''
+        websocket.enable_write_buffer()
+        with self._lock:
+            self._groups.setdefault(group, set()).add(websocket)
+
+    def resume(self, group, websocket, last_id):
+        '''
+        Sends the messages of *group* after the id *last_id* from the replay
+        buffer to *websocket* and adds it to *group*, so that it neither
+        misses nor repeats a message that is broadcast meanwhile. Returns
+        the number of replayed messages, or ``None`` if *last_id* is
+        ``None`` or the messages after it are not buffered anymore; the
+        websocket is added in any case. Raises ``ValueError`` if the
+        broadcaster has no replay buffer.
+
+        The replayed messages are queued like broadcasts, so a slow client
+        doesn't hold up broadcasts to the group; a ``SocketError`` is raised
+        if they don't fit in its write buffer.
+        '''
+        if self.replay is None:
+            raise ValueError("The broadcaster has no replay buffer.")
+        if last_id is None:
+            self.add(group, websocket)
+            return None
+        topic = self.replay.topic(group)
+        websocket.enable_write_buffer()
+        with topic.lock:
+            frames = topic.frames(websocket.__class__, last_id)
+            if frames:
+                websocket._queue_frame(frames)
+            self.add(group, websocket)
+            if frames is None:
+                return None
+            replayed = topic.next_sequence - 1 - topic.sequence(last_id)
+        if frames:
+            websocket._send_queued()
+        return replayed
+
+    def remove(self, group, websocket):
+        '''
+        Remove *websocket* from *group*. Does nothing if it's not a member.
+        '''
+        with self._lock:
+            members = self._groups.get(group)
+            if members is not None:
+                members.discard(websocket)
+                if not members:
+                    del self._groups[group]
+
+    def discard(self, websocket):
+        '''
+        Remove *websocket* from all groups.
+        '''
+        with self._lock:
+            for group, members in list(self._groups.items()):
+                members.discard(websocket)
+                if not members:
+                    del self._groups[group]
+
+    def members(self, group):
+        '''
+        Returns a list of the websockets in *group*.
+        '''
+        with self._lock:
+            return list(self._groups.get(group, ()))
+
+    def groups(self):
+        '''
+        Returns a list of the names of all groups with members.
+        '''
+        with self._lock:
+            return list(self._groups)
+
+    def broadcast(self, group, message):
+        '''
+        Sends *message* to all members of *group* and returns the number of
+        websockets it was sent to. With a replay buffer the message is
+        stored with the next id of the group first.
+        '''
+        if self.replay is None:
+            message = _encode_message(message)
+            return self._fanout(group, lambda cls: cls._pack_message(message))
+        topic = self.replay.topic(group)
+        # Queuing under the lock of the topic keeps the order of the
+        # messages in line with their ids and with :meth:`resume`.
+        with topic.lock:
+            message = topic.append(message)
+            members = self._queue(group,
+                lambda cls: cls._pack_message(message))
+        return self._send(members)
+
+    def _fanout(self, group, pack):
+        '''
+        Sends the frame returned by ``pack(cls)`` to all members of *group*
+        and returns the number of websockets it was sent to.
+        '''
+        return self._send(self._queue(group, pack))
+
+    def _queue(self, group, pack):
+        '''
+        Queues the frame returned by ``pack(cls)`` for all members of *group*
+        without writing to their sockets and returns the members. ``pack``
+        is called once per websocket class.
+        '''
+        frames = {}
+        queued = []
+        for websocket in self.members(group):
+            if websocket.closed:
+                self.discard(websocket)
+                continue
+            cls = websocket.__class__
+            frame = frames.get(cls)
+            if frame is None:
+                frame = frames[cls] = pack(cls)
+            try:
+                websocket._queue_frame(frame)
+            except SocketError:
+                self.discard(websocket)
+            else:
+                queued.append(websocket)
+        return queued
+
+    def _send(self, members):
+        '''
+        Sends the frames queued for *members* without blocking and returns
+        the number of members whose socket didn't fail.
+        '''
+        sent = 0
+        for websocket in members:
+            try:
+                websocket._send_queued()
+            except SocketError:
+                self.discard(websocket)
+            else:
+                sent += 1
+        return sent
+
+
+broadcaster = Broadcaster()
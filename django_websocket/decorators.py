@@ -6,7 +6,9 @@ from django_websocket.middleware import WebSocketMiddleware
 __all__ = ('accept_websocket', 'require_websocket')
 
 
-WEBSOCKET_MIDDLEWARE_INSTALLED = 'django_websocket.middleware.WebSocketMiddleware' in settings.MIDDLEWARE_CLASSES
+WEBSOCKET_MIDDLEWARE_INSTALLED = 'django_websocket.middleware.WebSocketMiddleware' in (
+    tuple(getattr(settings, 'MIDDLEWARE_CLASSES', None) or ()) +
+    tuple(getattr(settings, 'MIDDLEWARE', None) or ()))
 
 
 def _setup_websocket(func):
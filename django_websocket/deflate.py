@@ -0,0 +1,243 @@
+'''
+Support for the permessage-deflate extension of RFC 7692.
+
+The memory held by one connection is bounded by the negotiated window sizes
+and the zlib memory level. A compression context with the default settings
+takes about 256 KB, a decompression context about 40 KB. Both can be dropped
+with :meth:`PerMessageDeflate.release` while a connection is idle.
+'''
+import zlib
+from django_websocket.framing import FrameError, CLOSE_MESSAGE_TOO_BIG
+
+
+EXTENSION_NAME = 'permessage-deflate'
+
+DEFAULT_MIN_SIZE = 64
+
+# Maximum size of the chunks of streamed messages after decompression.
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Every message compressed with Z_SYNC_FLUSH ends with an empty stored block.
+# The extension strips it before sending and it needs to be appended again
+# before decompressing.
+_TAIL = b'\x00\x00\xff\xff'
+
+
+def _parse_offers(header):
+    '''
+    Returns a list of ``(name, params)`` tuples for all extensions listed in
+    a ``Sec-WebSocket-Extensions`` header. Parameters without a value are
+    mapped to ``None``.
+    '''
+    offers = []
+    for offer in header.split(','):
+        parts = [part.strip() for part in offer.split(';')]
+        params = {}
+        for param in parts[1:]:
+            if not param:
+                continue
+            if '=' in param:
+                key, value = param.split('=', 1)
+                params[key.strip()] = value.strip().strip('"')
+            else:
+                params[param] = None
+        offers.append((parts[0], params))
+    return offers
+
+
+def _window_bits(value):
+    '''
+    Returns the integer value of a ``*_max_window_bits`` parameter or ``None``
+    if it isn't valid.
+    '''
+    if value is None or not value.isdigit():
+        return None
+    bits = int(value)
+    if 8 <= bits <= 15:
+        return bits
+    return None
+
+
+class PerMessageDeflate(object):
+    '''
+    Compresses outgoing and decompresses incoming messages of one connection.
+
+    - ``server_window_bits``/``client_window_bits``: the LZ77 window sizes
+      used for compressing respectively decompressing messages.
+    - ``server_context_takeover``/``client_context_takeover``: if ``False``
+      every message is compressed respectively decompressed with a new
+      context, which is released right after the message.
+    - ``min_size``: messages shorter than this are sent uncompressed.
+    - ``level``, ``mem_level``: passed to ``zlib.compressobj``. Lowering the
+      memory level reduces the size of the compression context.
+    '''
+
+    def __init__(self, server_window_bits=15, client_window_bits=15,
+        server_context_takeover=True, client_context_takeover=True,
+        min_size=DEFAULT_MIN_SIZE, level=6, mem_level=8):
+        # zlib doesn't support compressing with a window of 256 bytes.
+        self.server_window_bits = max(server_window_bits, 9)
+        self.client_window_bits = client_window_bits
+        self.server_context_takeover = server_context_takeover
+        self.client_context_takeover = client_context_takeover
+        self.min_size = min_size
+        self.level = level
+        self.mem_level = mem_level
+        self._compressor = None
+        self._decompressor = None
+
+    @classmethod
+    def negotiate(cls, header, window_bits=15, context_takeover=True,
+        min_size=DEFAULT_MIN_SIZE, level=6, mem_level=8):
+        '''
+        Picks the first acceptable permessage-deflate offer of the
+        ``Sec-WebSocket-Extensions`` request ``header``.
+
+        ``window_bits`` is the largest window that is used in either
+        direction, as far as the client allows to limit it. If
+        ``context_takeover`` is ``False`` no context is kept between messages.
+
+        Returns a tuple of the :class:`PerMessageDeflate` instance and the
+        value of the ``Sec-WebSocket-Extensions`` response header, or
+        ``(None, None)`` if no offer was acceptable.
+        '''
+        for name, params in _parse_offers(header):
+            if name != EXTENSION_NAME:
+                continue
+            if set(params) - set(('server_no_context_takeover',
+                'client_no_context_takeover', 'server_max_window_bits',
+                'client_max_window_bits')):
+                continue
+
+            response = [EXTENSION_NAME]
+            # zlib doesn't support compressing with a window of 256 bytes,
+            # so a smaller window than 512 bytes is never announced.
+            server_window_bits = max(window_bits, 9)
+            if 'server_max_window_bits' in params:
+                offered = _window_bits(params['server_max_window_bits'])
+                if offered is None or offered < 9:
+                    continue
+                server_window_bits = min(server_window_bits, offered)
+                response.append('server_max_window_bits=%d' % server_window_bits)
+            elif server_window_bits < 15:
+                response.append('server_max_window_bits=%d' %
+                    server_window_bits)
+
+            # The window of the client can only be limited if it announced
+            # support for it.
+            client_window_bits = 15
+            if 'client_max_window_bits' in params:
+                client_window_bits = window_bits
+                if params['client_max_window_bits'] is not None:
+                    offered = _window_bits(params['client_max_window_bits'])
+                    if offered is None:
+                        continue
+                    client_window_bits = min(window_bits, offered)
+                response.append('client_max_window_bits=%d' % client_window_bits)
+
+            server_context_takeover = context_takeover and \
+                'server_no_context_takeover' not in params
+            if not server_context_takeover:
+                response.append('server_no_context_takeover')
+            client_context_takeover = context_takeover and \
+                'client_no_context_takeover' not in params
+            if not client_context_takeover:
+                response.append('client_no_context_takeover')
+
+            extension = cls(
+                server_window_bits=server_window_bits,
+                client_window_bits=client_window_bits,
+                server_context_takeover=server_context_takeover,
+                client_context_takeover=client_context_takeover,
+                min_size=min_size, level=level, mem_level=mem_level)
+            return extension, '; '.join(response)
+        return None, None
+
+    def compress(self, payload):
+        '''
+        Returns the compressed ``payload`` without the trailing empty block.
+        '''
+        if self._compressor is None:
+            self._compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                -self.server_window_bits, self.mem_level)
+        data = self._compressor.compress(payload) + \
+            self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        if not self.server_context_takeover:
+            self._compressor = None
+        return data[:-len(_TAIL)]
+
+    def decompress(self, payload, max_size=None):
+        '''
+        Returns the decompressed ``payload`` of a message. Raises a
+        :class:`~django_websocket.framing.FrameError` if the message would be
+        larger than ``max_size`` bytes, without decompressing the rest.
+        '''
+        if self._decompressor is None:
+            self._decompressor = zlib.decompressobj(-self.client_window_bits)
+        try:
+            if max_size is None:
+                data = self._decompressor.decompress(payload + _TAIL)
+            else:
+                data = self._decompressor.decompress(payload + _TAIL,
+                    max_size + 1)
+        except zlib.error as e:
+            raise FrameError('Invalid compressed data: %s' % e)
+        if max_size is not None and len(data) > max_size:
+            self._decompressor = None
+            raise FrameError('Message exceeds %d bytes.' % max_size,
+                CLOSE_MESSAGE_TOO_BIG)
+        if not self.client_context_takeover:
+            self._decompressor = None
+        return data
+
+    def compress_stream(self, payload, final=False):
+        '''
+        Compresses a part of a message that is sent in several frames.
+        *final* marks the last part, whose compressed data ends the message.
+        '''
+        if self._compressor is None:
+            self._compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                -self.server_window_bits, self.mem_level)
+        data = self._compressor.compress(payload)
+        if not final:
+            return data
+        data += self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        if not self.server_context_takeover:
+            self._compressor = None
+        return data[:-len(_TAIL)]
+
+    def decompress_stream(self, payload, final=False,
+        chunk_size=STREAM_CHUNK_SIZE):
+        '''
+        Decompresses a part of a message that is received in several pieces
+        and returns a list of chunks of at most *chunk_size* bytes. *final*
+        marks the last part of the message.
+        '''
+        if self._decompressor is None:
+            self._decompressor = zlib.decompressobj(-self.client_window_bits)
+        if final:
+            payload += _TAIL
+        chunks = []
+        try:
+            while payload:
+                data = self._decompressor.decompress(payload, chunk_size)
+                if data:
+                    chunks.append(data)
+                payload = self._decompressor.unconsumed_tail
+        except zlib.error as e:
+            raise FrameError('Invalid compressed data: %s' % e)
+        if final and not self.client_context_takeover:
+            self._decompressor = None
+        return chunks
+
+    def release(self):
+        '''
+        Drops the zlib contexts that can be dropped without breaking the
+        stream. The compression context can always be dropped: the next
+        message starts a new stream that doesn't refer to earlier ones. The
+        decompression context is still needed if the client keeps its
+        context between messages.
+        '''
+        self._compressor = None
+        if not self.client_context_takeover:
+            self._decompressor = None
@@ -0,0 +1,556 @@
+'''
+Incremental frame parsers and frame packers used by
+:class:`~django_websocket.websocket.WebSocket`.
+
+A parser is fed with the raw bytes read from the socket and returns the
+messages of all frames that are complete so far as ``(opcode, payload)``
+tuples. Data that belongs to an unfinished frame stays in the parser and is
+never scanned twice, so the work done per received byte is constant no matter
+how the frames are split up between ``recv()`` calls.
+
+The parsers keep the received data in one growable ``bytearray`` per
+connection. :meth:`~FrameBuffer.recv_into` reads from a socket directly into
+its free space and payloads are sliced out of it through ``memoryview``, so a
+payload is only copied when it's handed out as a message.
+
+A parser with ``streaming`` set reports the next message in chunks as its
+data arrives, as ``(opcode, chunk, final)`` tuples, instead of buffering the
+whole message. ``final`` is true for the last chunk, after which
+``streaming`` is reset. Streamed messages aren't limited by
+``max_message_size``.
+'''
+import struct
+
+
+OPCODE_CONTINUATION = 0x0
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xA
+
+CLOSE_NORMAL = 1000
+CLOSE_GOING_AWAY = 1001
+CLOSE_PROTOCOL_ERROR = 1002
+CLOSE_UNSUPPORTED_DATA = 1003
+CLOSE_POLICY_VIOLATION = 1008
+CLOSE_MESSAGE_TOO_BIG = 1009
+CLOSE_INTERNAL_ERROR = 1011
+
+_DATA_OPCODES = (OPCODE_CONTINUATION, OPCODE_TEXT, OPCODE_BINARY)
+_CONTROL_OPCODES = (OPCODE_CLOSE, OPCODE_PING, OPCODE_PONG)
+
+# Initial capacity of the receive buffer of a parser.
+INITIAL_BUFFER_SIZE = 4096
+# An empty receive buffer that grew larger than this, e.g. for a huge message,
+# is replaced by a new one of the initial size.
+_SHRINK_BUFFER_SIZE = 256 * 1024
+# Payloads up to this size are copied out of the receive buffer by slicing it
+# twice, which is cheaper than creating a memoryview for them.
+_SMALL_PAYLOAD_SIZE = 512
+
+
+class FrameError(ValueError):
+    '''
+    Raised by a parser if the peer violates the framing protocol. ``code`` is
+    the status code that should be used to close the connection.
+    '''
+    def __init__(self, message, code=CLOSE_PROTOCOL_ERROR):
+        super(FrameError, self).__init__(message)
+        self.code = code
+
+
+# Translation tables that XOR every byte with a given key. Unmasking a payload
+# with ``str.translate`` works on a whole slice at once in C instead of
+# touching every byte in Python.
+_XOR_TABLES = [bytes(bytearray(i ^ key for i in range(256)))
+    for key in range(256)]
+
+
+def unmask(mask, data):
+    '''
+    XORs ``data`` with the four byte ``mask`` as described in section 5.3 of
+    RFC 6455. Masking and unmasking are the same operation.
+
+    Every fourth byte is XORed with the same mask byte, so the payload is cut
+    into four strided slices which are translated in bulk and then woven back
+    together.
+    '''
+    out = bytearray(data)
+    unmask_into(mask, out)
+    return bytes(out)
+
+
+def unmask_into(mask, buf, start=0, end=None):
+    '''
+    Like :func:`unmask`, but XORs ``buf[start:end]`` of the bytearray
+    ``buf`` in place. The parser unmasks payloads in its receive buffer this
+    way, so they are copied only once, when they are taken out of it.
+    '''
+    if end is None:
+        end = len(buf)
+    mask = bytearray(mask)
+    for i in range(4):
+        buf[start + i:end:4] = \
+            buf[start + i:end:4].translate(_XOR_TABLES[mask[i]])
+
+
+class FrameBuffer(object):
+    '''
+    Base class of the parsers that manages the receive buffer.
+
+    ``buffer`` is reused for the whole connection. ``buffer[_start:_end]``
+    holds the data that isn't parsed yet, the space after ``_end`` is free
+    for the next read. Consumed data is dropped by moving ``_start``; the
+    remainder is only moved to the front when room for new data is needed.
+
+    ``wanted`` is the number of bytes that are still missing to complete the
+    frame at the start of the buffer, or ``0`` if that isn't known.
+    '''
+    wanted = 0
+    streaming = False
+    # ``True`` while a streamed message is being received.
+    in_stream = False
+
+    def __init__(self):
+        self.buffer = bytearray(INITIAL_BUFFER_SIZE)
+        self._start = 0
+        self._end = 0
+
+    def __len__(self):
+        return self._end - self._start
+
+    def feed(self, data):
+        '''
+        Append ``data`` to the internal buffer.
+        '''
+        size = len(data)
+        self.reserve(size)
+        self.buffer[self._end:self._end + size] = data
+        self._end += size
+
+    def recv_into(self, sock, size):
+        '''
+        Reads up to ``size`` bytes from the socket ``sock`` directly into the
+        internal buffer. Returns the number of bytes read, ``0`` if the peer
+        closed the connection.
+        '''
+        self.reserve(size)
+        received = sock.recv_into(memoryview(self.buffer)[self._end:], size)
+        self._end += received
+        return received
+
+    def reserve(self, size):
+        '''
+        Makes room for at least ``size`` bytes after the buffered data.
+        '''
+        buf = self.buffer
+        if len(buf) - self._end >= size:
+            return
+        length = self._end - self._start
+        if length + size <= len(buf):
+            buf[:length] = buf[self._start:self._end]
+        else:
+            self.buffer = bytearray(max(len(buf) * 2, length + size))
+            self.buffer[:length] = memoryview(buf)[self._start:self._end]
+        self._start = 0
+        self._end = length
+
+    def _consume(self, pos):
+        '''
+        Drops the buffered data before the position ``pos``.
+        '''
+        if pos < self._end:
+            self._start = pos
+            return
+        self._start = self._end = 0
+        if len(self.buffer) > _SHRINK_BUFFER_SIZE:
+            self.buffer = bytearray(INITIAL_BUFFER_SIZE)
+
+    def _check_buffer_size(self, max_buffer_size):
+        if max_buffer_size is not None and len(self) > max_buffer_size:
+            raise FrameError(
+                'More than %d bytes of incomplete frames buffered.' %
+                max_buffer_size, CLOSE_MESSAGE_TOO_BIG)
+
+
+class HixieParser(FrameBuffer):
+    '''
+    Parser for the ``\\x00 ... \\xFF`` framing of the hixie-75/76 drafts.
+    Messages are reported with ``OPCODE_TEXT``, the closing frame with
+    ``OPCODE_CLOSE``.
+
+    ``max_message_size`` limits the payload of a message and
+    ``max_buffer_size`` the amount of buffered data that doesn't belong to a
+    complete frame yet. :meth:`parse` raises a :class:`FrameError` if one of
+    them is exceeded.
+    '''
+
+    def __init__(self, max_message_size=None, max_buffer_size=None):
+        super(HixieParser, self).__init__()
+        self.closed = False
+        self.max_message_size = max_message_size
+        self.max_buffer_size = max_buffer_size
+        # The first ``_scanned`` bytes of the buffered data were already
+        # searched for the ``\xFF`` terminator of the current frame.
+        self._scanned = 0
+
+    def parse(self):
+        '''
+        Returns a list of ``(opcode, payload)`` tuples for all complete frames
+        in the buffer. The consumed bytes are removed from the buffer, the
+        remainder is kept until more data is fed.
+
+        Sets ``closed`` to ``True`` if the closing frame was received.
+        '''
+        buf = self.buffer
+        find = buf.find
+        pos = self._start
+        end = self._end
+        scanned = pos + self._scanned
+        msgs = []
+        if not self.streaming and not self.closed and pos < end and \
+            buf[pos] == 0x00:
+            # Fast path for a run of normal frames. Every terminator but the
+            # last one is followed by the start of the next frame, so the
+            # payloads are cut out of one copy of the run by a single split.
+            last = find(b'\xff', scanned, end)
+            if last != -1:
+                last = buf.rfind(b'\xff', last, end)
+                run = memoryview(buf)[pos + 1:last].tobytes()
+                if run.find(b'\xff') == -1:
+                    payloads = [run]
+                else:
+                    payloads = run.split(b'\xff\x00')
+                    # Another ``\xff`` belongs to a closing frame or a frame
+                    # of an unknown type, which the loop below handles.
+                    if run.count(b'\xff') != len(payloads) - 1:
+                        payloads = None
+                if payloads is not None:
+                    if self.max_message_size is not None:
+                        self._check_size(max(map(len, payloads)))
+                    msgs = [(OPCODE_TEXT, payload) for payload in payloads]
+                    pos = scanned = last + 1
+            else:
+                scanned = end
+        while pos < end and not self.closed:
+            if self.in_stream:
+                end_idx = find(b'\xff', pos, end)
+                if end_idx == -1:
+                    msgs.append((OPCODE_TEXT, bytes(buf[pos:end]), False))
+                    pos = scanned = end
+                    break
+                msgs.append((OPCODE_TEXT, bytes(buf[pos:end_idx]), True))
+                pos = scanned = end_idx + 1
+                self.in_stream = self.streaming = False
+                continue
+            frame_type = buf[pos]
+            if frame_type == 0x00 and self.streaming:
+                self.in_stream = True
+                pos = scanned = pos + 1
+            elif frame_type == 0x00:
+                # Normal message.
+                start = pos + 1
+                if scanned > start:
+                    start = scanned
+                end_idx = find(b'\xff', start, end)
+                if end_idx == -1:
+                    scanned = end
+                    end_idx = end
+                self._check_size(end_idx - pos - 1)
+                if end_idx == end:
+                    break
+                if end_idx - pos <= _SMALL_PAYLOAD_SIZE:
+                    payload = bytes(buf[pos + 1:end_idx])
+                else:
+                    payload = memoryview(buf)[pos + 1:end_idx].tobytes()
+                msgs.append((OPCODE_TEXT, payload))
+                pos = end_idx + 1
+            elif frame_type == 0xff:
+                # Closing handshake.
+                if pos + 1 == end:
+                    break
+                if buf[pos + 1] != 0x00:
+                    raise FrameError("Unexpected closing handshake: %r" %
+                        bytes(buf[pos:end]))
+                self.closed = True
+                msgs.append((OPCODE_CLOSE, b''))
+                pos += 2
+            else:
+                raise FrameError(
+                    "Don't understand how to parse this type of message: %r" %
+                    bytes(buf[pos:end]))
+        self._scanned = max(scanned - pos, 0)
+        self._consume(pos)
+        self._check_buffer_size(self.max_buffer_size)
+        return msgs
+
+    def _check_size(self, size):
+        if self.max_message_size is not None and size > self.max_message_size:
+            raise FrameError('Message exceeds %d bytes.' %
+                self.max_message_size, CLOSE_MESSAGE_TOO_BIG)
+
+
+class HybiParser(FrameBuffer):
+    '''
+    Parser for the framing of RFC 6455 (hybi-13). Fragmented messages are
+    reassembled and reported with the opcode of their first frame, control
+    frames are reported as soon as they arrive, even in between the fragments
+    of a message.
+
+    Frames sent by a client must be masked. Pass ``mask_required=False`` to
+    parse frames sent by a server.
+
+    If ``deflate`` is given, it is used to decompress messages that have the
+    RSV1 bit set, see :mod:`django_websocket.deflate`.
+
+    ``max_message_size`` and ``max_buffer_size`` work as for
+    :class:`HixieParser`. The size of a message is checked as soon as the
+    frame header is received and again after decompression.
+    '''
+
+    def __init__(self, mask_required=True, deflate=None,
+        max_message_size=None, max_buffer_size=None):
+        super(HybiParser, self).__init__()
+        self.closed = False
+        self.mask_required = mask_required
+        self.deflate = deflate
+        self.max_message_size = max_message_size
+        self.max_buffer_size = max_buffer_size
+        self._fragments = []
+        self._fragments_size = 0
+        self._message_opcode = None
+        self._message_compressed = False
+        # Payload bytes of the current streamed frame that are still to come,
+        # its mask and the number of bytes that were unmasked already.
+        self._stream_remaining = 0
+        self._stream_mask = None
+        self._stream_offset = 0
+        self._stream_fin = False
+
+    def parse(self):
+        '''
+        Returns a list of ``(opcode, payload)`` tuples for all complete
+        messages in the buffer. The consumed bytes are removed from the
+        buffer. A frame that is only partially received is kept until more
+        data is fed; only its header is looked at again.
+
+        Sets ``closed`` to ``True`` if a close frame was received. Raises
+        :class:`FrameError` if the data violates the protocol.
+        '''
+        buf = self.buffer
+        pos = self._start
+        end = self._end
+        msgs = []
+        self.wanted = 0
+        while not self.closed:
+            available = end - pos
+            if self._stream_remaining:
+                if not available:
+                    self.wanted = self._stream_remaining
+                    break
+                size = min(available, self._stream_remaining)
+                if self._stream_mask is not None:
+                    offset = self._stream_offset % 4
+                    unmask_into(self._stream_mask[offset:] +
+                        self._stream_mask[:offset], buf, pos, pos + size)
+                payload = memoryview(buf)[pos:pos + size].tobytes()
+                pos += size
+                self._stream_offset += size
+                self._stream_remaining -= size
+                self._stream_chunk(msgs, payload,
+                    self._stream_fin and not self._stream_remaining)
+                continue
+            if available < 2:
+                break
+            first, second = buf[pos], buf[pos + 1]
+            fin = first & 0x80
+            opcode = first & 0x0f
+            masked = second & 0x80
+            length = second & 0x7f
+            header_length = 2
+            if length == 126:
+                header_length = 4
+                if available < header_length:
+                    break
+                length = struct.unpack_from('!H', buf, pos + 2)[0]
+            elif length == 127:
+                header_length = 10
+                if available < header_length:
+                    break
+                length = struct.unpack_from('!Q', buf, pos + 2)[0]
+                if length >> 63:
+                    raise FrameError('Invalid payload length.')
+            if masked:
+                header_length += 4
+            self._check_frame(first, opcode, fin, masked, length)
+            if self.streaming and opcode not in _CONTROL_OPCODES:
+                if available < header_length:
+                    break
+                pos = self._start_stream_frame(msgs, first, opcode, fin,
+                    masked, length, pos, header_length)
+                continue
+            if available < header_length + length:
+                self.wanted = header_length + length - available
+                break
+
+            start = pos + header_length
+            if masked:
+                unmask_into(buf[start - 4:start], buf, start, start + length)
+            if length <= _SMALL_PAYLOAD_SIZE:
+                payload = bytes(buf[start:start + length])
+            else:
+                payload = memoryview(buf)[start:start + length].tobytes()
+            pos = start + length
+
+            if opcode in _CONTROL_OPCODES:
+                if opcode == OPCODE_CLOSE:
+                    self.closed = True
+                msgs.append((opcode, payload))
+                continue
+            if opcode != OPCODE_CONTINUATION:
+                self._message_opcode = opcode
+                self._message_compressed = bool(first & 0x40)
+            if not fin:
+                self._fragments.append(payload)
+                self._fragments_size += length
+                continue
+            if self._fragments:
+                self._fragments.append(payload)
+                payload = b''.join(self._fragments)
+                self._fragments = []
+                self._fragments_size = 0
+            if self._message_compressed:
+                payload = self.deflate.decompress(payload,
+                    self.max_message_size)
+            msgs.append((self._message_opcode, payload))
+            self._message_opcode = None
+        self._consume(pos)
+        self._check_buffer_size(self.max_buffer_size)
+        return msgs
+
+    def _start_stream_frame(self, msgs, first, opcode, fin, masked, length,
+        pos, header_length):
+        '''
+        Takes the header of a frame of a streamed message and returns the
+        position of its payload, which is reported as it arrives.
+        '''
+        if opcode != OPCODE_CONTINUATION:
+            self._message_opcode = opcode
+            self._message_compressed = bool(first & 0x40)
+        self.in_stream = True
+        if self._fragments:
+            # Streaming was switched on in the middle of the message.
+            payload = b''.join(self._fragments)
+            self._fragments = []
+            self._fragments_size = 0
+            self._stream_chunk(msgs, payload, False)
+        start = pos + header_length
+        if masked:
+            self._stream_mask = bytes(self.buffer[start - 4:start])
+        else:
+            self._stream_mask = None
+        self._stream_remaining = length
+        self._stream_offset = 0
+        self._stream_fin = bool(fin)
+        if not length:
+            self._stream_chunk(msgs, b'', self._stream_fin)
+        return start
+
+    def _stream_chunk(self, msgs, payload, final):
+        opcode = self._message_opcode
+        if self._message_compressed:
+            chunks = self.deflate.decompress_stream(payload, final)
+        else:
+            chunks = [payload]
+        for chunk in chunks[:-1]:
+            msgs.append((opcode, chunk, False))
+        msgs.append((opcode, chunks[-1] if chunks else b'', final))
+        if final:
+            self._message_opcode = None
+            self.in_stream = self.streaming = False
+
+    def _check_frame(self, first, opcode, fin, masked, length):
+        reserved = first & 0x70
+        # RSV1 marks the first frame of a compressed message.
+        if reserved and not (reserved == 0x40 and self.deflate is not None and
+            opcode in (OPCODE_TEXT, OPCODE_BINARY)):
+            raise FrameError('Reserved bits must not be set.')
+        if self.mask_required and not masked:
+            raise FrameError('Frames sent by the client must be masked.')
+        if opcode in _CONTROL_OPCODES:
+            if not fin:
+                raise FrameError('Control frames must not be fragmented.')
+            if length > 125:
+                raise FrameError('Control frame payload is too big.')
+        elif opcode not in _DATA_OPCODES:
+            raise FrameError('Unknown opcode %#x.' % opcode)
+        elif self.max_message_size is not None and not self.streaming and \
+            self._fragments_size + length > self.max_message_size:
+            raise FrameError('Message exceeds %d bytes.' %
+                self.max_message_size, CLOSE_MESSAGE_TOO_BIG)
+        elif opcode == OPCODE_CONTINUATION:
+            if self._message_opcode is None:
+                raise FrameError('Continuation frame without a message.')
+        elif self._message_opcode is not None:
+            raise FrameError('Expected a continuation frame.')
+
+
+def pack_hixie_message(payload):
+    '''
+    Wraps ``payload`` between ``\\x00`` and ``\\xFF`` as required by the
+    hixie-75/76 drafts.
+    '''
+    return b'\x00' + payload + b'\xff'
+
+
+def pack_hybi_header(opcode, length, fin=True, mask=None, rsv1=False):
+    '''
+    Returns the header of a RFC 6455 frame with the given ``opcode`` and
+    payload ``length``. ``mask`` is appended if given. ``rsv1`` marks a
+    compressed message.
+    '''
+    first = opcode
+    if fin:
+        first |= 0x80
+    if rsv1:
+        first |= 0x40
+    mask_bit = 0x80 if mask else 0
+    if length < 126:
+        header = struct.pack('!BB', first, mask_bit | length)
+    elif length < 0x10000:
+        header = struct.pack('!BBH', first, mask_bit | 126, length)
+    else:
+        header = struct.pack('!BBQ', first, mask_bit | 127, length)
+    if mask:
+        return header + mask
+    return header
+
+
+def pack_hybi_frame(opcode, payload, fin=True, mask=None, rsv1=False):
+    '''
+    Returns a RFC 6455 frame with the given ``opcode`` and ``payload``. The
+    payload is masked with ``mask`` if given, which is required for frames
+    sent by a client. ``rsv1`` marks a compressed message.
+    '''
+    header = pack_hybi_header(opcode, len(payload), fin, mask, rsv1)
+    if mask:
+        return header + unmask(mask, payload)
+    return header + payload
+
+
+def pack_close_payload(code, reason=b''):
+    '''
+    Returns the payload of a close frame with status ``code``.
+    '''
+    return struct.pack('!H', code) + reason
+
+
+def unpack_close_payload(payload):
+    '''
+    Returns the status code and reason of a close frame payload. The code is
+    ``None`` if the peer didn't send one.
+    '''
+    if len(payload) < 2:
+        return None, b''
+    return struct.unpack('!H', payload[:2])[0], payload[2:]
@@ -0,0 +1,52 @@
+'''
+Run requests through the middleware and the views of the project without a
+WSGI server, for :class:`~django_websocket.testing.WebSocketClient` and
+:class:`~django_websocket.asgi.WebSocketASGIHandler`.
+'''
+import threading
+from django.core import signals
+from django.core.handlers.wsgi import WSGIHandler
+try:
+    from django.urls import set_script_prefix
+except ImportError: #pragma NO COVER
+    from django.core.urlresolvers import set_script_prefix
+
+
+class RequestHandler(object):
+    '''
+    Handles requests like the WSGI handler of Django. The middleware of the
+    settings is loaded when the first request is handled.
+    '''
+
+    def __init__(self):
+        self._handler = None
+        self._lock = threading.Lock()
+
+    def get_handler(self):
+        '''
+        Returns the ``WSGIHandler`` with the middleware loaded.
+        '''
+        with self._lock:
+            if self._handler is None:
+                handler = WSGIHandler()
+                if getattr(handler, '_request_middleware', None) is None:
+                    handler.load_middleware()
+                self._handler = handler
+        return self._handler
+
+    def get_response(self, environ, sender, websocket=None):
+        '''
+        Runs the view for the WSGI *environ* in the current thread and
+        returns the request and the closed response. *sender* is the sender
+        of the ``request_started`` signal and *websocket*, if given, becomes
+        ``request.websocket`` before the middleware runs.
+        '''
+        handler = self.get_handler()
+        set_script_prefix(environ['SCRIPT_NAME'] or '/')
+        signals.request_started.send(sender=sender, environ=environ)
+        request = handler.request_class(environ)
+        if websocket is not None:
+            request.websocket = websocket
+        response = handler.get_response(request)
+        response.close()
+        return request, response
@@ -0,0 +1,249 @@
+'''
+Serve websockets from a background thread instead of the request thread.
+
+A view that serves a websocket keeps its worker of the WSGI server busy for
+as long as the client stays connected. :func:`handoff` passes the websocket
+of a request to a :class:`WebSocketService` together with a
+:class:`WebSocketHandler`, and the view returns right away::
+
+    from django_websocket.handoff import WebSocketHandler, handoff
+
+    class Echo(WebSocketHandler):
+        def on_message(self, websocket, message):
+            websocket.send(message)
+
+    @require_websocket
+    def echo(request):
+        handoff(request, Echo())
+
+The service reads from all websockets it took over with one
+:class:`~django_websocket.poller.WebSocketPoller` in a single thread and
+calls the handlers from there. Handlers therefore must not block; enable the
+write buffer (``WEBSOCKET_WRITE_BUFFER``) so that slow clients don't stall
+the others.
+'''
+import collections
+import logging
+import os
+import threading
+from socket import socketpair, error as SocketError, SHUT_WR
+from django_websocket.framing import CLOSE_GOING_AWAY, CLOSE_INTERNAL_ERROR
+from django_websocket.poller import WebSocketPoller, EVENT_READ
+
+
+logger = logging.getLogger('django_websocket')
+
+
+class WebSocketHandler(object):
+    '''
+    Base class for the handlers of websockets served by a
+    :class:`WebSocketService`. The methods are called in the thread of the
+    service. A handler that raises an exception gets its websocket closed
+    with status code 1011.
+    '''
+
+    def on_open(self, websocket):
+        '''
+        Called when the service took over *websocket*.
+        '''
+
+    def on_message(self, websocket, message):
+        '''
+        Called for every message received from the client.
+        '''
+
+    def on_close(self, websocket):
+        '''
+        Called once *websocket* is closed, by either side. The socket is
+        closed afterwards.
+        '''
+
+
+def detach_connection(sock):
+    '''
+    Disconnects the socket *sock* of the WSGI server from the client, so
+    that the response which the server writes after the view returned
+    doesn't end up in the websocket stream. The file descriptor of *sock* is
+    replaced by one end of a new socket pair; the connection itself stays
+    open through the duplicate held by the websocket.
+
+    Returns the other end of the pair, which must stay open until the server
+    is done with *sock*. Reads of the server see the end of the stream.
+    '''
+    local, placeholder = socketpair()
+    try:
+        os.dup2(local.fileno(), sock.fileno())
+    finally:
+        local.close()
+    placeholder.shutdown(SHUT_WR)
+    return placeholder
+
+
+class WebSocketService(object):
+    '''
+    Serves websockets with :class:`WebSocketHandler` objects from one
+    background thread.
+
+    :meth:`adopt` can be called from any thread. The thread is started by
+    :meth:`start`; :meth:`serve_once` runs a single iteration of it instead.
+    '''
+
+    def __init__(self, poller=None):
+        if poller is None:
+            poller = WebSocketPoller()
+        self.poller = poller
+        self._handlers = {}
+        self._adopted = collections.deque()
+        self._lock = threading.Lock()
+        # Interrupts a poll when websockets are adopted or the service stops.
+        self._waker, self._wakeup = socketpair()
+        self._waker.setblocking(False)
+        self._wakeup.setblocking(False)
+        self.poller.selector.register(self._waker, EVENT_READ, None)
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def __len__(self):
+        return len(self._handlers) + len(self._adopted)
+
+    def __contains__(self, websocket):
+        return websocket in self._handlers
+
+    def adopt(self, websocket, handler, placeholder=None):
+        '''
+        Serves *websocket* with *handler* from now on. *placeholder* is
+        closed together with the websocket, see :func:`detach_connection`.
+        '''
+        with self._lock:
+            self._adopted.append((websocket, handler, placeholder))
+        self._wake()
+
+    def _wake(self):
+        try:
+            self._wakeup.send(b'\x00')
+        except SocketError:
+            # The pair is full, so the poll is interrupted anyway.
+            pass
+
+    def _take_over(self):
+        try:
+            while self._waker.recv(4096):
+                pass
+        except SocketError:
+            pass
+        with self._lock:
+            adopted = list(self._adopted)
+            self._adopted.clear()
+        for websocket, handler, placeholder in adopted:
+            self._handlers[websocket] = (handler, placeholder)
+            self.poller.register(websocket)
+            self._call(websocket, handler.on_open, websocket)
+
+    def _call(self, websocket, method, *args):
+        try:
+            method(*args)
+        except SocketError:
+            # The client is gone.
+            websocket.closed = True
+        except Exception:
+            logger.exception('Websocket handler %r failed.', method)
+            websocket._fail_connection(CLOSE_INTERNAL_ERROR)
+            websocket.closed = True
+
+    def _drop(self, websocket):
+        if websocket in self.poller:
+            self.poller.unregister(websocket)
+        handler, placeholder = self._handlers.pop(websocket)
+        self._call(websocket, handler.on_close, websocket)
+        websocket._send_closing_frame(True)
+        websocket.socket.close()
+        if websocket.metrics is not None:
+            websocket.metrics.registry.unregister(websocket)
+        if placeholder is not None:
+            placeholder.close()
+
+    def serve_once(self, timeout=None):
+        '''
+        Takes over adopted websockets, waits up to *timeout* seconds (forever
+        if ``None``) for incoming data and passes the received messages to
+        the handlers. Closed websockets are dropped.
+        '''
+        self._take_over()
+        for websocket, messages in self.poller.poll(timeout):
+            handler = self._handlers[websocket][0]
+            for message in messages:
+                if websocket.closed:
+                    break
+                self._call(websocket, handler.on_message, websocket, message)
+        for websocket in [websocket for websocket in self._handlers
+            if websocket.closed]:
+            self._drop(websocket)
+
+    def start(self):
+        '''
+        Starts the thread that serves the websockets, unless it's running
+        already.
+        '''
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run,
+                name='django_websocket.WebSocketService')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        '''
+        Stops the thread that serves the websockets. The websockets stay
+        open.
+        '''
+        self._stopped.set()
+        self._wake()
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        self._thread = None
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.serve_once()
+            except Exception:
+                logger.exception('Serving websockets failed.')
+
+    def close(self):
+        '''
+        Stops the service and closes all websockets with status code 1001.
+        '''
+        self.stop()
+        self._take_over()
+        for websocket in list(self._handlers):
+            websocket._fail_connection(CLOSE_GOING_AWAY)
+            websocket.closed = True
+            self._drop(websocket)
+        self.poller.close()
+        self._waker.close()
+        self._wakeup.close()
+
+
+websocket_service = WebSocketService()
+
+
+def handoff(request, handler, service=None):
+    '''
+    Hands the websocket of *request* over to *service*, which defaults to
+    the one shared by the whole process, and serves it with *handler* from
+    then on. The handshake is sent if that didn't happen yet. The view
+    should return right after this call; the middleware leaves the
+    websocket open.
+    '''
+    if service is None:
+        service = websocket_service
+    websocket = request.websocket
+    if not websocket._handshake_sent:
+        websocket.send_handshake()
+    placeholder = detach_connection(request.META['wsgi.input']._sock)
+    websocket.handed_off = True
+    service.adopt(websocket, handler, placeholder)
+    service.start()
@@ -0,0 +1,262 @@
+'''
+Detect dead clients with pings and close websockets that stay silent.
+
+A client that vanishes without closing the connection would otherwise keep
+the view that serves it blocked in ``WebSocket.wait()`` forever.
+:class:`KeepAlive` pings websockets that didn't receive anything for a while
+and closes them if the client doesn't answer in time::
+
+    from django_websocket.keepalive import KeepAlive
+
+    keepalive = KeepAlive(ping_interval=20, timeout=60)
+    keepalive.register(request.websocket)
+
+The ``WEBSOCKET_KEEPALIVE`` setting does this for every websocket.
+
+All websockets of a process share one :class:`TimerWheel`, which is advanced
+by a single background thread. Each websocket has one timer at a time.
+Parsed frames only update ``WebSocket.last_activity`` and don't touch the
+wheel; the timer checks that timestamp when it fires and schedules itself
+again for the next deadline. A tick therefore only costs the timers that
+are due, no matter how many websockets are connected.
+
+Only complete frames count as activity, so pongs keep a connection alive once
+the view reads them, e.g. while it waits in ``WebSocket.wait()``. A client
+that trickles bytes without completing a frame is closed like a silent one.
+'''
+import logging
+import math
+import threading
+import time
+from socket import error as SocketError
+
+
+logger = logging.getLogger('django_websocket')
+
+
+class Timer(object):
+    '''
+    A callback scheduled on a :class:`TimerWheel`. ``rounds`` counts the
+    turns of the wheel that are left before it is due.
+    '''
+    __slots__ = ('callback', 'args', 'rounds', 'active')
+
+    def __init__(self, callback, args, rounds):
+        self.callback = callback
+        self.args = args
+        self.rounds = rounds
+        self.active = True
+
+
+class TimerWheel(object):
+    '''
+    A hashed timing wheel. Timers are put into one of ``slots`` lists by
+    their deadline, with a resolution of ``tick`` seconds. Every tick only
+    the list of the current slot is looked at, so scheduling, cancelling and
+    advancing don't depend on the total number of timers.
+
+    The wheel is advanced by :meth:`advance`, which is called by a daemon
+    thread once :meth:`start` was called. Callbacks run in that thread.
+    '''
+
+    def __init__(self, tick=1.0, slots=512):
+        self.tick = tick
+        self._slots = [[] for i in range(slots)]
+        self._lock = threading.Lock()
+        self._epoch = time.time()
+        self._current = 0
+        self._count = 0
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def __len__(self):
+        return self._count
+
+    def schedule(self, delay, callback, *args):
+        '''
+        Calls ``callback(*args)`` after *delay* seconds, rounded up to full
+        ticks. Returns a :class:`Timer` that can be passed to
+        :meth:`cancel`.
+        '''
+        ticks = max(int(math.ceil(delay / float(self.tick))), 1)
+        count = len(self._slots)
+        timer = Timer(callback, args, (ticks - 1) // count)
+        with self._lock:
+            self._slots[(self._current + ticks) % count].append(timer)
+            self._count += 1
+        return timer
+
+    def cancel(self, timer):
+        '''
+        Cancels *timer* if it didn't fire yet.
+        '''
+        with self._lock:
+            if timer.active:
+                timer.active = False
+                self._count -= 1
+
+    def advance(self, now=None):
+        '''
+        Processes all ticks up to the time *now*, which defaults to the
+        current time, and calls the callbacks of the timers that are due.
+        Returns the number of called callbacks.
+        '''
+        if now is None:
+            now = time.time()
+        target = int((now - self._epoch) / self.tick)
+        count = len(self._slots)
+        called = 0
+        while self._current < target:
+            due = []
+            with self._lock:
+                self._current += 1
+                slot = self._slots[self._current % count]
+                pending = []
+                for timer in slot:
+                    if not timer.active:
+                        continue
+                    if timer.rounds:
+                        timer.rounds -= 1
+                        pending.append(timer)
+                    else:
+                        timer.active = False
+                        due.append(timer)
+                slot[:] = pending
+                self._count -= len(due)
+            for timer in due:
+                try:
+                    timer.callback(*timer.args)
+                except Exception:
+                    logger.exception('Timer callback %r failed.',
+                        timer.callback)
+            called += len(due)
+        return called
+
+    def start(self):
+        '''
+        Starts the thread that advances the wheel, unless it's running
+        already.
+        '''
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run,
+                name='django_websocket.TimerWheel')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        '''
+        Stops the thread that advances the wheel. Pending timers are kept.
+        '''
+        self._stopped.set()
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        self._thread = None
+
+    def _run(self):
+        while not self._stopped.wait(self.tick):
+            self.advance()
+
+
+timer_wheel = TimerWheel()
+
+
+class KeepAlive(object):
+    '''
+    Pings registered websockets that didn't receive a frame for
+    ``ping_interval`` seconds and closes them once they didn't receive
+    one for ``timeout`` seconds, with status code 1001.
+
+    Closed websockets are dropped automatically; views that keep running
+    after closing their websocket should call :meth:`unregister`.
+    '''
+
+    def __init__(self, ping_interval=20.0, timeout=60.0, wheel=None,
+        hixie_message=None):
+        '''
+        Arguments:
+
+        - ``ping_interval``: Seconds without incoming data after which the
+          client is pinged.
+        - ``timeout``: Seconds without incoming data after which the
+          websocket is closed.
+        - ``wheel``: The :class:`TimerWheel` to use. Defaults to the one that
+          is shared by the whole process, which is started on the first
+          :meth:`register` call.
+        - ``hixie_message``: The hixie drafts have no ping frames. If given,
+          this message is sent to hixie clients instead, which the client
+          application is expected to answer. Otherwise hixie clients are only
+          closed when they stay silent for ``timeout`` seconds.
+        '''
+        if timeout < ping_interval:
+            raise ValueError("timeout must not be shorter than ping_interval.")
+        self.ping_interval = ping_interval
+        self.timeout = timeout
+        self.hixie_message = hixie_message
+        if wheel is None:
+            wheel = timer_wheel
+        self.wheel = wheel
+        self._timers = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._timers)
+
+    def __contains__(self, websocket):
+        return websocket in self._timers
+
+    def register(self, websocket):
+        '''
+        Starts watching *websocket*.
+        '''
+        self._schedule(websocket, self.ping_interval)
+        if self.wheel is timer_wheel:
+            timer_wheel.start()
+
+    def unregister(self, websocket):
+        '''
+        Stops watching *websocket*.
+        '''
+        with self._lock:
+            timer = self._timers.pop(websocket, None)
+        if timer is not None:
+            self.wheel.cancel(timer)
+
+    def _schedule(self, websocket, delay, rearm=False):
+        timer = self.wheel.schedule(delay, self._check, websocket)
+        with self._lock:
+            if rearm and websocket not in self._timers:
+                # Unregistered while the fired timer checked it.
+                previous = timer
+            else:
+                previous = self._timers.get(websocket)
+                self._timers[websocket] = timer
+        if previous is not None:
+            self.wheel.cancel(previous)
+
+    def _check(self, websocket):
+        if websocket.closed:
+            self.unregister(websocket)
+            return
+        try:
+            idle = time.time() - websocket.last_activity
+            if idle >= self.timeout:
+                self.unregister(websocket)
+                websocket._reap()
+                return
+            if idle >= self.ping_interval:
+                frame = websocket._keepalive_frame(self.hixie_message)
+                if frame is not None:
+                    websocket._write_nowait(frame)
+                delay = min(self.ping_interval, self.timeout - idle)
+            else:
+                delay = self.ping_interval - idle
+        except (SocketError, ValueError):
+            # The connection is broken or the socket already closed.
+            self.unregister(websocket)
+            websocket._reap()
+            return
+        self._schedule(websocket, delay, rearm=True)
@@ -0,0 +1,136 @@
+'''
+Generate load on a websocket view that echoes messages, like the ``echo``
+view of the example project, to find out how many connections and messages
+a deployment handles::
+
+    python manage.py websocket_loadtest ws://127.0.0.1:8000/echo \\
+        --clients 200 --messages 100 --size 64
+
+Every simulated client runs in its own thread. All clients connect first,
+which gives the connection rate, then each one sends its messages one at a
+time and waits for the echo, which gives the message throughput and the
+round trip times.
+'''
+import math
+import threading
+import time
+from django_websocket.testing import connect
+
+
+def percentile(values, percent):
+    '''
+    Returns the *percent* percentile of *values* by the nearest rank method,
+    ``None`` if *values* is empty.
+    '''
+    if not values:
+        return None
+    values = sorted(values)
+    # The smallest value that is greater than or equal to *percent* percent
+    # of the values. Multiplying first keeps ``percent / 100.0`` from
+    # rounding up, e.g. to 7.000000000000001 for 7 of 100.
+    rank = int(math.ceil(percent * len(values) / 100.0))
+    return values[max(0, min(rank, len(values)) - 1)]
+
+
+def _rate(count, seconds):
+    if not seconds:
+        return None
+    return count / seconds
+
+
+def _latencies(values):
+    return dict(('p%d' % percent, percentile(values, percent))
+        for percent in (50, 90, 99))
+
+
+class LoadTest(object):
+    '''
+    Runs ``clients`` simulated clients against the ``ws://`` *url*. Each
+    client sends ``messages`` text messages of ``size`` bytes and expects
+    every message to be echoed.
+    '''
+
+    def __init__(self, url, clients=10, messages=100, size=16, version=13,
+        timeout=10):
+        if clients < 1:
+            raise ValueError('At least one client is needed.')
+        self.url = url
+        self.clients = clients
+        self.messages = messages
+        self.size = size
+        self.version = version
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._start = threading.Event()
+        self._ready = 0
+        self._all_ready = threading.Event()
+        self.connect_times = []
+        self.round_trip_times = []
+        self.errors = []
+
+    def _client(self):
+        websocket = None
+        try:
+            begin = time.time()
+            websocket = connect(self.url, self.version, self.timeout)
+            self.connect_times.append(time.time() - begin)
+        except Exception as e:
+            self.errors.append('connect: %s' % e)
+        with self._lock:
+            self._ready += 1
+            if self._ready == self.clients:
+                self._all_ready.set()
+        if websocket is None:
+            return
+        self._start.wait()
+        message = u'x' * self.size
+        round_trip_times = []
+        try:
+            for i in range(self.messages):
+                begin = time.time()
+                websocket.send(message)
+                if websocket.receive(self.timeout) is None:
+                    raise IOError('Closed by the server.')
+                round_trip_times.append(time.time() - begin)
+        except Exception as e:
+            self.errors.append('message: %s' % e)
+        finally:
+            self.round_trip_times.extend(round_trip_times)
+            websocket.close(timeout=self.timeout)
+
+    def run(self):
+        '''
+        Runs the load test and returns a dict with the results. Latencies
+        are in seconds.
+        '''
+        threads = [threading.Thread(target=self._client)
+            for i in range(self.clients)]
+        start = time.time()
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        self._all_ready.wait()
+        connected = time.time()
+        self._start.set()
+        for thread in threads:
+            thread.join()
+        finished = time.time()
+
+        connect_seconds = connected - start
+        message_seconds = finished - connected
+        messages = len(self.round_trip_times)
+        return {
+            'url': self.url,
+            'clients': self.clients,
+            'connections': len(self.connect_times),
+            'connect_seconds': connect_seconds,
+            'connections_per_second':
+                _rate(len(self.connect_times), connect_seconds),
+            'connect_time': _latencies(self.connect_times),
+            'messages': messages,
+            'message_seconds': message_seconds,
+            'messages_per_second': _rate(messages, message_seconds),
+            'round_trip_time': _latencies(self.round_trip_times),
+            'errors': len(self.errors),
+            'first_errors': self.errors[:10],
+        }
@@ -0,0 +1,61 @@
+import json
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django_websocket.loadtest import LoadTest
+
+
+def _ms(value):
+    if value is None:
+        return '-'
+    return '%.2f ms' % (value * 1000)
+
+
+class Command(BaseCommand):
+    help = ('Opens simulated clients to a websocket view that echoes '
+        'messages and reports the connection rate, message throughput and '
+        'round trip times.')
+    args = '<ws://host:port/path>'
+    option_list = BaseCommand.option_list + (
+        make_option('--clients', type='int', dest='clients', default=10,
+            help='Number of simulated clients. Default: 10.'),
+        make_option('--messages', type='int', dest='messages', default=100,
+            help='Messages sent by every client. Default: 100.'),
+        make_option('--size', type='int', dest='size', default=16,
+            help='Size of a message in bytes. Default: 16.'),
+        make_option('--protocol-version', dest='protocol_version',
+            default='13', help='WebSocket protocol version: 75, 76, 8 or 13. '
+            'Default: 13.'),
+        make_option('--timeout', type='float', dest='timeout', default=10,
+            help='Seconds to wait for the server. Default: 10.'),
+        make_option('--json', dest='json', metavar='FILE',
+            help='Write the results as JSON to FILE.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Pass the ws:// URL of an echo view.')
+        if options['clients'] < 1:
+            raise CommandError('At least one client is needed.')
+        results = LoadTest(args[0], clients=options['clients'],
+            messages=options['messages'], size=options['size'],
+            version=options['protocol_version'],
+            timeout=options['timeout']).run()
+        self.stdout.write(
+            'Connections: %(connections)d of %(clients)d in '
+            '%(connect_seconds).2f s\n' % results)
+        self.stdout.write('Connections/s: %.1f\n' % (
+            results['connections_per_second'] or 0))
+        self.stdout.write('Connect time: p50 %s, p90 %s, p99 %s\n' % tuple(
+            _ms(results['connect_time'][p]) for p in ('p50', 'p90', 'p99')))
+        self.stdout.write(
+            'Messages: %(messages)d in %(message_seconds).2f s\n' % results)
+        self.stdout.write('Messages/s: %.1f\n' % (
+            results['messages_per_second'] or 0))
+        self.stdout.write('Round trip time: p50 %s, p90 %s, p99 %s\n' % tuple(
+            _ms(results['round_trip_time'][p]) for p in ('p50', 'p90', 'p99')))
+        self.stdout.write('Errors: %d\n' % results['errors'])
+        for error in results['first_errors']:
+            self.stdout.write('  %s\n' % error)
+        if options.get('json'):
+            with open(options['json'], 'w') as output:
+                json.dump(results, output, indent=2, sort_keys=True)
@@ -0,0 +1,260 @@
+'''
+Optional instrumentation of websockets.
+
+Instrumented websockets count the bytes and frames they receive and send,
+time their handshake and record how long each write takes. The counters
+live in a :class:`ConnectionMetrics` object per websocket and are updated
+without any locking: receiving happens in the thread that serves the
+websocket and writes are serialized by the write lock of the websocket
+anyway.
+
+A :class:`MetricsRegistry` keeps track of the instrumented websockets, also
+of those that are garbage collected without being unregistered, and adds
+their counters up only when :meth:`MetricsRegistry.snapshot` is
+called, e.g. by a view that exposes them to a monitoring system::
+
+    from django_websocket.metrics import registry
+
+    def websocket_metrics(request):
+        return HttpResponse(json.dumps(registry.snapshot()),
+            content_type='application/json')
+
+The ``WEBSOCKET_METRICS`` setting registers every websocket with the
+process-wide :data:`registry`; ``WebSocket.enable_metrics()`` does it for a
+single one.
+'''
+import collections
+import threading
+import time
+import weakref
+from bisect import bisect_left
+
+
+# Upper bounds in seconds of the buckets of latency histograms.
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Upper bounds in seconds of the buckets of the connection lifetime.
+LIFETIME_BUCKETS = (1.0, 10.0, 60.0, 300.0, 900.0, 3600.0, 4 * 3600.0,
+    24 * 3600.0)
+
+
+class Histogram(object):
+    '''
+    Counts observed values in buckets with the upper bounds ``bounds``,
+    plus one bucket for larger values.
+    '''
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def merge(self, other):
+        '''
+        Adds the counts of the histogram *other*, which must have the same
+        buckets.
+        '''
+        counts = self.counts
+        for i, count in enumerate(other.counts):
+            counts[i] += count
+        self.sum += other.sum
+
+    def quantile(self, q):
+        '''
+        Returns the upper bound of the bucket that contains the *q* quantile,
+        ``None`` if nothing was observed or it's in the last bucket.
+        '''
+        total = self.count
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+    def as_dict(self):
+        return {
+            'buckets': list(zip(self.bounds + (None,), self.counts)),
+            'count': self.count,
+            'sum': self.sum,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+        }
+
+
+class ConnectionMetrics(object):
+    '''
+    The counters of a single websocket, available as ``websocket.metrics``.
+    Fragmented messages count as one received frame.
+    '''
+    __slots__ = ('registry', 'opened', 'handshake_time', 'bytes_in',
+        'bytes_out', 'frames_in', 'frames_out', 'send_latency')
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.opened = time.time()
+        self.handshake_time = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.frames_in = 0
+        self.frames_out = 0
+        self.send_latency = Histogram()
+
+    def sent(self, nbytes, frames, seconds):
+        self.bytes_out += nbytes
+        self.frames_out += frames
+        self.send_latency.observe(seconds)
+
+    def as_dict(self, websocket, now):
+        return {
+            'lifetime': now - self.opened,
+            'handshake_time': self.handshake_time,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'frames_in': self.frames_in,
+            'frames_out': self.frames_out,
+            'queued_messages': len(websocket._message_queue),
+            'buffered_bytes_in': len(websocket._parser),
+            'buffered_bytes_out': websocket.buffered_amount,
+            'send_latency': self.send_latency.as_dict(),
+        }
+
+
+_COUNTERS = ('bytes_in', 'bytes_out', 'frames_in', 'frames_out')
+
+
+class MetricsRegistry(object):
+    '''
+    Aggregates the metrics of websockets. The registry owns the
+    :class:`ConnectionMetrics` of every registered websocket and only holds
+    weak references to the websockets themselves. Connections are retired,
+    i.e. their counters are added to the totals, by :meth:`unregister`, by
+    the next :meth:`snapshot` once they are closed, or once the websocket
+    was garbage collected without being unregistered.
+    '''
+
+    def __init__(self):
+        # Maps weak references to the websockets to their metrics.
+        self._connections = {}
+        # Weak references to websockets that were garbage collected. The
+        # callbacks of the references only append to it, as they may run in
+        # any thread, also while it holds the lock.
+        self._collected = collections.deque()
+        self._lock = threading.Lock()
+        self.connections_total = 0
+        self._retired = dict((name, 0) for name in _COUNTERS)
+        self._send_latency = Histogram()
+        self._handshake_time = Histogram()
+        self._lifetime = Histogram(LIFETIME_BUCKETS)
+
+    def __len__(self):
+        with self._lock:
+            self._retire_collected(time.time())
+            return len(self._connections)
+
+    def __contains__(self, websocket):
+        return weakref.ref(websocket) in self._connections
+
+    def register(self, websocket):
+        '''
+        Instruments *websocket*. Its counters are available as
+        ``websocket.metrics`` afterwards.
+        '''
+        metrics = websocket.metrics = ConnectionMetrics(self)
+        ref = weakref.ref(websocket, self._collected.append)
+        with self._lock:
+            self._connections[ref] = metrics
+            self.connections_total += 1
+
+    def unregister(self, websocket):
+        '''
+        Adds the counters of *websocket* to the totals and stops tracking
+        it. Called once the connection is over.
+        '''
+        with self._lock:
+            self._retire(weakref.ref(websocket), time.time())
+
+    def _retire(self, ref, now):
+        metrics = self._connections.pop(ref, None)
+        if metrics is None:
+            return
+        for name in _COUNTERS:
+            self._retired[name] += getattr(metrics, name)
+        self._send_latency.merge(metrics.send_latency)
+        if metrics.handshake_time is not None:
+            self._handshake_time.observe(metrics.handshake_time)
+        self._lifetime.observe(now - metrics.opened)
+
+    def _retire_collected(self, now):
+        collected = self._collected
+        while collected:
+            self._retire(collected.popleft(), now)
+
+    def snapshot(self, connections=False):
+        '''
+        Returns a dict with the current number of connections, the totals of
+        the counters of all websockets since the start of the process, the
+        currently queued data and histograms of the send latency, handshake
+        time and lifetime of finished connections. Pass
+        ``connections=True`` to include a list with the metrics of every
+        open connection.
+        '''
+        now = time.time()
+        with self._lock:
+            self._retire_collected(now)
+            websockets = []
+            for ref in list(self._connections):
+                websocket = ref()
+                if websocket is None or websocket.closed:
+                    self._retire(ref, now)
+                else:
+                    websockets.append((websocket, self._connections[ref]))
+            totals = dict(self._retired)
+            send_latency = Histogram()
+            send_latency.merge(self._send_latency)
+            handshake_time = Histogram()
+            handshake_time.merge(self._handshake_time)
+            lifetime = self._lifetime.as_dict()
+            connections_total = self.connections_total
+        snapshot = {
+            'connections': len(websockets),
+            'connections_total': connections_total,
+            'queued_messages': 0,
+            'buffered_bytes_in': 0,
+            'buffered_bytes_out': 0,
+            'lifetime': lifetime,
+        }
+        details = []
+        for websocket, metrics in websockets:
+            for name in _COUNTERS:
+                totals[name] += getattr(metrics, name)
+            send_latency.merge(metrics.send_latency)
+            if metrics.handshake_time is not None:
+                handshake_time.observe(metrics.handshake_time)
+            snapshot['queued_messages'] += len(websocket._message_queue)
+            snapshot['buffered_bytes_in'] += len(websocket._parser)
+            snapshot['buffered_bytes_out'] += websocket.buffered_amount
+            if connections:
+                details.append(metrics.as_dict(websocket, now))
+        snapshot.update(totals)
+        snapshot['send_latency'] = send_latency.as_dict()
+        snapshot['handshake_time'] = handshake_time.as_dict()
+        if connections:
+            snapshot['connection_metrics'] = details
+        return snapshot
+
+
+registry = MetricsRegistry()
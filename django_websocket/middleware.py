@@ -1,38 +1,195 @@
 from django.conf import settings
 from django.http import HttpResponseBadRequest
-from django_websocket.websocket import setup_websocket, MalformedWebSocket
+from django_websocket.keepalive import KeepAlive
+from django_websocket.metrics import registry as METRICS
+from django_websocket.ratelimit import RateLimiter
+from django_websocket.websocket import WebSocket, setup_websocket, \
+    MalformedWebSocket
 
 
 WEBSOCKET_ACCEPT_ALL = getattr(settings, 'WEBSOCKET_ACCEPT_ALL', False)
 
+# Set to ``True`` to negotiate permessage-deflate with the default options or
+# to a dict with keyword arguments for ``PerMessageDeflate.negotiate``, e.g.
+# ``{'window_bits': 12, 'context_takeover': False, 'min_size': 256}``.
+WEBSOCKET_DEFLATE = getattr(settings, 'WEBSOCKET_DEFLATE', False)
+if WEBSOCKET_DEFLATE is True:
+    DEFLATE_OPTIONS = {}
+elif WEBSOCKET_DEFLATE:
+    DEFLATE_OPTIONS = dict(WEBSOCKET_DEFLATE)
+else:
+    DEFLATE_OPTIONS = None
+
+# A dict with keyword arguments for ``WebSocket.enable_write_buffer`` to
+# buffer outgoing frames of every websocket, e.g.
+# ``{'high_watermark': 256 * 1024, 'policy': 'drop'}``.
+WEBSOCKET_WRITE_BUFFER = getattr(settings, 'WEBSOCKET_WRITE_BUFFER', None)
+
+# Set to ``True`` to coalesce outgoing frames of every websocket with the
+# default options, or to a dict with keyword arguments for
+# ``WebSocket.enable_coalescing``, e.g. ``{'delay': 0.01, 'cork': True}``.
+WEBSOCKET_COALESCE = getattr(settings, 'WEBSOCKET_COALESCE', False)
+if WEBSOCKET_COALESCE is True:
+    COALESCE_OPTIONS = {}
+elif WEBSOCKET_COALESCE:
+    COALESCE_OPTIONS = dict(WEBSOCKET_COALESCE)
+else:
+    COALESCE_OPTIONS = None
+
+# Limits for incoming data per websocket. ``None`` disables a limit. The
+# buffer has to hold a complete frame, so it must not be smaller than the
+# maximum message size.
+WEBSOCKET_MAX_MESSAGE_SIZE = getattr(settings, 'WEBSOCKET_MAX_MESSAGE_SIZE',
+    1024 * 1024)
+if WEBSOCKET_MAX_MESSAGE_SIZE is None:
+    _default_buffer_size = None
+else:
+    _default_buffer_size = 2 * WEBSOCKET_MAX_MESSAGE_SIZE
+WEBSOCKET_MAX_BUFFER_SIZE = getattr(settings, 'WEBSOCKET_MAX_BUFFER_SIZE',
+    _default_buffer_size)
+WEBSOCKET_MAX_QUEUED_MESSAGES = getattr(settings,
+    'WEBSOCKET_MAX_QUEUED_MESSAGES', 1000)
+
+# A dict with keyword arguments for ``WebSocket.enable_rate_limit`` to limit
+# the incoming messages of every websocket, e.g.
+# ``{'messages_per_second': 20, 'burst_messages': 50, 'policy': 'close'}``.
+WEBSOCKET_RATE_LIMIT = getattr(settings, 'WEBSOCKET_RATE_LIMIT', None)
+
+# A dict with keyword arguments for a ``RateLimiter`` shared by all
+# websockets of the process, e.g.
+# ``{'messages_per_second': 5000, 'policy': 'delay'}``.
+WEBSOCKET_GLOBAL_RATE_LIMIT = getattr(settings, 'WEBSOCKET_GLOBAL_RATE_LIMIT',
+    None)
+if WEBSOCKET_GLOBAL_RATE_LIMIT is not None:
+    GLOBAL_RATE_LIMITER = RateLimiter(**WEBSOCKET_GLOBAL_RATE_LIMIT)
+else:
+    GLOBAL_RATE_LIMITER = None
+
+# Set to ``True`` to ping idle clients and close dead connections with the
+# default intervals, or to a dict with keyword arguments for ``KeepAlive``,
+# e.g. ``{'ping_interval': 30, 'timeout': 90}``.
+WEBSOCKET_KEEPALIVE = getattr(settings, 'WEBSOCKET_KEEPALIVE', False)
+if WEBSOCKET_KEEPALIVE is True:
+    KEEPALIVE = KeepAlive()
+elif WEBSOCKET_KEEPALIVE:
+    KEEPALIVE = KeepAlive(**WEBSOCKET_KEEPALIVE)
+else:
+    KEEPALIVE = None
+
+# Set to ``True`` to count the traffic of every websocket in
+# ``django_websocket.metrics.registry``.
+WEBSOCKET_METRICS = getattr(settings, 'WEBSOCKET_METRICS', False)
+
+
+def _is_websocket():
+    return True
+
+
+def _is_not_websocket():
+    return False
+
+
+# ``(accept_websocket, require_websocket)`` flags of the views seen so far.
+_view_flags = {}
+_VIEW_FLAGS_LIMIT = 10000
+
+
+def view_flags(view_func):
+    '''
+    Returns the ``accept_websocket`` and ``require_websocket`` flags of
+    *view_func*, which are looked up only once per view.
+    '''
+    try:
+        return _view_flags[view_func]
+    except KeyError:
+        pass
+    except TypeError:
+        # Unhashable view.
+        return (getattr(view_func, 'accept_websocket', False),
+            getattr(view_func, 'require_websocket', False))
+    flags = (getattr(view_func, 'accept_websocket', False),
+        getattr(view_func, 'require_websocket', False))
+    if len(_view_flags) >= _VIEW_FLAGS_LIMIT:
+        # Views that are created per request mustn't fill up the memory.
+        _view_flags.clear()
+    _view_flags[view_func] = flags
+    return flags
+
 
 class WebSocketMiddleware(object):
+    def __init__(self, get_response=None):
+        # Newer Django versions pass the next handler in the chain.
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.process_request(request)
+        if response is None:
+            response = self.get_response(request)
+        return self.process_response(request, response)
+
     def process_request(self, request):
+        # Most requests are plain HTTP requests, which are recognized by a
+        # single lookup.
+        if 'HTTP_UPGRADE' not in request.META:
+            request.websocket = None
+            request.is_websocket = _is_not_websocket
+            return
+        if getattr(request, 'websocket', None) is not None:
+            # Set up already, e.g. by the ASGI handler.
+            request.is_websocket = _is_websocket
+            return
         try:
-            request.websocket = setup_websocket(request)
-        except MalformedWebSocket, e:
+            request.websocket = setup_websocket(request,
+                deflate=DEFLATE_OPTIONS,
+                max_message_size=WEBSOCKET_MAX_MESSAGE_SIZE,
+                max_buffer_size=WEBSOCKET_MAX_BUFFER_SIZE,
+                max_queued_messages=WEBSOCKET_MAX_QUEUED_MESSAGES)
+        except MalformedWebSocket:
             request.websocket = None
-            request.is_websocket = lambda: False
+            request.is_websocket = _is_not_websocket
             return HttpResponseBadRequest()
         if request.websocket is None:
-            request.is_websocket = lambda: False
+            request.is_websocket = _is_not_websocket
         else:
-            request.is_websocket = lambda: True
+            request.is_websocket = _is_websocket
+            if WEBSOCKET_METRICS:
+                request.websocket.enable_metrics(METRICS)
 
     def process_view(self, request, view_func, view_args, view_kwargs):
-        # open websocket if its an accepted request
-        if request.is_websocket():
-            # deny websocket request if view can't handle websocket
-            if not WEBSOCKET_ACCEPT_ALL and \
-                not getattr(view_func, 'accept_websocket', False):
+        accept, require = view_flags(view_func)
+        websocket = getattr(request, 'websocket', None)
+        if websocket is None:
+            if require:
+                # websocket was required but not provided
                 return HttpResponseBadRequest()
-            # everything is fine .. so prepare connection by sending handshake
-            request.websocket.send_handshake()
-        elif getattr(view_func, 'require_websocket', False):
-            # websocket was required but not provided
+            return
+        # deny websocket request if view can't handle websocket
+        if not accept and not WEBSOCKET_ACCEPT_ALL:
             return HttpResponseBadRequest()
+        # everything is fine .. so prepare connection by sending handshake
+        websocket.send_handshake()
+        # Websockets of an ASGI server are buffered and kept alive by the
+        # server.
+        if isinstance(websocket, WebSocket):
+            if WEBSOCKET_WRITE_BUFFER is not None:
+                websocket.enable_write_buffer(**WEBSOCKET_WRITE_BUFFER)
+            if COALESCE_OPTIONS is not None:
+                websocket.enable_coalescing(**COALESCE_OPTIONS)
+            if WEBSOCKET_RATE_LIMIT is not None:
+                websocket.enable_rate_limit(parent=GLOBAL_RATE_LIMITER,
+                    **WEBSOCKET_RATE_LIMIT)
+            elif GLOBAL_RATE_LIMITER is not None:
+                websocket.enable_rate_limit(parent=GLOBAL_RATE_LIMITER)
+            if KEEPALIVE is not None:
+                KEEPALIVE.register(websocket)
 
     def process_response(self, request, response):
-        if request.is_websocket() and request.websocket._handshake_sent:
-            request.websocket._send_closing_frame(True)
+        websocket = getattr(request, 'websocket', None)
+        if websocket is not None and websocket._handshake_sent and \
+            not getattr(websocket, 'handed_off', False):
+            if KEEPALIVE is not None:
+                KEEPALIVE.unregister(websocket)
+            websocket._send_closing_frame(True)
+            if websocket.metrics is not None:
+                websocket.metrics.registry.unregister(websocket)
         return response
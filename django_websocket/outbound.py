@@ -0,0 +1,385 @@
+'''
+An optional write buffer for :class:`~django_websocket.websocket.WebSocket`.
+
+Without a buffer, ``WebSocket.send`` blocks in ``sendall`` until the client
+has received enough data, so a single slow client stalls the view that
+serves it. With a :class:`WriteBuffer` frames are queued and written without
+blocking. Once more than ``high_watermark`` bytes are queued, the configured
+policy decides what happens:
+
+- ``POLICY_BLOCK``: wait until the queue drains below ``low_watermark``.
+- ``POLICY_DROP``: drop the oldest queued frames until the queue is below
+  ``low_watermark``. Don't combine this with permessage-deflate context
+  takeover or fragmented messages; the client can't decode a stream with
+  missing frames.
+- ``POLICY_CLOSE``: mark the websocket as closed and raise
+  :class:`SlowConsumer`.
+
+A write buffer can also coalesce frames, see ``WebSocket.enable_coalescing``.
+Frames are then only sent once ``coalesce_bytes`` are queued, or by the
+:class:`Flusher` thread when the oldest queued frame waited long enough.
+Views that send many small messages in a row produce far fewer system calls
+and TCP segments that way.
+'''
+import collections
+import heapq
+import itertools
+import logging
+import select
+import socket as socket_module
+import threading
+import time
+from errno import EAGAIN, EWOULDBLOCK, EINTR
+from socket import error as SocketError
+
+
+POLICY_BLOCK = 'block'
+POLICY_DROP = 'drop'
+POLICY_CLOSE = 'close'
+POLICIES = (POLICY_BLOCK, POLICY_DROP, POLICY_CLOSE)
+
+DEFAULT_HIGH_WATERMARK = 1024 * 1024
+
+# Small frames are joined to chunks of up to this size before sending.
+SEND_CHUNK_SIZE = 64 * 1024
+
+_MSG_DONTWAIT = getattr(socket_module, 'MSG_DONTWAIT', 0)
+# Sockets that select as writable have at least this much free space in their
+# send buffer. Used on systems without MSG_DONTWAIT.
+_SNDLOWAT = 2048
+
+# Linux only; TCP_NOPUSH of the BSDs has different semantics.
+_TCP_CORK = getattr(socket_module, 'TCP_CORK', None)
+
+logger = logging.getLogger('django_websocket')
+
+
+class SlowConsumer(SocketError):
+    '''
+    Raised if the write buffer of a websocket with ``POLICY_CLOSE``
+    overflows.
+    '''
+
+
+def _wait_writable(sock, timeout):
+    try:
+        r, w, e = select.select([], [sock], [], timeout)
+    except select.error as err:
+        if err.args[0] == EINTR:
+            return False
+        raise
+    return bool(w)
+
+
+def _send_nowait(sock, data):
+    '''
+    Sends as much of *data* as possible without blocking and returns the
+    number of bytes sent.
+    '''
+    try:
+        timeout = sock.gettimeout()
+        if timeout is None:
+            if _MSG_DONTWAIT:
+                return sock.send(data, _MSG_DONTWAIT)
+            if not _wait_writable(sock, 0):
+                return 0
+            return sock.send(data[:_SNDLOWAT])
+        # Sockets with a timeout are non-blocking underneath, but Python
+        # waits up to the timeout for them to become writable before it
+        # sends, even with MSG_DONTWAIT.
+        if timeout and not _wait_writable(sock, 0):
+            return 0
+        return sock.send(data)
+    except socket_module.timeout:
+        return 0
+    except SocketError as e:
+        if e.args[0] in (EAGAIN, EWOULDBLOCK, EINTR):
+            return 0
+        raise
+
+
+class WriteBuffer(object):
+    '''
+    Queues frames for a socket and writes them without blocking.
+
+    ``buffered_amount`` is the number of queued bytes, ``dropped_frames``
+    counts the frames dropped by ``POLICY_DROP``.
+
+    If ``coalesce_bytes`` is set, writes only send the queued data once at
+    least that many bytes are queued; :meth:`flush` sends it regardless.
+    With ``cork`` the socket is corked while data is sent, so that it leaves
+    in full TCP segments even if it takes several ``send`` calls.
+    '''
+    coalesce_bytes = None
+    cork = False
+
+    def __init__(self, socket, high_watermark=DEFAULT_HIGH_WATERMARK,
+        low_watermark=None, policy=POLICY_BLOCK, close_timeout=5.0):
+        '''
+        Arguments:
+
+        - ``socket``: The socket to write to.
+        - ``high_watermark``: Number of queued bytes at which the policy
+          kicks in.
+        - ``low_watermark``: Number of queued bytes the policy reduces the
+          queue to. Defaults to half of ``high_watermark``.
+        - ``policy``: One of ``POLICY_BLOCK``, ``POLICY_DROP`` and
+          ``POLICY_CLOSE``.
+        - ``close_timeout``: Seconds to wait for the queue to drain when the
+          websocket gets closed.
+        '''
+        if policy not in POLICIES:
+            raise ValueError("Unknown write buffer policy: %r" % policy)
+        if low_watermark is None:
+            low_watermark = high_watermark // 2
+        if low_watermark > high_watermark:
+            raise ValueError("low_watermark must not exceed high_watermark.")
+        self.socket = socket
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.policy = policy
+        self.close_timeout = close_timeout
+        self.buffered_amount = 0
+        self.dropped_frames = 0
+        self._queue = collections.deque()
+        # Number of bytes of the first queued frame that were already sent.
+        self._offset = 0
+
+    def __len__(self):
+        return self.buffered_amount
+
+    def write(self, data):
+        '''
+        Queue *data* and send as much as possible without blocking. Applies
+        the policy if the queue exceeds the high watermark afterwards.
+        '''
+        self.extend((data,))
+
+    def extend(self, buffers):
+        '''
+        Like :meth:`write`, for a sequence of buffers.
+        '''
+        self._extend(buffers, self.policy)
+
+    def extend_nowait(self, buffers):
+        '''
+        Like :meth:`extend`, but never blocks: an overflow with
+        ``POLICY_BLOCK`` raises :class:`SlowConsumer` like ``POLICY_CLOSE``.
+        '''
+        if self.policy == POLICY_BLOCK:
+            self._extend(buffers, POLICY_CLOSE)
+        else:
+            self._extend(buffers, self.policy)
+
+    def _extend(self, buffers, policy):
+        if not self._queue and self.coalesce_bytes is None and \
+            len(buffers) == 1:
+            # Nothing is queued, so a single frame can go out right away;
+            # only what the socket doesn't take is queued.
+            data = buffers[0]
+            sent = _send_nowait(self.socket, data)
+            if sent == len(data):
+                return
+            self._queue.append(data)
+            self._offset = sent
+            self.buffered_amount += len(data) - sent
+            buffers = ()
+        for data in buffers:
+            if len(data):
+                self._queue.append(data)
+                self.buffered_amount += len(data)
+        if self.coalesce_bytes is None or \
+            self.buffered_amount >= self.coalesce_bytes:
+            self.flush()
+        if self.buffered_amount > self.high_watermark:
+            if policy == POLICY_BLOCK:
+                self._flush(self.low_watermark, None)
+            elif policy == POLICY_DROP:
+                self._drop(self.low_watermark)
+            else:
+                self.clear()
+                raise SlowConsumer(
+                    "More than %d bytes queued for the client." %
+                    self.high_watermark)
+
+    def flush(self, timeout=0):
+        '''
+        Sends queued data. Waits up to *timeout* seconds for the queue to
+        drain; ``0`` never blocks and ``None`` waits as long as it takes.
+        Returns ``True`` if the queue is empty.
+        '''
+        return self._flush(0, timeout)
+
+    def clear(self):
+        '''
+        Discards all queued data.
+        '''
+        self._queue.clear()
+        self._offset = 0
+        self.buffered_amount = 0
+
+    def _flush(self, limit, timeout):
+        if self.cork and self.buffered_amount > limit:
+            set_cork(self.socket, True)
+            try:
+                return self._send_queue(limit, timeout)
+            finally:
+                set_cork(self.socket, False)
+        return self._send_queue(limit, timeout)
+
+    def _send_queue(self, limit, timeout):
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            while self.buffered_amount > limit:
+                sent = _send_nowait(self.socket, self._next_chunk())
+                if not sent:
+                    break
+                self._consume(sent)
+            if self.buffered_amount <= limit:
+                return True
+            if timeout is None:
+                remaining = None
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+            _wait_writable(self.socket, remaining)
+
+    def _next_chunk(self):
+        queue = self._queue
+        first = queue[0]
+        if len(first) - self._offset >= SEND_CHUNK_SIZE or len(queue) == 1:
+            if self._offset:
+                return memoryview(first)[self._offset:]
+            return first
+        chunks = [first[self._offset:]]
+        size = len(chunks[0])
+        for data in itertools.islice(queue, 1, None):
+            if size + len(data) > SEND_CHUNK_SIZE:
+                break
+            chunks.append(data)
+            size += len(data)
+        return b''.join(chunks)
+
+    def _consume(self, sent):
+        self.buffered_amount -= sent
+        sent += self._offset
+        self._offset = 0
+        queue = self._queue
+        while sent:
+            length = len(queue[0])
+            if sent < length:
+                self._offset = sent
+                return
+            sent -= length
+            queue.popleft()
+
+    def _drop(self, limit):
+        queue = self._queue
+        # A partially sent frame can't be dropped.
+        keep = 1 if self._offset else 0
+        while self.buffered_amount > limit and len(queue) > keep:
+            if keep:
+                data = queue[1]
+                del queue[1]
+            else:
+                data = queue.popleft()
+            self.buffered_amount -= len(data)
+            self.dropped_frames += 1
+
+
+def set_cork(sock, corked):
+    '''
+    Sets the ``TCP_CORK`` option of *sock*. Returns ``False`` if the system
+    or the socket doesn't support it.
+    '''
+    if _TCP_CORK is None:
+        return False
+    try:
+        sock.setsockopt(socket_module.IPPROTO_TCP, _TCP_CORK, int(corked))
+    except SocketError:
+        return False
+    return True
+
+
+class Flusher(object):
+    '''
+    Sends the coalesced frames of websockets once they waited long enough.
+    Websockets are scheduled with :meth:`schedule` when the first frame is
+    queued; a daemon thread calls their ``_flush_coalesced`` method at the
+    deadline and sleeps while nothing is scheduled.
+    '''
+
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._heap)
+
+    def schedule(self, delay, websocket):
+        '''
+        Calls ``websocket._flush_coalesced()`` in *delay* seconds.
+        '''
+        deadline = time.time() + delay
+        with self._condition:
+            heapq.heappush(self._heap,
+                (deadline, next(self._counter), websocket))
+            if self._heap[0][2] is websocket:
+                self._condition.notify()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                    name='django_websocket.Flusher')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def run_pending(self, now=None):
+        '''
+        Flushes the websockets that are due at the time *now*, which
+        defaults to the current time, and returns their number.
+        '''
+        if now is None:
+            now = time.time()
+        due = []
+        with self._condition:
+            while self._heap and self._heap[0][0] <= now:
+                due.append(heapq.heappop(self._heap)[2])
+        for websocket in due:
+            try:
+                websocket._flush_coalesced()
+            except Exception:
+                logger.exception('Flushing %r failed.', websocket)
+        return len(due)
+
+    def stop(self):
+        '''
+        Stops the thread. Scheduled websockets are kept and flushed once
+        :meth:`schedule` started a new thread.
+        '''
+        with self._condition:
+            thread = self._thread
+            self._thread = None
+            self._condition.notify()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def _run(self):
+        current = threading.current_thread()
+        while True:
+            with self._condition:
+                if self._thread is not current:
+                    return
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                remaining = self._heap[0][0] - time.time()
+                if remaining > 0:
+                    self._condition.wait(remaining)
+                    continue
+            self.run_pending()
+
+
+flusher = Flusher()
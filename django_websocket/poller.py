@@ -0,0 +1,237 @@
+'''
+Serve many :class:`~django_websocket.websocket.WebSocket` objects from a
+single thread.
+
+:class:`WebSocketPoller` waits for incoming data on all registered websockets
+with one ``selectors.DefaultSelector`` (epoll or kqueue where available), so
+the cost of a poll doesn't grow with the number of idle connections and file
+descriptors above 1024 work fine::
+
+    poller = WebSocketPoller()
+    poller.register(websocket)
+    for websocket, messages in poller:
+        for message in messages:
+            websocket.send(message)
+'''
+import collections
+import select
+import time
+from errno import EINTR
+try:
+    import selectors
+except ImportError: #pragma NO COVER
+    selectors = None
+
+
+EVENT_READ = 1
+
+SelectorKey = collections.namedtuple('SelectorKey',
+    ['fileobj', 'fd', 'events', 'data'])
+
+
+class _PollSelector(object):
+    '''
+    The part of the ``selectors.DefaultSelector`` API that is needed by
+    :class:`WebSocketPoller`, for Python versions without the ``selectors``
+    module. Uses ``epoll`` if available and ``poll`` otherwise.
+    '''
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self._poll = select.epoll()
+            self._read_mask = select.EPOLLIN
+            self._timeout_scale = 1
+        else:
+            self._poll = select.poll()
+            self._read_mask = select.POLLIN
+            self._timeout_scale = 1000
+        self._keys = {}
+
+    def register(self, fileobj, events, data=None):
+        key = SelectorKey(fileobj, fileobj.fileno(), events, data)
+        self._poll.register(key.fd, self._read_mask)
+        self._keys[key.fd] = key
+        return key
+
+    def unregister(self, fileobj):
+        key = self._keys.pop(fileobj.fileno())
+        self._poll.unregister(key.fd)
+        return key
+
+    def select(self, timeout=None):
+        if timeout is None:
+            timeout = -1
+        elif timeout > 0:
+            timeout *= self._timeout_scale
+        try:
+            ready = self._poll.poll(timeout)
+        except (IOError, OSError, select.error) as e:
+            if e.args[0] == EINTR:
+                return []
+            raise
+        return [(self._keys[fd], EVENT_READ) for fd, event in ready
+            if fd in self._keys]
+
+    def close(self):
+        if hasattr(self._poll, 'close'):
+            self._poll.close()
+        self._keys.clear()
+
+
+def _default_selector():
+    if selectors is not None:
+        return selectors.DefaultSelector()
+    return _PollSelector()
+
+
+class WebSocketPoller(object):
+    '''
+    Multiplexes many websockets in one thread.
+
+    :meth:`poll` reads from every websocket that has data available, parses
+    it into the websocket's message queue and returns the queued messages.
+    Websockets that are closed by the client are reported one last time and
+    unregistered automatically.
+    '''
+
+    def __init__(self, selector=None):
+        '''
+        Arguments:
+
+        - ``selector``: A ``selectors.BaseSelector`` instance. Defaults to a
+          new ``selectors.DefaultSelector``.
+        '''
+        if selector is None:
+            selector = _default_selector()
+        self.selector = selector
+        self._websockets = set()
+        # Websockets with messages that were queued before a poll.
+        self._pending = set()
+        # Websockets whose rate limiter delays reads, with the time they may
+        # read again. They aren't watched by the selector meanwhile.
+        self._delayed = {}
+
+    def __len__(self):
+        return len(self._websockets)
+
+    def __contains__(self, websocket):
+        return websocket in self._websockets
+
+    def register(self, websocket):
+        '''
+        Watch *websocket* for incoming messages.
+        '''
+        self.selector.register(websocket.socket, EVENT_READ, websocket)
+        self._websockets.add(websocket)
+        if websocket._message_queue or websocket.closed:
+            self._pending.add(websocket)
+
+    def unregister(self, websocket):
+        '''
+        Stop watching *websocket*.
+        '''
+        if websocket in self._delayed:
+            del self._delayed[websocket]
+        else:
+            self.selector.unregister(websocket.socket)
+        self._websockets.discard(websocket)
+        self._pending.discard(websocket)
+
+    def poll(self, timeout=None):
+        '''
+        Waits up to *timeout* seconds (forever if ``None``) for data and
+        returns a list of ``(websocket, messages)`` tuples for all
+        websockets that received new messages or got closed. Closed
+        websockets are unregistered.
+        '''
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            results = self._poll(timeout)
+            if results or not self._delayed:
+                return results
+            # Woken up early to watch delayed websockets again.
+            if deadline is not None:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    return results
+
+    def _poll(self, timeout):
+        if self._delayed:
+            timeout = self._resume_delayed(timeout)
+        ready = self._pending
+        self._pending = set()
+        if ready:
+            timeout = 0
+        for key, events in self.selector.select(timeout):
+            websocket = key.data
+            if websocket is None:
+                # Registered directly with the selector by the owner of the
+                # poller, e.g. to interrupt a poll from another thread.
+                continue
+            if websocket.closed:
+                ready.add(websocket)
+                continue
+            try:
+                if not websocket._socket_recv():
+                    websocket.closed = True
+            except (IOError, OSError, ValueError):
+                # Connection errors and malformed frames of one client must
+                # not stop the other websockets from being served.
+                websocket.closed = True
+            limiter = websocket.rate_limiter
+            if limiter is not None and not websocket.closed:
+                delay = limiter.delay()
+                if delay > 0:
+                    self.selector.unregister(websocket.socket)
+                    self._delayed[websocket] = time.time() + delay
+            ready.add(websocket)
+
+        results = []
+        for websocket in ready:
+            messages = [websocket._decode_message(message)
+                for message in websocket._message_queue]
+            websocket._message_queue.clear()
+            if websocket.closed:
+                self.unregister(websocket)
+            elif not messages:
+                continue
+            results.append((websocket, messages))
+        return results
+
+    def _resume_delayed(self, timeout):
+        '''
+        Watches the delayed websockets that may read again and returns
+        *timeout*, shortened to the time until the next one may read.
+        '''
+        now = time.time()
+        soonest = None
+        for websocket, until in list(self._delayed.items()):
+            if until <= now:
+                del self._delayed[websocket]
+                self.selector.register(websocket.socket, EVENT_READ,
+                    websocket)
+            elif soonest is None or until < soonest:
+                soonest = until
+        if soonest is not None and (timeout is None or
+                soonest - now < timeout):
+            timeout = soonest - now
+        return timeout
+
+    def __iter__(self):
+        '''
+        Yields ``(websocket, messages)`` tuples as data arrives, as long as
+        websockets are registered.
+        '''
+        while self._websockets:
+            for result in self.poll():
+                yield result
+
+    def close(self):
+        '''
+        Unregisters all websockets and closes the selector. The websockets
+        themselves are left open.
+        '''
+        for websocket in list(self._websockets):
+            self.unregister(websocket)
+        self.selector.close()
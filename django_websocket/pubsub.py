@@ -0,0 +1,532 @@
+'''
+Broadcast to the websockets of all worker processes of a node.
+
+A :class:`~django_websocket.broadcast.Broadcaster` only reaches the
+websockets of its own process. A :class:`SharedBroadcaster` publishes the
+framed message into a :class:`SharedRing`, a ring buffer in a memory mapped
+file that all processes of the node map, and a thread in every process that
+has subscribers reads the ring and writes the frames to the local members of
+the group::
+
+    from django_websocket.pubsub import SharedBroadcaster
+
+    shared = SharedBroadcaster('/dev/shm/myproject-broadcast')
+
+    @require_websocket
+    def notifications(request):
+        shared.add('news', request.websocket)
+        try:
+            for message in request.websocket:
+                pass
+        finally:
+            shared.discard(request.websocket)
+
+    # in any process of the node
+    shared.broadcast('news', u'Hello everybody!')
+
+No broker is involved. Publishers append records under an exclusive
+``flock`` of the file and never wait for readers: once the ring is full the
+oldest records are overwritten. Every record has a sequence number, so a
+reader that falls behind by more than the size of the ring skips to the
+newest record and counts the messages it lost. Readers sleep on a named pipe
+per reader, which publishers write a byte to after every record.
+
+Readers don't take the lock. The positions in the header are updated inside
+a sequence lock and a reader checks after copying records that none of them
+was overwritten in the meantime. A reader that keeps finding the header in
+the middle of an update takes the lock after all. If the header is still
+inconsistent then, a publisher died while updating it and the reader
+repairs it. Publishers and readers must run on the same machine. POSIX only.
+'''
+import errno
+import fcntl
+import itertools
+import logging
+import mmap
+import os
+import select
+import stat
+import struct
+import threading
+from django_websocket.broadcast import Broadcaster
+from django_websocket.websocket import HybiWebSocket, _encode_message
+
+
+logger = logging.getLogger('django_websocket')
+
+DEFAULT_CAPACITY = 4 * 1024 * 1024
+
+_MAGIC = b'DJWSRING'
+# magic, capacity, generation, reserved position, committed position and
+# next sequence number, number of reader registrations.
+_HEADER = struct.Struct('=8sQQQQQQ')
+_HEADER_SIZE = 64
+_GENERATION = 16
+_READERS = 48
+# Attempts to read a consistent header before taking the lock.
+_HEADER_RETRIES = 100
+# total size, sequence number and length of the group name of a record.
+_RECORD = struct.Struct('=IQH')
+
+_counter = itertools.count()
+
+
+class SharedRing(object):
+    '''
+    A ring buffer of ``(group, frame)`` records in the file *path*, which is
+    created with room for *capacity* bytes of records if it doesn't exist.
+    Put it into a memory backed file system like ``/dev/shm``.
+
+    The ring can be used by the process that created it and its children,
+    as well as by unrelated processes that open the same path.
+    '''
+
+    def __init__(self, path, capacity=DEFAULT_CAPACITY):
+        self.path = path
+        self.wakeup_dir = path + '.wakeup'
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_size < _HEADER_SIZE:
+                    os.ftruncate(fd, _HEADER_SIZE + capacity)
+                    header = _HEADER.pack(_MAGIC, capacity, 0, 0, 0, 0, 0)
+                    os.write(fd, header)
+                self._map = mmap.mmap(fd, 0)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+        magic, self.capacity = _HEADER.unpack_from(self._map, 0)[:2]
+        if magic != _MAGIC:
+            raise ValueError('%s is not a ring buffer.' % path)
+        try:
+            os.mkdir(self.wakeup_dir, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self._lock = threading.Lock()
+        # The lock file is opened per process, flock() doesn't exclude
+        # processes that share the open file after a fork.
+        self._lock_fd = None
+        self._lock_pid = None
+        self._wakeups = {}
+        self._readers_seen = None
+
+    def close(self):
+        for fd in self._wakeups.values():
+            os.close(fd)
+        self._wakeups.clear()
+        if self._lock_fd is not None and self._lock_pid == os.getpid():
+            os.close(self._lock_fd)
+        self._lock_fd = None
+        self._map.close()
+
+    def _header(self, locked=False):
+        '''
+        Returns a consistent ``(reserved, committed, sequence)`` snapshot of
+        the positions in the header. *locked* tells that the caller holds
+        the lock, so no publisher can be updating the header.
+        '''
+        unpack_from = _HEADER.unpack_from
+        for i in range(1 if locked else _HEADER_RETRIES):
+            header = unpack_from(self._map, 0)
+            generation = header[2]
+            if generation % 2 == 0 and \
+                struct.unpack_from('=Q', self._map, _GENERATION)[0] == \
+                    generation:
+                return header[3:6]
+        if locked:
+            return self._repair_header()
+        # The publisher is slow, or it died while updating the header.
+        with self._lock:
+            fd = self._flock()
+            try:
+                return self._repair_header()
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def _repair_header(self):
+        # Called with the lock held. The positions are the old or the new
+        # ones of an update that was cut short, both of which are valid.
+        header = _HEADER.unpack_from(self._map, 0)
+        generation = header[2]
+        if generation % 2:
+            logger.warning('Repairing the header of the ring buffer %s, a '
+                'publisher died while updating it.', self.path)
+            struct.pack_into('=Q', self._map, _GENERATION, generation + 1)
+        return header[3:6]
+
+    def _set_header(self, reserved, committed, sequence):
+        generation = struct.unpack_from('=Q', self._map, _GENERATION)[0]
+        struct.pack_into('=Q', self._map, _GENERATION, generation + 1)
+        struct.pack_into('=QQQ', self._map, _GENERATION + 8, reserved,
+            committed, sequence)
+        struct.pack_into('=Q', self._map, _GENERATION, generation + 2)
+
+    def _flock(self):
+        pid = os.getpid()
+        if self._lock_pid != pid:
+            if self._lock_fd is not None:
+                # Inherited from the parent process.
+                os.close(self._lock_fd)
+                for fd in self._wakeups.values():
+                    os.close(fd)
+            self._lock_fd = os.open(self.path, os.O_RDWR)
+            self._lock_pid = pid
+            self._wakeups = {}
+            self._readers_seen = None
+        fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+        return self._lock_fd
+
+    def _write(self, position, data):
+        offset = position % self.capacity
+        first = min(len(data), self.capacity - offset)
+        start = _HEADER_SIZE + offset
+        self._map[start:start + first] = data[:first]
+        if first < len(data):
+            self._map[_HEADER_SIZE:_HEADER_SIZE + len(data) - first] = \
+                data[first:]
+
+    def _read(self, position, size):
+        offset = position % self.capacity
+        first = min(size, self.capacity - offset)
+        start = _HEADER_SIZE + offset
+        data = self._map[start:start + first]
+        if first < size:
+            data += self._map[_HEADER_SIZE:_HEADER_SIZE + size - first]
+        return data
+
+    def publish(self, group, frame):
+        '''
+        Appends the already framed message *frame* for *group* and wakes up
+        the readers. Returns the sequence number of the record.
+        '''
+        group = _encode_message(group)
+        size = _RECORD.size + len(group) + len(frame)
+        if size > self.capacity // 2:
+            raise ValueError('Messages must not exceed half of the ring.')
+        with self._lock:
+            fd = self._flock()
+            try:
+                reserved, committed, sequence = self._header(locked=True)
+                # Readers that are copying the space that is overwritten
+                # now notice by the reserved position.
+                self._set_header(committed + size, committed, sequence)
+                self._write(committed, b''.join((
+                    _RECORD.pack(size, sequence, len(group)), group, frame)))
+                self._set_header(committed + size, committed + size,
+                    sequence + 1)
+                readers = struct.unpack_from('=Q', self._map, _READERS)[0]
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            self._wake(readers)
+        return sequence
+
+    def _wake(self, readers):
+        if readers != self._readers_seen:
+            self._readers_seen = readers
+            names = set(os.listdir(self.wakeup_dir))
+            for name in list(self._wakeups):
+                if name not in names:
+                    os.close(self._wakeups.pop(name))
+            for name in names - set(self._wakeups):
+                try:
+                    self._wakeups[name] = os.open(
+                        os.path.join(self.wakeup_dir, name),
+                        os.O_WRONLY | os.O_NONBLOCK)
+                except OSError as e:
+                    if e.errno not in (errno.ENXIO, errno.ENOENT):
+                        raise
+                    # The reader is gone.
+                    self._unlink_wakeup(name)
+        for name, fd in list(self._wakeups.items()):
+            try:
+                os.write(fd, b'\x00')
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    # The reader has a wakeup pending already.
+                    continue
+                if e.errno != errno.EPIPE:
+                    raise
+                os.close(self._wakeups.pop(name))
+                self._unlink_wakeup(name)
+
+    def _unlink_wakeup(self, name):
+        try:
+            os.unlink(os.path.join(self.wakeup_dir, name))
+        except OSError:
+            pass
+
+    def _register(self, name):
+        path = os.path.join(self.wakeup_dir, name)
+        try:
+            os.mkfifo(path, 0o600)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            # Left behind by a process that had the same pid. Publishers may
+            # still have the pipe open, so it's reused rather than replaced.
+            if not stat.S_ISFIFO(os.lstat(path).st_mode):
+                os.unlink(path)
+                os.mkfifo(path, 0o600)
+        # Opened for writing too, so that it never reports end of file.
+        fd = os.open(path, os.O_RDWR | os.O_NONBLOCK)
+        self._bump_readers()
+        return fd
+
+    def _unregister(self, name, fd):
+        os.close(fd)
+        self._unlink_wakeup(name)
+        self._bump_readers()
+
+    def _bump_readers(self):
+        with self._lock:
+            fd = self._flock()
+            try:
+                readers = struct.unpack_from('=Q', self._map, _READERS)[0]
+                struct.pack_into('=Q', self._map, _READERS, readers + 1)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def reader(self):
+        '''
+        Returns a :class:`RingReader` that starts with the next published
+        record.
+        '''
+        return RingReader(self)
+
+
+class RingReader(object):
+    '''
+    Reads the records of a :class:`SharedRing` in order. ``next_sequence``
+    is the sequence number of the next record and ``lost`` counts the
+    records that were overwritten before they could be read.
+    '''
+
+    def __init__(self, ring):
+        self.ring = ring
+        self._name = '%d-%d' % (os.getpid(), next(_counter))
+        self._fd = ring._register(self._name)
+        reserved, self._position, self.next_sequence = ring._header()
+        self.lost = 0
+
+    def fileno(self):
+        '''
+        The file descriptor that becomes readable when records were
+        published.
+        '''
+        return self._fd
+
+    def close(self):
+        if self._fd is not None:
+            self.ring._unregister(self._name, self._fd)
+            self._fd = None
+
+    def wait(self, timeout=None):
+        '''
+        Waits up to *timeout* seconds for a wakeup by a publisher and
+        returns :meth:`read`.
+        '''
+        try:
+            readable = select.select([self._fd], [], [], timeout)[0]
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            readable = False
+        if readable:
+            try:
+                while os.read(self._fd, 4096):
+                    pass
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+        return self.read()
+
+    def _skip(self, committed, sequence):
+        self.lost += sequence - self.next_sequence
+        self._position = committed
+        self.next_sequence = sequence
+
+    def read(self):
+        '''
+        Returns a list of ``(group, frame)`` tuples of the records that were
+        published since the last call, without waiting.
+        '''
+        ring = self.ring
+        reserved, committed, sequence = ring._header()
+        if committed - self._position > ring.capacity:
+            self._skip(committed, sequence)
+            return []
+        data = ring._read(self._position, committed - self._position)
+        if ring._header()[0] - ring.capacity > self._position:
+            # Overwritten while copying.
+            reserved, committed, sequence = ring._header()
+            self._skip(committed, sequence)
+            return []
+        records = []
+        offset = 0
+        unpack_from = _RECORD.unpack_from
+        while offset < len(data):
+            size, record_sequence, group_length = unpack_from(data, offset)
+            start = offset + _RECORD.size
+            group = data[start:start + group_length]
+            records.append((group.decode('utf-8'),
+                data[start + group_length:offset + size]))
+            offset += size
+            self.next_sequence = record_sequence + 1
+        self._position = committed
+        return records
+
+
+def _hybi_payload(frame):
+    '''
+    Returns the payload of the unmasked RFC 6455 *frame*.
+    '''
+    length = bytearray(frame[1:2])[0] & 0x7f
+    if length == 126:
+        return frame[4:]
+    if length == 127:
+        return frame[10:]
+    return frame[2:]
+
+
+class SharedBroadcaster(object):
+    '''
+    Sends messages to groups of websockets in all processes that use the
+    ring buffer file *path*. The websockets of this process are managed by
+    the :class:`~django_websocket.broadcast.Broadcaster` *local*, a new one
+    by default.
+
+    The thread that delivers messages to this process is started by the
+    first :meth:`add`, also in processes that were forked after the
+    ``SharedBroadcaster`` was created. Messages are delivered to websockets
+    of every class, but they are framed only once by the publisher, so
+    websockets that negotiated permessage-deflate receive them
+    uncompressed.
+
+    If *local* has a :class:`~django_websocket.replay.ReplayBuffer`, every
+    process stores the delivered messages in it, so that
+    ``local.resume()`` replays them to clients that reconnect to the same
+    process.
+    '''
+
+    def __init__(self, path, capacity=DEFAULT_CAPACITY, local=None,
+        poll_interval=1.0):
+        self.path = path
+        self.capacity = capacity
+        if local is None:
+            local = Broadcaster()
+        self.local = local
+        self.poll_interval = poll_interval
+        self._ring = None
+        self._pid = None
+        self._thread = None
+        self._reader = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    @property
+    def ring(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    # Threads and readers don't survive a fork.
+                    self._ring = SharedRing(self.path, self.capacity)
+                    self._thread = None
+                    self._reader = None
+                    self._pid = pid
+        return self._ring
+
+    @property
+    def lost(self):
+        '''
+        The number of messages this process missed because it fell behind.
+        '''
+        if self._reader is None:
+            return 0
+        return self._reader.lost
+
+    def add(self, group, websocket):
+        '''
+        Add *websocket* of this process to *group*.
+        '''
+        self.start()
+        self.local.add(group, websocket)
+
+    def remove(self, group, websocket):
+        self.local.remove(group, websocket)
+
+    def discard(self, websocket):
+        self.local.discard(websocket)
+
+    def broadcast(self, group, message):
+        '''
+        Publishes *message* to the members of *group* in all processes and
+        returns its sequence number.
+        '''
+        frame = HybiWebSocket._pack_message(message)
+        return self.ring.publish(group, frame)
+
+    def deliver(self, group, frame):
+        '''
+        Writes the published *frame* to the members of *group* in this
+        process and returns the number of websockets it was sent to. If
+        *local* has a replay buffer, the message is stored there with an id
+        of this process and framed again, like a local broadcast.
+        '''
+        if self.local.replay is not None:
+            return self.local.broadcast(group,
+                _hybi_payload(frame).decode('utf-8'))
+        def pack(cls):
+            if issubclass(cls, HybiWebSocket):
+                return frame
+            return cls._pack_message(_hybi_payload(frame))
+        return self.local._fanout(group, pack)
+
+    def start(self):
+        '''
+        Starts the thread that delivers messages to this process, unless
+        it's running already.
+        '''
+        ring = self.ring
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stopped.clear()
+            self._reader = ring.reader()
+            self._thread = threading.Thread(target=self._run,
+                args=(self._reader,),
+                name='django_websocket.SharedBroadcaster')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        '''
+        Stops the delivering thread of this process.
+        '''
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is None:
+            return
+        self._stopped.set()
+        if thread is not threading.current_thread():
+            thread.join()
+
+    def _run(self, reader):
+        try:
+            while not self._stopped.is_set():
+                lost = reader.lost
+                records = reader.wait(self.poll_interval)
+                if reader.lost != lost:
+                    logger.warning('Lost %d broadcast messages.',
+                        reader.lost - lost)
+                for group, frame in records:
+                    try:
+                        self.deliver(group, frame)
+                    except Exception:
+                        logger.exception('Broadcast to %r failed.', group)
+        finally:
+            reader.close()
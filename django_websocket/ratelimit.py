@@ -0,0 +1,181 @@
+'''
+Inbound rate limits for :class:`~django_websocket.websocket.WebSocket`.
+
+A client that floods a websocket with messages makes the view spend its time
+on that client alone. A :class:`RateLimiter` counts the messages and bytes a
+websocket receives in token buckets that refill at ``messages_per_second``
+and ``bytes_per_second`` and hold up to ``burst_messages`` and
+``burst_bytes``. Received data is charged after it was parsed, before the
+messages are queued and decoded. Once a bucket is empty, the policy decides
+what happens:
+
+- ``POLICY_DROP``: drop the messages that exceed the limit.
+- ``POLICY_DELAY``: keep the messages, but don't read from the socket until
+  the buckets are refilled. The client is slowed down by TCP flow control.
+  ``WebSocket.wait()`` sleeps, ``read()`` and ``has_messages()`` don't read
+  and a :class:`~django_websocket.poller.WebSocketPoller` stops watching the
+  websocket meanwhile.
+- ``POLICY_CLOSE``: close the websocket with status code 1008.
+
+A limiter can have a *parent* that is shared by many websockets, e.g. all
+websockets of a process, which is charged with the messages the limiter of
+the websocket let through and applies its own policy::
+
+    from django_websocket.ratelimit import RateLimiter
+
+    everybody = RateLimiter(messages_per_second=5000, policy='delay')
+
+    @accept_websocket
+    def chat(request):
+        request.websocket.enable_rate_limit(messages_per_second=20,
+            burst_messages=50, policy='close', parent=everybody)
+        ...
+'''
+import threading
+import time
+
+
+POLICY_DROP = 'drop'
+POLICY_DELAY = 'delay'
+POLICY_CLOSE = 'close'
+POLICIES = (POLICY_DROP, POLICY_DELAY, POLICY_CLOSE)
+
+
+class TokenBucket(object):
+    '''
+    Holds up to *burst* tokens, *rate* by default, and gains *rate* tokens
+    per second. Spending more tokens than are available leaves a debt that
+    is paid back before tokens are available again.
+    '''
+
+    def __init__(self, rate, burst=None):
+        if rate <= 0:
+            raise ValueError('The rate must be positive.')
+        self.rate = float(rate)
+        if burst is None:
+            burst = rate
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = time.time()
+
+    def _refill(self, now):
+        elapsed = now - self.updated
+        if elapsed > 0:
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+            self.updated = now
+
+    def spend(self, amount, now):
+        '''
+        Spends *amount* tokens, even if that leaves a debt.
+        '''
+        self._refill(now)
+        self.tokens -= amount
+
+    def take(self, amount, now):
+        '''
+        Spends up to *amount* whole tokens and returns how many were
+        available.
+        '''
+        self._refill(now)
+        # A token that is short by a rounding error counts.
+        taken = min(amount, max(int(self.tokens + 1e-9), 0))
+        self.tokens -= taken
+        return taken
+
+    def delay(self, now):
+        '''
+        Returns the seconds until the debt is paid back.
+        '''
+        self._refill(now)
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+
+class RateLimiter(object):
+    '''
+    Limits the messages and bytes received by one websocket, or by all
+    websockets that use it as *parent*. ``dropped_messages`` counts the
+    messages dropped by ``POLICY_DROP``.
+    '''
+
+    def __init__(self, messages_per_second=None, bytes_per_second=None,
+        burst_messages=None, burst_bytes=None, policy=POLICY_DROP,
+        parent=None):
+        '''
+        Arguments:
+
+        - ``messages_per_second``: Sustained rate of messages, ``None``
+          doesn't limit the messages.
+        - ``bytes_per_second``: Sustained rate of received bytes, including
+          frame headers and control frames. ``None`` doesn't limit the bytes.
+        - ``burst_messages`` and ``burst_bytes``: Size of the buckets, how
+          much may be received at once after a quiet period. Default to one
+          second worth of the rate.
+        - ``policy``: One of ``POLICY_DROP``, ``POLICY_DELAY`` and
+          ``POLICY_CLOSE``.
+        - ``parent``: A ``RateLimiter`` shared with other websockets.
+        '''
+        if policy not in POLICIES:
+            raise ValueError('Unknown policy: %r' % (policy,))
+        self.policy = policy
+        self.parent = parent
+        self.messages = None
+        if messages_per_second is not None:
+            self.messages = TokenBucket(messages_per_second, burst_messages)
+        self.bytes = None
+        if bytes_per_second is not None:
+            self.bytes = TokenBucket(bytes_per_second, burst_bytes)
+        self.dropped_messages = 0
+        self._lock = threading.Lock()
+
+    def receive(self, nbytes, nmessages, now=None):
+        '''
+        Charges *nbytes* received bytes that contained *nmessages* messages.
+        Returns how many of the messages are let through, counted from the
+        first one, or ``None`` if the websocket has to be closed.
+        '''
+        if now is None:
+            now = time.time()
+        with self._lock:
+            admitted = self._receive(nbytes, nmessages, now)
+        if admitted is None or self.parent is None:
+            return admitted
+        return self.parent.receive(nbytes, admitted, now)
+
+    def _receive(self, nbytes, nmessages, now):
+        policy = self.policy
+        admitted = nmessages
+        if self.bytes is not None:
+            self.bytes.spend(nbytes, now)
+            if self.bytes.tokens < 0:
+                if policy == POLICY_CLOSE:
+                    return None
+                if policy == POLICY_DROP:
+                    admitted = 0
+        if self.messages is not None and admitted:
+            if policy == POLICY_DELAY:
+                self.messages.spend(admitted, now)
+            else:
+                admitted = self.messages.take(admitted, now)
+                if admitted < nmessages and policy == POLICY_CLOSE:
+                    return None
+        self.dropped_messages += nmessages - admitted
+        return admitted
+
+    def delay(self, now=None):
+        '''
+        Returns the seconds to wait before reading again, which is only
+        positive for ``POLICY_DELAY``.
+        '''
+        if now is None:
+            now = time.time()
+        delay = 0.0
+        if self.policy == POLICY_DELAY:
+            with self._lock:
+                for bucket in (self.messages, self.bytes):
+                    if bucket is not None:
+                        delay = max(delay, bucket.delay(now))
+        if self.parent is not None:
+            delay = max(delay, self.parent.delay(now))
+        return delay
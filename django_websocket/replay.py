@@ -0,0 +1,236 @@
+'''
+Replay the messages a reconnecting client missed.
+
+A :class:`ReplayBuffer` keeps the most recent messages of every topic, each
+with an id that is larger than the ids before it. A
+:class:`~django_websocket.broadcast.Broadcaster` with a replay buffer stores
+every message it broadcasts, and a client that reconnects after a deploy or
+a network hiccup passes the id of the last message it saw to get only the
+gap, without a database query::
+
+    import json
+    from django_websocket.broadcast import Broadcaster
+    from django_websocket.replay import ReplayBuffer, last_seen_id
+
+    news = Broadcaster(replay=ReplayBuffer(
+        format=lambda id, message: json.dumps({'id': id, 'text': message})))
+
+    @require_websocket
+    def notifications(request):
+        # ws://example.com/notifications/?last_id=5f3a9c0e12d4-1042
+        if news.resume('news', request.websocket,
+                last_seen_id(request)) is None:
+            # Too old to be replayed from memory.
+            send_from_database(request.websocket)
+        ...
+
+Ids are strings that consist of the epoch of the topic, random hex digits
+chosen when the topic is created, and a sequence number. Every process has
+its own buffer, so an id that a client got from another worker or from a
+restarted process has another epoch. It is never mistaken for an id of the
+current topic and can't be replayed, which makes the client resync from the
+database.
+'''
+import random
+import re
+import threading
+from collections import deque
+from itertools import islice
+from django_websocket.websocket import _encode_message
+
+
+_ID = re.compile(r'^[0-9a-f]+-[0-9]+$')
+_random = random.SystemRandom()
+
+
+class Topic(object):
+    '''
+    The recent messages of a topic. ``lock`` serializes the appends and
+    replays of the topic.
+    '''
+
+    def __init__(self, max_messages, max_bytes, format=None):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.format = format
+        self.lock = threading.Lock()
+        self.epoch = '%012x' % _random.getrandbits(48)
+        # Sequence number 0 is the id of the start of the topic, before the
+        # first message.
+        self.next_sequence = 1
+        # The oldest sequence number that is still buffered.
+        self.first_sequence = 1
+        self.nbytes = 0
+        self._messages = deque()
+        # Joined frames of replays by websocket class and id. Clients that
+        # reconnect at the same time mostly missed the same messages.
+        self._frames = {}
+
+    def __len__(self):
+        return len(self._messages)
+
+    @property
+    def last_id(self):
+        '''
+        The id of the newest message, or ``None`` if nothing was appended.
+        '''
+        if self.next_sequence == 1:
+            return None
+        return self.make_id(self.next_sequence - 1)
+
+    def make_id(self, sequence):
+        '''
+        Returns the id of the message with the sequence number *sequence*.
+        '''
+        return '%s-%d' % (self.epoch, sequence)
+
+    def sequence(self, id):
+        '''
+        Returns the sequence number of *id*, or ``None`` if it's not an id of
+        this topic.
+        '''
+        try:
+            epoch, sequence = id.split('-')
+            sequence = int(sequence)
+        except (AttributeError, ValueError):
+            return None
+        if epoch != self.epoch:
+            return None
+        return sequence
+
+    def append(self, message):
+        '''
+        Assigns the next id to *message* and buffers it, formatted by
+        ``format(id, message)`` if a format function is set. Returns the
+        encoded payload that is stored. The oldest messages are evicted to
+        stay within the count and size limits.
+        '''
+        id = self.make_id(self.next_sequence)
+        self.next_sequence += 1
+        if self.format is not None:
+            message = self.format(id, message)
+        payload = _encode_message(message)
+        self._frames.clear()
+        messages = self._messages
+        messages.append(payload)
+        self.nbytes += len(payload)
+        while len(messages) > self.max_messages or \
+            (self.max_bytes is not None and self.nbytes > self.max_bytes):
+            self.nbytes -= len(messages.popleft())
+            self.first_sequence += 1
+        return payload
+
+    def since(self, last_id):
+        '''
+        Returns a list of the payloads of the messages after *last_id*, or
+        ``None`` if some of them were evicted already or *last_id* is
+        unknown, e.g. from another epoch.
+        '''
+        sequence = self.sequence(last_id)
+        if sequence is None or sequence < self.first_sequence - 1 or \
+            sequence >= self.next_sequence:
+            return None
+        count = self.next_sequence - 1 - sequence
+        # Counted from the newest message, which is cheap for small gaps.
+        missed = list(islice(reversed(self._messages), count))
+        missed.reverse()
+        return missed
+
+    def frames(self, cls, last_id):
+        '''
+        Returns the messages after *last_id* framed for the websocket class
+        *cls* as one string, or ``None`` if they can't be replayed.
+        '''
+        key = (cls, last_id)
+        frames = self._frames.get(key)
+        if frames is None:
+            missed = self.since(last_id)
+            if missed is None:
+                return None
+            if len(self._frames) >= 64:
+                self._frames.clear()
+            frames = self._frames[key] = b''.join(
+                [cls._pack_message(payload) for payload in missed])
+        return frames
+
+
+class ReplayBuffer(object):
+    '''
+    Keeps up to *max_messages* messages and *max_bytes* bytes of encoded
+    payloads per topic. A message that doesn't fit into *max_bytes* on its
+    own is not kept. *format* is called with the id and the message to get
+    the payload that is sent and stored, e.g. to include the id.
+    '''
+
+    def __init__(self, max_messages=1000, max_bytes=1024 * 1024, format=None):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.format = format
+        self._topics = {}
+        self._lock = threading.Lock()
+
+    def topic(self, name):
+        '''
+        Returns the :class:`Topic` *name*, which is created if needed.
+        '''
+        try:
+            return self._topics[name]
+        except KeyError:
+            pass
+        with self._lock:
+            topic = self._topics.get(name)
+            if topic is None:
+                topic = self._topics[name] = Topic(self.max_messages,
+                    self.max_bytes, self.format)
+            return topic
+
+    def topics(self):
+        '''
+        Returns a list of the names of all topics.
+        '''
+        with self._lock:
+            return list(self._topics)
+
+    def discard(self, name):
+        '''
+        Forgets the messages of the topic *name*.
+        '''
+        with self._lock:
+            self._topics.pop(name, None)
+
+    def append(self, name, message):
+        '''
+        Buffers *message* for the topic *name* and returns its id.
+        '''
+        topic = self.topic(name)
+        with topic.lock:
+            topic.append(message)
+            return topic.last_id
+
+    def since(self, name, last_id):
+        '''
+        Returns a list of the payloads of the topic *name* after *last_id*,
+        or ``None`` if they can't be replayed.
+        '''
+        topic = self.topic(name)
+        with topic.lock:
+            return topic.since(last_id)
+
+    def last_id(self, name):
+        '''
+        Returns the id of the newest message of the topic *name*.
+        '''
+        topic = self.topic(name)
+        with topic.lock:
+            return topic.last_id
+
+
+def last_seen_id(request, name='last_id'):
+    '''
+    Returns the id that the client passed in the query string parameter
+    *name* of the websocket's URL, or ``None`` if it's missing or malformed.
+    '''
+    value = request.GET.get(name)
+    if not value or _ID.match(value) is None:
+        return None
+    return str(value)
@@ -0,0 +1,405 @@
+'''
+Talk to websocket views over real connections, in tests or against a
+running server.
+
+:class:`WebSocketClient` works like Django's test client, but the request
+comes with a socket: one end of a ``socket.socketpair()``. The request
+passes through the middleware and the handshake like on a real server, the
+view runs in a thread, and the test talks to it through the other end::
+
+    from django_websocket.testing import WebSocketClient
+
+    class EchoTests(TestCase):
+        def test_echo(self):
+            websocket = WebSocketClient().connect('/echo/')
+            websocket.send(u'spam')
+            self.assertEqual(websocket.receive(), u'spam')
+            websocket.close()
+
+:func:`connect` opens a :class:`ClientWebSocket` to a server over TCP
+instead.
+'''
+import base64
+import os
+import random
+import socket
+import struct
+import sys
+import threading
+from hashlib import md5, sha1
+try:
+    from urlparse import urlsplit
+except ImportError: #pragma NO COVER
+    from urllib.parse import urlsplit
+from django_websocket.framing import HixieParser, HybiParser, OPCODE_TEXT, \
+    OPCODE_BINARY, OPCODE_CLOSE, OPCODE_PING, OPCODE_PONG, CLOSE_NORMAL, \
+    pack_hixie_message, pack_hybi_frame, pack_close_payload, \
+    unpack_close_payload
+from django_websocket.handlers import RequestHandler
+from django_websocket.websocket import HYBI_GUID, _encode_message
+
+
+class HandshakeError(Exception):
+    '''
+    Raised if the server didn't upgrade the connection. ``status`` is the
+    HTTP status code of the response, if there was one, and ``content`` its
+    body.
+    '''
+    def __init__(self, message, status=None, content=b''):
+        super(HandshakeError, self).__init__(message)
+        self.status = status
+        self.content = content
+
+
+def _hixie_key():
+    '''
+    Returns a ``Sec-WebSocket-Key1/2`` header value of the hixie-76 draft and
+    the number it encodes.
+    '''
+    spaces = random.randint(1, 12)
+    number = random.randint(0, 0xffffffff // spaces)
+    key = list(str(number * spaces))
+    for i in range(random.randint(1, 12)):
+        key.insert(random.randint(0, len(key)), random.choice('!#$%&/()=?+*~'))
+    for i in range(spaces):
+        key.insert(random.randint(1, len(key) - 1), ' ')
+    return ''.join(key), number
+
+
+def upgrade_request(version=13):
+    '''
+    Returns the headers of an upgrade request for the protocol *version*
+    (75, 76, 8 or 13) as dict of WSGI environ keys, the body of the request
+    and the value the server has to answer with: the
+    ``Sec-WebSocket-Accept`` header of RFC 6455 or the challenge response of
+    hixie-76.
+    '''
+    version = int(version)
+    headers = {'HTTP_CONNECTION': 'Upgrade'}
+    body = b''
+    expected = None
+    if version in (75, 76):
+        headers['HTTP_UPGRADE'] = 'WebSocket'
+        headers['HTTP_ORIGIN'] = 'http://testserver'
+        if version == 76:
+            key1, number1 = _hixie_key()
+            key2, number2 = _hixie_key()
+            headers['HTTP_SEC_WEBSOCKET_KEY1'] = key1
+            headers['HTTP_SEC_WEBSOCKET_KEY2'] = key2
+            body = os.urandom(8)
+            expected = md5(struct.pack('>II', number1, number2) + body).digest()
+    else:
+        key = base64.b64encode(os.urandom(16)).decode('ascii')
+        headers['HTTP_UPGRADE'] = 'websocket'
+        headers['HTTP_SEC_WEBSOCKET_VERSION'] = str(version)
+        headers['HTTP_SEC_WEBSOCKET_KEY'] = key
+        expected = base64.b64encode(
+            sha1((key + HYBI_GUID).encode('ascii')).digest()).decode('ascii')
+    return headers, body, expected
+
+
+def _read_handshake(sock, version, expected):
+    '''
+    Reads the response to an upgrade request from *sock*. Returns the data
+    that was received after it, which already belongs to the websocket.
+    '''
+    data = b''
+    while b'\r\n\r\n' not in data:
+        chunk = sock.recv(4096)
+        if not chunk:
+            raise HandshakeError('Connection closed during the handshake.')
+        data += chunk
+    head, data = data.split(b'\r\n\r\n', 1)
+    lines = head.decode('latin-1').split('\r\n')
+    try:
+        status = int(lines[0].split(' ')[1])
+    except (IndexError, ValueError):
+        raise HandshakeError('Invalid response: %r' % lines[0])
+    if status != 101:
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+        raise HandshakeError('The server answered with status %d.' % status,
+            status, data)
+    headers = {}
+    for line in lines[1:]:
+        name, value = line.split(':', 1)
+        headers[name.strip().lower()] = value.strip()
+    if int(version) == 76:
+        while len(data) < 16:
+            chunk = sock.recv(16 - len(data))
+            if not chunk:
+                raise HandshakeError('Connection closed during the handshake.')
+            data += chunk
+        if data[:16] != expected:
+            raise HandshakeError('Invalid challenge response.')
+        data = data[16:]
+    elif expected is not None and \
+        headers.get('sec-websocket-accept') != expected:
+        raise HandshakeError('Invalid Sec-WebSocket-Accept header.')
+    return data
+
+
+class ClientWebSocket(object):
+    '''
+    The client end of a websocket whose handshake is done. Frames are masked
+    as required for clients, pings are answered and a close frame of the
+    server is echoed.
+    '''
+
+    def __init__(self, sock, version=13, data=b''):
+        self.socket = sock
+        self.version = int(version)
+        self.closed = False
+        self.close_code = None
+        if self.is_hixie:
+            self._parser = HixieParser()
+        else:
+            self._parser = HybiParser(mask_required=False)
+        self._parser.feed(data)
+        self._messages = []
+
+    @property
+    def is_hixie(self):
+        return self.version in (75, 76)
+
+    def _frame(self, opcode, payload):
+        return pack_hybi_frame(opcode, payload, mask=os.urandom(4))
+
+    def send(self, message, binary=False):
+        '''
+        Sends *message*, as binary message if *binary* is true.
+        '''
+        payload = _encode_message(message)
+        if self.is_hixie:
+            if binary:
+                raise ValueError("WebSocket protocol version %s doesn't "
+                    "support binary messages." % self.version)
+            self.socket.sendall(pack_hixie_message(payload))
+        else:
+            opcode = OPCODE_BINARY if binary else OPCODE_TEXT
+            self.socket.sendall(self._frame(opcode, payload))
+
+    def ping(self, payload=b''):
+        self.socket.sendall(self._frame(OPCODE_PING, payload))
+
+    def receive(self, timeout=None):
+        '''
+        Returns the next message, text messages as unicode and binary ones
+        as byte string, or ``None`` once the websocket is closed. Raises
+        ``socket.timeout`` if nothing arrives within *timeout* seconds.
+        '''
+        self.socket.settimeout(timeout)
+        while not self._messages:
+            if self.closed:
+                return None
+            for opcode, payload in self._parser.parse():
+                if opcode == OPCODE_TEXT:
+                    self._messages.append(payload.decode('utf-8'))
+                elif opcode == OPCODE_BINARY:
+                    self._messages.append(payload)
+                else:
+                    self._handle_control_frame(opcode, payload)
+            if self._messages or self.closed:
+                continue
+            if not self._parser.recv_into(self.socket, 64 * 1024):
+                self.closed = True
+        return self._messages.pop(0)
+
+    def _handle_control_frame(self, opcode, payload):
+        if opcode == OPCODE_PING:
+            self.socket.sendall(self._frame(OPCODE_PONG, payload))
+        elif opcode == OPCODE_CLOSE:
+            if not self.is_hixie:
+                self.close_code, reason = unpack_close_payload(payload)
+                try:
+                    self.socket.sendall(self._frame(OPCODE_CLOSE, payload))
+                except socket.error:
+                    # The server didn't wait for the answer.
+                    pass
+            self.closed = True
+
+    def close(self, code=CLOSE_NORMAL, timeout=5):
+        '''
+        Starts the closing handshake and waits up to *timeout* seconds for
+        the server to finish it. Messages that arrive in the meantime are
+        discarded.
+        '''
+        try:
+            if not self.closed:
+                if self.version == 76:
+                    self.socket.sendall(b'\xff\x00')
+                elif not self.is_hixie:
+                    self.socket.sendall(self._frame(OPCODE_CLOSE,
+                        pack_close_payload(code)))
+                elif self.version == 75:
+                    self.socket.shutdown(socket.SHUT_WR)
+            while self.receive(timeout) is not None:
+                pass
+        except (socket.error, ValueError):
+            # WSGI servers write their response to the connection after the
+            # view returned, which is no valid frame.
+            pass
+        self.closed = True
+        self.socket.close()
+
+
+def connect(url, version=13, timeout=10, headers=None):
+    '''
+    Opens a websocket to the ``ws://`` *url* of a running server and returns
+    a :class:`ClientWebSocket`. *headers* is a dict with additional request
+    headers.
+    '''
+    parts = urlsplit(url)
+    port = parts.port or (443 if parts.scheme == 'wss' else 80)
+    if parts.scheme == 'wss':
+        raise ValueError('wss:// is not supported.')
+    sock = socket.create_connection((parts.hostname, port), timeout)
+    try:
+        upgrade, body, expected = upgrade_request(version)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        lines = ['GET %s HTTP/1.1' % path, 'Host: %s' % parts.netloc]
+        for key, value in sorted(upgrade.items()):
+            name = '-'.join(word.capitalize() for word in key[5:].split('_'))
+            lines.append('%s: %s' % (name, value))
+        for name, value in (headers or {}).items():
+            lines.append('%s: %s' % (name, value))
+        sock.sendall(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') +
+            body)
+        data = _read_handshake(sock, version, expected)
+    except Exception:
+        sock.close()
+        raise
+    return ClientWebSocket(sock, version, data)
+
+
+class _Input(object):
+    '''
+    The ``wsgi.input`` of a request for a websocket view: the socket of the
+    connection plus the body of the upgrade request.
+    '''
+    def __init__(self, sock, body):
+        self._sock = sock
+        self._body = body
+
+    def read(self, size=-1):
+        if size < 0:
+            size = len(self._body)
+        data, self._body = self._body[:size], self._body[size:]
+        return data
+
+
+class ViewThread(threading.Thread):
+    '''
+    Runs the view of a :class:`WebSocketClient` request. Once it's finished,
+    ``response`` is the response of the view, or ``exc_info`` is set if it
+    raised an exception.
+    '''
+
+    def __init__(self, client, environ, sock):
+        super(ViewThread, self).__init__(name='django_websocket.ViewThread')
+        self.daemon = True
+        self.client = client
+        self.environ = environ
+        self.socket = sock
+        self.response = None
+        self.exc_info = None
+
+    def run(self):
+        websocket = None
+        try:
+            request, self.response = self.client.handler.get_response(
+                self.environ, self.__class__)
+            websocket = getattr(request, 'websocket', None)
+            if websocket is None or not websocket._handshake_sent:
+                # Rejected, the client gets to see the response.
+                self._write_response(self.response)
+        except Exception:
+            self.exc_info = sys.exc_info()
+        finally:
+            # The server closes the connection after the view returned.
+            self.socket.close()
+            if websocket is not None and \
+                not getattr(websocket, 'handed_off', False):
+                websocket.socket.close()
+
+    def _write_response(self, response):
+        reason = getattr(response, 'reason_phrase', None)
+        if reason is None:
+            from django.core.handlers.wsgi import STATUS_CODE_TEXT
+            reason = STATUS_CODE_TEXT.get(response.status_code, 'UNKNOWN')
+        lines = ['HTTP/1.1 %d %s' % (response.status_code, reason)]
+        for name, value in response.items():
+            lines.append('%s: %s' % (name, value))
+        self.socket.sendall(('\r\n'.join(lines) + '\r\n\r\n').encode(
+            'latin-1') + response.content)
+
+
+class WebSocketClient(object):
+    '''
+    Connects to websocket views of the current project in the same process,
+    over a ``socket.socketpair()``. Keyword arguments are added to the WSGI
+    environ of every request, like for Django's test client.
+    '''
+
+    def __init__(self, **defaults):
+        self.defaults = defaults
+        self.handler = RequestHandler()
+
+    def _environ(self, path, headers, extra, sock, body):
+        if '?' in path:
+            path, query = path.split('?', 1)
+        else:
+            query = ''
+        environ = {
+            'REQUEST_METHOD': 'GET',
+            'SCRIPT_NAME': '',
+            'PATH_INFO': path,
+            'QUERY_STRING': query,
+            'SERVER_NAME': 'testserver',
+            'SERVER_PORT': '80',
+            'SERVER_PROTOCOL': 'HTTP/1.1',
+            'REMOTE_ADDR': '127.0.0.1',
+            'HTTP_HOST': 'testserver',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': _Input(sock, body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        environ.update(headers)
+        environ.update(self.defaults)
+        environ.update(extra)
+        return environ
+
+    def connect(self, path, version=13, timeout=5, **extra):
+        '''
+        Requests *path* with an upgrade to a websocket of protocol *version*
+        and returns the :class:`ClientWebSocket` once the view sent the
+        handshake. Its ``view`` attribute is the :class:`ViewThread` that
+        runs the view. Raises :class:`HandshakeError` if the view rejects
+        the websocket.
+        '''
+        client, server = socket.socketpair()
+        client.settimeout(timeout)
+        headers, body, expected = upgrade_request(version)
+        thread = ViewThread(self,
+            self._environ(path, headers, extra, server, body), server)
+        thread.start()
+        try:
+            data = _read_handshake(client, version, expected)
+        except Exception:
+            client.close()
+            thread.join(timeout)
+            if thread.exc_info is not None:
+                raise thread.exc_info[1]
+            raise
+        websocket = ClientWebSocket(client, version, data)
+        websocket.view = thread
+        return websocket
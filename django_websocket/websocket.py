@@ -1,19 +1,119 @@
+import binascii
 import collections
+import os
+import re
 import select
-import string
 import struct
+import threading
+import time
 try:
-    from hashlib import md5
+    from hashlib import md5, sha1
 except ImportError: #pragma NO COVER
     from md5 import md5
+    from sha import sha as sha1
+try:
+    text_type = unicode
+except NameError: #pragma NO COVER
+    text_type = str
 from errno import EINTR
-from socket import error as SocketError
+from socket import error as SocketError, SHUT_RDWR
+from django_websocket.deflate import PerMessageDeflate
+from django_websocket.metrics import registry as metrics_registry
+from django_websocket.outbound import WriteBuffer, SlowConsumer, \
+    POLICY_DROP, _wait_writable, flusher, set_cork
+from django_websocket.ratelimit import RateLimiter
+from django_websocket.framing import HixieParser, HybiParser, FrameError, \
+    OPCODE_CONTINUATION, OPCODE_TEXT, OPCODE_BINARY, OPCODE_CLOSE, \
+    OPCODE_PING, OPCODE_PONG, CLOSE_NORMAL, CLOSE_GOING_AWAY, \
+    CLOSE_POLICY_VIOLATION, CLOSE_INTERNAL_ERROR, pack_hixie_message, \
+    pack_hybi_frame, pack_hybi_header, pack_close_payload, unpack_close_payload
+
+
+# Versions of the Sec-WebSocket-Version header that use the RFC 6455 framing.
+HYBI_VERSIONS = ('8', '13')
+HYBI_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+# Handshake replies, only the values of the request are filled in per
+# handshake.
+_HYBI_REPLY = (
+    "HTTP/1.1 101 Switching Protocols\r\n"
+    "Upgrade: websocket\r\n"
+    "Connection: Upgrade\r\n"
+    "Sec-WebSocket-Accept: ")
+_HYBI_EXTENSIONS = "\r\nSec-WebSocket-Extensions: "
+_HIXIE_75_REPLY = (
+    "HTTP/1.1 101 Web Socket Protocol Handshake\r\n"
+    "Upgrade: WebSocket\r\n"
+    "Connection: Upgrade\r\n"
+    "WebSocket-Origin: %s\r\n"
+    "WebSocket-Location: ws://%s%s\r\n\r\n")
+_HIXIE_76_REPLY = (
+    "HTTP/1.1 101 Web Socket Protocol Handshake\r\n"
+    "Upgrade: WebSocket\r\n"
+    "Connection: Upgrade\r\n"
+    "Sec-WebSocket-Origin: %s\r\n"
+    "Sec-WebSocket-Protocol: %s\r\n"
+    "Sec-WebSocket-Location: ws://%s%s\r\n\r\n")
+
+# Characters that are deleted from the hixie-76 keys to keep their digits.
+_NON_DIGITS = ''.join(chr(i) for i in range(256) if not '0' <= chr(i) <= '9')
+_DIGITS = re.compile('[0-9]+')
+
+# Number of bytes read at a time from files passed to ``send_stream``.
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Maximum number of buffers that can be passed to one sendmsg call.
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
 
 
 class MalformedWebSocket(ValueError):
     pass
 
 
+def _encode_message(message):
+    """
+    Returns *message* as byte string, unicode is encoded as utf-8.
+    """
+    if isinstance(message, text_type):
+        return message.encode('utf-8')
+    elif isinstance(message, memoryview):
+        return message.tobytes()
+    elif isinstance(message, bytearray):
+        return bytes(message)
+    elif not isinstance(message, bytes):
+        return _encode_message(str(message))
+    return message
+
+
+def _send_buffers(sock, buffers):
+    """
+    Writes all *buffers* to *sock*. If the socket supports ``sendmsg``
+    (writev) up to ``IOV_MAX`` buffers are written with one system call
+    without joining them first. Partial writes are continued where they
+    stopped. Other sockets, which includes all sockets on Python 2, get the
+    joined buffers passed to ``sendall``.
+    """
+    buffers = [buf for buf in buffers if len(buf)]
+    sendmsg = getattr(sock, 'sendmsg', None)
+    if sendmsg is None:
+        sock.sendall(b''.join(buffers))
+        return
+    index = 0
+    count = len(buffers)
+    while index < count:
+        sent = sendmsg(buffers[index:index + IOV_MAX])
+        while sent:
+            length = len(buffers[index])
+            if sent < length:
+                buffers[index] = memoryview(buffers[index])[sent:]
+                break
+            sent -= length
+            index += 1
+
+
 def _extract_number(value):
     """
     Utility function which, given a string like 'g98sd  5[]221@1', will
@@ -22,19 +122,133 @@ def _extract_number(value):
     In other words, it extracts digits from a string and returns the number
     due to the number of spaces.
     """
-    out = ""
-    spaces = 0
-    for char in value:
-        if char in string.digits:
-            out += char
-        elif char == " ":
-            spaces += 1
-    return int(out) / spaces
+    try:
+        digits = value.translate(None, _NON_DIGITS)
+    except TypeError:
+        # Text strings don't delete characters with translate.
+        digits = ''.join(_DIGITS.findall(value))
+    spaces = value.count(' ')
+    if not digits or not spaces:
+        raise MalformedWebSocket("Invalid Sec-WebSocket-Key header.")
+    return int(digits) // spaces
+
+
+def _accept_key(key):
+    """
+    Returns the Sec-WebSocket-Accept value for the Sec-WebSocket-Key *key*,
+    or ``None`` if *key* isn't the base64 encoding of 16 bytes.
+    """
+    # The encoding of 16 bytes always has 24 characters including padding.
+    if len(key) != 24:
+        return None
+    try:
+        if len(binascii.a2b_base64(key)) != 16:
+            return None
+    except (TypeError, binascii.Error):
+        return None
+    return binascii.b2a_base64(sha1(key + HYBI_GUID).digest())[:-1]
+
+
+def _stream_chunks(data, chunk_size):
+    """
+    Returns an iterator over the non-empty chunks of the file-like object or
+    iterable *data*. Files are read *chunk_size* bytes at a time.
+    """
+    read = getattr(data, 'read', None)
+    if read is not None:
+        data = iter(lambda: read(chunk_size), b'')
+    for chunk in data:
+        if len(chunk):
+            yield _encode_message(chunk)
+
+
+def _file_size(fileobj):
+    """
+    Returns the size of the file-like object *fileobj*.
+    """
+    try:
+        return os.fstat(fileobj.fileno()).st_size
+    except (AttributeError, EnvironmentError, ValueError):
+        # Not a real file, like a StringIO.
+        position = fileobj.tell()
+        fileobj.seek(0, 2)
+        size = fileobj.tell()
+        fileobj.seek(position)
+        return size
+
 
+def _copy_file(sock, fileobj, offset, count, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Sends *count* bytes of *fileobj* from *offset* on to *sock* and returns
+    the number of bytes sent, which is smaller if the file ended early. Uses
+    ``socket.sendfile``, which lets the kernel copy the data, where it's
+    available and reads and sends the file otherwise.
+    """
+    if not count:
+        return 0
+    sendfile = getattr(sock, 'sendfile', None)
+    if sendfile is not None:
+        return sendfile(fileobj, offset, count)
+    fileobj.seek(offset)
+    remaining = count
+    while remaining:
+        data = fileobj.read(min(chunk_size, remaining))
+        if not data:
+            break
+        sock.sendall(data)
+        remaining -= len(data)
+    return count - remaining
 
-def setup_websocket(request):
-    if request.META.get('HTTP_CONNECTION', None) == 'Upgrade' and \
-        request.META.get('HTTP_UPGRADE', None) == 'WebSocket':
+
+def _header_tokens(value):
+    return [token.strip().lower() for token in value.split(',')]
+
+
+def _setup_hybi_websocket(request, deflate=None, **options):
+    """
+    Returns a :class:`HybiWebSocket` for a request that follows RFC 6455.
+    permessage-deflate is negotiated if *deflate* is a dict with the keyword
+    arguments for :meth:`PerMessageDeflate.negotiate`.
+    """
+    version = request.META['HTTP_SEC_WEBSOCKET_VERSION'].strip()
+    if version not in HYBI_VERSIONS:
+        raise MalformedWebSocket(
+            "Unsupported WebSocket protocol version %s." % version)
+    accept = _accept_key(request.META.get('HTTP_SEC_WEBSOCKET_KEY', '').strip())
+    if accept is None:
+        raise MalformedWebSocket("Invalid Sec-WebSocket-Key header.")
+    extension = None
+    extensions = request.META.get('HTTP_SEC_WEBSOCKET_EXTENSIONS')
+    if deflate is not None and extensions:
+        extension, response = PerMessageDeflate.negotiate(extensions, **deflate)
+    if extension is None:
+        handshake_reply = _HYBI_REPLY + accept + "\r\n\r\n"
+    else:
+        handshake_reply = ''.join((_HYBI_REPLY, accept, _HYBI_EXTENSIONS,
+            response, "\r\n\r\n"))
+    socket = request.META['wsgi.input']._sock.dup()
+    return HybiWebSocket(
+        socket,
+        protocol=request.META.get('HTTP_SEC_WEBSOCKET_PROTOCOL'),
+        version=int(version),
+        handshake_reply=handshake_reply,
+        deflate=extension,
+        **options
+    )
+
+
+def setup_websocket(request, deflate=None, **options):
+    """
+    Returns a :class:`WebSocket` if *request* asks for a websocket upgrade,
+    otherwise ``None``. *options*, like the size limits, are passed on to the
+    :class:`WebSocket`.
+    """
+    if 'upgrade' in _header_tokens(request.META.get('HTTP_CONNECTION', '')) and \
+        request.META.get('HTTP_UPGRADE', '').lower() == 'websocket':
+
+        # Current browsers follow RFC 6455.
+        if 'HTTP_SEC_WEBSOCKET_VERSION' in request.META:
+            return _setup_hybi_websocket(request, deflate, **options)
 
         # See if they sent the new-format headers
         if 'HTTP_SEC_WEBSOCKET_KEY1' in request.META:
@@ -54,41 +268,25 @@ def setup_websocket(request):
             key = struct.pack(">II", key1, key2) + key3
             handshake_response = md5(key).digest()
 
-        location = 'ws://%s%s' % (request.get_host(), request.path)
+        path = request.path
         qs = request.META.get('QUERY_STRING')
         if qs:
-            location += '?' + qs
+            path = '%s?%s' % (path, qs)
         if protocol_version == 75:
-            handshake_reply = (
-                "HTTP/1.1 101 Web Socket Protocol Handshake\r\n"
-                "Upgrade: WebSocket\r\n"
-                "Connection: Upgrade\r\n"
-                "WebSocket-Origin: %s\r\n"
-                "WebSocket-Location: %s\r\n\r\n" % (
-                    request.META.get('HTTP_ORIGIN'),
-                    location))
-        elif protocol_version == 76:
-            handshake_reply = (
-                "HTTP/1.1 101 Web Socket Protocol Handshake\r\n"
-                "Upgrade: WebSocket\r\n"
-                "Connection: Upgrade\r\n"
-                "Sec-WebSocket-Origin: %s\r\n"
-                "Sec-WebSocket-Protocol: %s\r\n"
-                "Sec-WebSocket-Location: %s\r\n" % (
-                    request.META.get('HTTP_ORIGIN'),
-                    request.META.get('HTTP_SEC_WEBSOCKET_PROTOCOL', 'default'),
-                    location))
-            handshake_reply = str(handshake_reply)
-            handshake_reply = '%s\r\n%s' % (handshake_reply, handshake_response)
-
+            handshake_reply = _HIXIE_75_REPLY % (
+                request.META.get('HTTP_ORIGIN'), request.get_host(), path)
         else:
-            raise MalformedWebSocket("Unknown WebSocket protocol version.")
+            handshake_reply = str(_HIXIE_76_REPLY % (
+                request.META.get('HTTP_ORIGIN'),
+                request.META.get('HTTP_SEC_WEBSOCKET_PROTOCOL', 'default'),
+                request.get_host(), path)) + handshake_response
         socket = request.META['wsgi.input']._sock.dup()
         return WebSocket(
             socket,
             protocol=request.META.get('HTTP_WEBSOCKET_PROTOCOL'),
             version=protocol_version,
             handshake_reply=handshake_reply,
+            **options
         )
     return None
 
@@ -102,11 +300,17 @@ class WebSocket(object):
     call :meth:`send` and :meth:`wait` in order to pass messages back
     and forth with the browser.
     """
+    # Bounds of the number of bytes requested per read. The read size adapts
+    # to the incoming traffic in between.
     _socket_recv_bytes = 4096
-
+    _socket_recv_max_bytes = 256 * 1024
+    # Seconds until the flusher retries sending data that neither a busy
+    # write lock nor a full socket let through, if not coalescing.
+    _flush_retry_delay = 0.01
 
     def __init__(self, socket, protocol, version=76,
-        handshake_reply=None, handshake_sent=None):
+        handshake_reply=None, handshake_sent=None, max_message_size=None,
+        max_buffer_size=None, max_queued_messages=None, decode=True):
         '''
         Arguments:
 
@@ -118,22 +322,59 @@ class WebSocket(object):
           client when ``send_handshake()`` is called.
         - ``handshake_sent``: Whether the handshake is already sent or not.
           Set to ``False`` to prevent ``send_handshake()`` to do anything.
+        - ``max_message_size``: Maximum size of a received message in bytes.
+        - ``max_buffer_size``: Maximum number of bytes of incomplete frames
+          that are buffered. Must not be smaller than ``max_message_size``.
+        - ``max_queued_messages``: Maximum number of received messages that
+          wait for being read.
+        - ``decode``: Set to ``False`` to receive text messages as utf-8
+          encoded byte strings instead of unicode.
+
+        The websocket is closed if the client exceeds one of the limits.
         '''
         self.socket = socket
         self.protocol = protocol
         self.version = version
         self.closed = False
+        self.max_message_size = max_message_size
+        self.max_buffer_size = max_buffer_size
+        self.max_queued_messages = max_queued_messages
+        self.decode = decode
         self.handshake_reply = handshake_reply
         if handshake_sent is None:
             self._handshake_sent = not bool(handshake_reply)
         else:
             self._handshake_sent = handshake_sent
-        self._buffer = ""
+        self._parser = self._create_parser()
         self._message_queue = collections.deque()
+        self._recv_size = self._socket_recv_bytes
+        self.write_buffer = None
+        # Seconds coalesced frames may wait, ``None`` if not coalescing.
+        self.coalesce_delay = None
+        self._flush_scheduled = False
+        # Frames of broadcasts that wait for the write lock, see
+        # ``_queue_frame``.
+        self._pending = collections.deque()
+        self._pending_bytes = 0
+        self._pending_scheduled = False
+        self._pending_lock = threading.Lock()
+        self.rate_limiter = None
+        self.metrics = None
+        # Time of the last parsed frame, used to detect dead clients.
+        self.last_activity = time.time()
+        # Frames may be written by other threads, like the keepalive thread
+        # or a broadcaster, so writes must not interleave.
+        self._write_lock = threading.RLock()
+
+    def _create_parser(self):
+        return HixieParser(max_message_size=self.max_message_size,
+            max_buffer_size=self.max_buffer_size)
 
     def send_handshake(self):
         self.socket.sendall(self.handshake_reply)
         self._handshake_sent = True
+        if self.metrics is not None:
+            self.metrics.handshake_time = time.time() - self.metrics.opened
 
     @classmethod
     def _pack_message(cls, message):
@@ -141,62 +382,565 @@ class WebSocket(object):
 
         As per the dataframing section (5.3) for the websocket spec
         """
-        if isinstance(message, unicode):
-            message = message.encode('utf-8')
-        elif not isinstance(message, str):
-            message = str(message)
-        packed = "\x00%s\xFF" % message
-        return packed
+        return pack_hixie_message(_encode_message(message))
 
     def _parse_message_queue(self):
-        """ Parses for messages in the buffer *buf*.  It is assumed that
-        the buffer contains the start character for a message, but that it
-        may contain only part of the rest of the message.
+        """ Parses for messages in the buffered data of the parser.  It is
+        assumed that the buffer contains the start character for a message,
+        but that it may contain only part of the rest of the message.
 
-        Returns an array of messages, and the buffer remainder that
-        didn't contain any full messages."""
+        Returns an array of ``(opcode, payload)`` tuples. The payloads are
+        decoded when they are read. Data that didn't contain any full
+        messages stays buffered in the parser."""
+        try:
+            frames = self._parser.parse()
+        except FrameError as e:
+            self._fail_connection(e.code)
+            return []
+        if not frames:
+            return []
+        self.last_activity = time.time()
+        if self.metrics is not None:
+            self.metrics.frames_in += len(frames)
         msgs = []
-        end_idx = 0
-        buf = self._buffer
-        while buf:
-            frame_type = ord(buf[0])
-            if frame_type == 0:
-                # Normal message.
-                end_idx = buf.find("\xFF")
-                if end_idx == -1: #pragma NO COVER
-                    break
-                msgs.append(buf[1:end_idx].decode('utf-8', 'replace'))
-                buf = buf[end_idx+1:]
-            elif frame_type == 255:
-                # Closing handshake.
-                assert ord(buf[1]) == 0, "Unexpected closing handshake: %r" % buf
-                self.closed = True
-                break
+        for frame in frames:
+            if frame[0] == OPCODE_TEXT or frame[0] == OPCODE_BINARY:
+                msgs.append(frame)
             else:
-                raise ValueError("Don't understand how to parse this type of message: %r" % buf)
-        self._buffer = buf
+                self._handle_control_frame(*frame)
         return msgs
 
-    def send(self, message):
+    def _decode_message(self, message, decode=None):
+        '''
+        Returns the payload of the queued *message*. Text messages are
+        decoded if *decode* is true, which defaults to ``self.decode``.
+        '''
+        opcode, payload = message
+        if decode is None:
+            decode = self.decode
+        if decode and opcode == OPCODE_TEXT:
+            return payload.decode('utf-8', 'replace')
+        return payload
+
+    def _handle_control_frame(self, opcode, payload):
+        if opcode == OPCODE_CLOSE:
+            self.closed = True
+
+    def _fail_connection(self, code):
+        '''
+        Closes the websocket because the client violated the protocol or a
+        limit. *code* is the reason as RFC 6455 status code.
+        '''
+        self._send_closing_frame(True)
+        self.closed = True
+
+    def send(self, message, binary=False):
         '''
         Send a message to the client. *message* should be convertable to a
         string; unicode objects should be encodable as utf-8.
+
+        Pass ``binary=True`` to send a binary message, which requires the
+        framing of RFC 6455.
         '''
+        if binary:
+            self._binary_unsupported()
         packed = self._pack_message(message)
-        self.socket.sendall(packed)
+        self._write(packed)
+
+    def _binary_unsupported(self):
+        raise ValueError(
+            "WebSocket protocol version %s doesn't support binary messages." %
+            self.version)
+
+    def _write(self, data):
+        '''
+        Writes already framed *data* to the socket.
+        '''
+        metrics = self.metrics
+        # The counters are only updated under the write lock.
+        with self._write_lock:
+            if metrics is not None:
+                start = time.time()
+            if self.write_buffer is None:
+                self.socket.sendall(data)
+            else:
+                self._write_buffers((data,))
+            if metrics is not None:
+                metrics.sent(len(data), 1, time.time() - start)
+
+    def _write_buffers(self, buffers):
+        '''
+        Writes the already framed data in the list *buffers* to the socket.
+        '''
+        with self._write_lock:
+            if self.write_buffer is None:
+                _send_buffers(self.socket, buffers)
+                return
+            try:
+                self.write_buffer.extend(buffers)
+            except SlowConsumer:
+                self.closed = True
+                raise
+            if self.coalesce_delay is not None and \
+                not self._flush_scheduled and self.write_buffer.buffered_amount:
+                self._flush_scheduled = True
+                flusher.schedule(self.coalesce_delay, self)
+
+    def _flush_delay(self):
+        if self.coalesce_delay is not None:
+            return self.coalesce_delay
+        return self._flush_retry_delay
+
+    def _flush_coalesced(self):
+        '''
+        Sends the coalesced and queued frames without blocking. Called by the
+        flusher thread once the delay is over; data that the socket doesn't
+        take right away is tried again after another delay.
+        '''
+        if not self._write_lock.acquire(False):
+            # The view is writing right now, which may flush anyway.
+            flusher.schedule(self._flush_delay(), self)
+            return
+        try:
+            self._flush_scheduled = False
+            try:
+                self._move_pending()
+                empty = self.write_buffer.flush(0)
+            except SocketError:
+                # The view gets the error with its next write.
+                return
+            if not empty:
+                self._flush_scheduled = True
+                flusher.schedule(self._flush_delay(), self)
+        finally:
+            self._write_lock.release()
+
+    def _queue_frame(self, data):
+        '''
+        Queues the already framed *data* for :meth:`_send_queued` without
+        touching the socket, so that a broadcaster can queue a message for
+        many websockets while holding a lock. Requires a write buffer, whose
+        policy applies once more than its high watermark is queued; only
+        ``POLICY_DROP`` doesn't close the websocket then, because queuing
+        must not block.
+        '''
+        if self.closed:
+            raise SocketError("The websocket is closed.")
+        write_buffer = self.write_buffer
+        with self._pending_lock:
+            pending = self._pending
+            pending.append(data)
+            self._pending_bytes += len(data)
+            if self._pending_bytes <= write_buffer.high_watermark:
+                return
+            if write_buffer.policy != POLICY_DROP:
+                pending.clear()
+                self._pending_bytes = 0
+                self.closed = True
+                raise SlowConsumer(
+                    "More than %d bytes queued for the client." %
+                    write_buffer.high_watermark)
+            while self._pending_bytes > write_buffer.low_watermark and \
+                len(pending) > 1:
+                self._pending_bytes -= len(pending.popleft())
+                write_buffer.dropped_frames += 1
+
+    def _send_queued(self):
+        '''
+        Sends the frames queued by :meth:`_queue_frame` as far as that
+        doesn't block. If another thread is writing or the socket doesn't
+        take everything, the flusher thread tries again later.
+        '''
+        if not self._write_lock.acquire(False):
+            with self._pending_lock:
+                if not self._pending or self._pending_scheduled:
+                    return
+                self._pending_scheduled = True
+            flusher.schedule(self._flush_delay(), self)
+            return
+        try:
+            self._move_pending()
+            if self.write_buffer.buffered_amount and \
+                not self._flush_scheduled:
+                self._flush_scheduled = True
+                flusher.schedule(self._flush_delay(), self)
+        finally:
+            self._write_lock.release()
+
+    def _move_pending(self):
+        '''
+        Moves the frames queued by :meth:`_queue_frame` into the write
+        buffer. Must be called with the write lock held.
+        '''
+        with self._pending_lock:
+            frames = self._pending
+            if not frames:
+                return
+            nbytes = self._pending_bytes
+            self._pending = collections.deque()
+            self._pending_bytes = 0
+            self._pending_scheduled = False
+        try:
+            self.write_buffer.extend_nowait(frames)
+        except SlowConsumer:
+            self.closed = True
+            raise
+        if self.metrics is not None:
+            self.metrics.sent(nbytes, len(frames), 0.0)
+
+    def _write_nowait(self, data):
+        '''
+        Writes the small frame *data* only if that doesn't block, and returns
+        ``True`` if it was written. Used by the keepalive thread, which must
+        not get stuck on a dead connection.
+        '''
+        if not self._write_lock.acquire(False):
+            return False
+        try:
+            if self.buffered_amount or not _wait_writable(self.socket, 0):
+                return False
+            self.socket.sendall(data)
+            if self.metrics is not None:
+                self.metrics.sent(len(data), 1, 0.0)
+            return True
+        finally:
+            self._write_lock.release()
+
+    def _keepalive_frame(self, message):
+        '''
+        Returns the frame that is sent to find out if the client is still
+        alive. The hixie drafts have no ping frames, so *message* is sent as
+        an ordinary message if it's given.
+        '''
+        if message is None:
+            return None
+        return self._pack_message(message)
+
+    def _reap(self):
+        '''
+        Closes the websocket of a client that stopped responding, with
+        status code 1001. Called by the keepalive thread, so the closing
+        frame is only sent if that doesn't block. The socket is shut down
+        afterwards, which wakes up a view that is blocked reading from or
+        writing to the dead connection.
+        '''
+        if self._write_lock.acquire(False):
+            try:
+                if self.write_buffer is not None:
+                    self.write_buffer.clear()
+                with self._pending_lock:
+                    self._pending.clear()
+                    self._pending_bytes = 0
+                if _wait_writable(self.socket, 0):
+                    self._fail_connection(CLOSE_GOING_AWAY)
+            except SocketError:
+                pass
+            finally:
+                self._write_lock.release()
+        self.closed = True
+        try:
+            self.socket.shutdown(SHUT_RDWR)
+        except SocketError:
+            pass
+
+    def enable_metrics(self, registry=None):
+        '''
+        Counts the traffic of this websocket in ``self.metrics`` and reports
+        it to *registry*, which defaults to the process-wide
+        :data:`django_websocket.metrics.registry`.
+        '''
+        if registry is None:
+            registry = metrics_registry
+        registry.register(self)
+
+    def enable_rate_limit(self, **kwargs):
+        '''
+        Limit the rate of incoming messages and bytes, so that a client that
+        floods the websocket can't keep the view busy. The keyword arguments
+        are passed to :class:`~django_websocket.ratelimit.RateLimiter` and
+        configure the rates, the bursts, the policy for clients that exceed
+        them and a limiter shared with other websockets.
+        '''
+        self.rate_limiter = RateLimiter(**kwargs)
+
+    def enable_write_buffer(self, **kwargs):
+        '''
+        Queue outgoing frames and write them without blocking, so that a slow
+        client doesn't stall the view. The keyword arguments are passed to
+        :class:`~django_websocket.outbound.WriteBuffer` and configure the
+        watermarks and the policy for clients that don't keep up.
+        '''
+        if self.write_buffer is None:
+            self.write_buffer = WriteBuffer(self.socket, **kwargs)
+
+    def enable_coalescing(self, delay=0.005, max_bytes=16 * 1024, cork=False,
+        **kwargs):
+        '''
+        Collect outgoing frames and send them together, to save system calls
+        and TCP segments when many small messages are sent in a row. Frames
+        are sent once ``max_bytes`` are queued, after at most *delay*
+        seconds or when :meth:`flush` is called. With ``cork=True`` the
+        socket is corked while the collected frames are sent (Linux only).
+
+        Coalescing uses the write buffer; the keyword arguments are passed to
+        :meth:`enable_write_buffer` if it isn't enabled yet.
+        '''
+        self.enable_write_buffer(**kwargs)
+        with self._write_lock:
+            self.write_buffer.coalesce_bytes = max_bytes
+            self.write_buffer.cork = cork and set_cork(self.socket, False)
+            self.coalesce_delay = delay
+
+    @property
+    def buffered_amount(self):
+        '''
+        The number of bytes queued in the write buffer.
+        '''
+        if self.write_buffer is None:
+            return 0
+        return self.write_buffer.buffered_amount + self._pending_bytes
+
+    def flush(self, timeout=0):
+        '''
+        Sends data queued in the write buffer, including coalesced frames.
+        Waits up to *timeout* seconds for the buffer to drain, ``None`` waits
+        forever. Returns ``True`` if nothing is queued anymore.
+        '''
+        if self.write_buffer is None:
+            return True
+        with self._write_lock:
+            self._move_pending()
+            return self.write_buffer.flush(timeout)
+
+    def _drain_write_buffer(self, ignore_send_errors=False):
+        '''
+        Gives queued data a chance to reach the client before the connection
+        is closed.
+        '''
+        if self.buffered_amount:
+            try:
+                with self._write_lock:
+                    self._move_pending()
+                    self.write_buffer.flush(self.write_buffer.close_timeout)
+            except SocketError:
+                if not ignore_send_errors:
+                    raise
+
+    def _message_buffers(self, message, binary=False):
+        '''
+        Returns the frame of *message* as a list of buffers that make up the
+        frame when written one after another.
+        '''
+        if binary:
+            self._binary_unsupported()
+        return [b'\x00', _encode_message(message), b'\xff']
+
+    def send_many(self, messages, binary=False):
+        '''
+        Send all messages of the iterable *messages* to the client. The
+        frames are written in batches with a single ``sendmsg`` call each,
+        without copying the payloads into one string. Python 2 has no
+        ``sendmsg``, there the frames of a batch are joined and written with
+        one ``sendall``. A generator is consumed batch by batch, so it
+        doesn't need to fit into memory at once.
+        '''
+        buffers = []
+        count = 0
+        for message in messages:
+            buffers.extend(self._message_buffers(message, binary))
+            count += 1
+            if len(buffers) >= IOV_MAX:
+                self._write_batch(buffers, count)
+                buffers = []
+                count = 0
+        if buffers:
+            self._write_batch(buffers, count)
+
+    def _write_batch(self, buffers, count):
+        metrics = self.metrics
+        if metrics is None:
+            self._write_buffers(buffers)
+            return
+        nbytes = sum(len(buf) for buf in buffers)
+        with self._write_lock:
+            start = time.time()
+            self._write_buffers(buffers)
+            metrics.sent(nbytes, count, time.time() - start)
+
+    def send_stream(self, data, binary=False, chunk_size=STREAM_CHUNK_SIZE):
+        '''
+        Send a message whose payload is read from the file-like object
+        *data*, *chunk_size* bytes at a time, or made up of the chunks of
+        the iterable *data*. The payload is sent as it's read, so it never
+        has to be in memory as a whole. Unicode chunks are encoded as utf-8.
+
+        Other threads can't send messages until the whole message is sent.
+        If reading *data* fails, the connection is closed, as the message
+        can't be completed anymore, and the exception is raised.
+        '''
+        if binary:
+            self._binary_unsupported()
+        with self._write_lock:
+            self._write_batch([b'\x00'], 0)
+            try:
+                for chunk in _stream_chunks(data, chunk_size):
+                    self._write_batch([chunk], 0)
+            except SocketError:
+                raise
+            except Exception:
+                self._abort_stream()
+                raise
+            self._write_batch([b'\xff'], 1)
+
+    def send_file(self, fileobj, offset=0, count=None, binary=True):
+        '''
+        Send *count* bytes of the file *fileobj*, starting at *offset*, as
+        one message; *count* defaults to the rest of the file. The frame
+        header is written first and the payload is then copied by the kernel
+        with ``sendfile``, so it never passes through Python. Where
+        ``socket.sendfile`` isn't available (Python 2), the file is read and
+        sent in chunks instead.
+
+        The file must be opened in binary mode. The hixie framing only
+        supports text messages, which must be valid utf-8. Messages sent
+        this way are never compressed. Data queued in the write buffer is
+        sent first, and the call blocks until the whole message is sent. If
+        the file ends early, the connection is closed, as the message can't
+        be completed anymore, and an ``IOError`` is raised.
+        '''
+        if count is None:
+            count = _file_size(fileobj) - offset
+        header, trailer = self._file_frame(count, binary)
+        metrics = self.metrics
+        if metrics is not None:
+            start = time.time()
+        with self._write_lock:
+            if self.write_buffer is not None:
+                self.write_buffer.flush(None)
+            self.socket.sendall(header)
+            sent = _copy_file(self.socket, fileobj, offset, count)
+            if sent < count:
+                self._abort_connection()
+                raise IOError('The file ended after %d of %d bytes.' %
+                    (sent, count))
+            if trailer:
+                self.socket.sendall(trailer)
+            if metrics is not None:
+                metrics.sent(len(header) + count + len(trailer), 1,
+                    time.time() - start)
+
+    def _file_frame(self, count, binary):
+        '''
+        Returns the bytes that are sent before and after a payload of
+        *count* bytes that is sent by :meth:`send_file`.
+        '''
+        if binary:
+            self._binary_unsupported()
+        return b'\x00', b'\xff'
+
+    def _abort_stream(self):
+        '''
+        Closes the connection in the middle of a message that can't be
+        completed. The hixie framing has no way to end the message early.
+        '''
+        self._abort_connection()
+
+    def _abort_connection(self):
+        '''
+        Shuts the connection down without a closing handshake, which is the
+        only way out in the middle of a frame.
+        '''
+        self.closed = True
+        try:
+            self.socket.shutdown(SHUT_RDWR)
+        except SocketError:
+            pass
 
     def _socket_recv(self):
         '''
         Gets new data from the socket and try to parse new messages.
+
+        The data is read with ``recv_into`` directly into the buffer of the
+        parser. Sockets without ``recv_into`` are read with ``recv``.
         '''
-        delta = self.socket.recv(self._socket_recv_bytes)
-        if delta == '':
+        size = self._recv_size
+        if self._parser.wanted > size:
+            size = min(self._parser.wanted, self._socket_recv_max_bytes)
+        recv_into = getattr(self.socket, 'recv_into', None)
+        if recv_into is None:
+            delta = self.socket.recv(size)
+            received = len(delta)
+            self._parser.feed(delta)
+        else:
+            received = self._parser.recv_into(self.socket, size)
+        if not received:
             return False
-        self._buffer += delta
+        if self.metrics is not None:
+            self.metrics.bytes_in += received
+        self._adapt_recv_size(size, received)
+        # The parser switches streaming off when a streamed message ends.
+        streaming = self._parser.streaming
         msgs = self._parse_message_queue()
+        if self.rate_limiter is not None:
+            msgs = self._rate_limit(received, msgs, streaming)
         self._message_queue.extend(msgs)
+        if self.max_queued_messages is not None and \
+            len(self._message_queue) > self.max_queued_messages:
+            self._fail_connection(CLOSE_POLICY_VIOLATION)
         return True
 
+    def _rate_limit(self, received, msgs, streaming):
+        '''
+        Charges the rate limiter with the *received* bytes and the messages
+        *msgs* parsed from them and returns the messages that are let
+        through. If the parser was *streaming*, *msgs* can contain
+        ``(opcode, chunk, final)`` chunks of a streamed message. The message
+        is charged with its final chunk, but chunks are never dropped, that
+        would corrupt the message.
+        '''
+        if not streaming:
+            admitted = self.rate_limiter.receive(received, len(msgs))
+            if admitted is None:
+                self._fail_connection(CLOSE_POLICY_VIOLATION)
+                return []
+            del msgs[admitted:]
+            return msgs
+        complete = [i for i, msg in enumerate(msgs) if len(msg) == 2]
+        streamed = sum(1 for msg in msgs if len(msg) == 3 and msg[2])
+        admitted = self.rate_limiter.receive(received,
+            len(complete) + streamed)
+        if admitted is None:
+            self._fail_connection(CLOSE_POLICY_VIOLATION)
+            return []
+        # The streamed message is charged first.
+        dropped = set(complete[max(admitted - streamed, 0):])
+        if dropped:
+            msgs = [msg for i, msg in enumerate(msgs) if i not in dropped]
+        return msgs
+
+    def _throttled_recv(self):
+        '''
+        Like :meth:`_socket_recv`, but sleeps first while the rate limiter
+        delays reads.
+        '''
+        if self.rate_limiter is not None:
+            delay = self.rate_limiter.delay()
+            if delay > 0:
+                time.sleep(delay)
+        return self._socket_recv()
+
+    def _adapt_recv_size(self, requested, received):
+        '''
+        A read that filled all of the requested space means that more data is
+        waiting, so the next read asks for twice as much. The read size
+        shrinks again if reads return much less than requested.
+        '''
+        if received == requested:
+            self._recv_size = min(requested * 2, self._socket_recv_max_bytes)
+        elif received < self._recv_size // 4:
+            self._recv_size = max(self._recv_size // 2,
+                self._socket_recv_bytes)
+
     def _socket_can_recv(self, timeout=0.0):
         '''
         Return ``True`` if new data can be read from the socket.
@@ -204,7 +948,7 @@ class WebSocket(object):
         r, w, e = [self.socket], [], []
         try:
             r, w, e = select.select(r, w, e, timeout)
-        except select.error, err:
+        except select.error as err:
             if err.args[0] == EINTR:
                 return False
             raise
@@ -212,7 +956,11 @@ class WebSocket(object):
 
     def _get_new_messages(self):
         # read as long from socket as we need to get a new message.
+        limiter = self.rate_limiter
         while self._socket_can_recv():
+            if limiter is not None and limiter.delay() > 0:
+                # The data stays in the socket until reads are allowed again.
+                return
             self._socket_recv()
             if self._message_queue:
                 return
@@ -241,24 +989,96 @@ class WebSocket(object):
         Return new message or ``fallback`` if no message is available.
         '''
         if self.has_messages():
-            return self._message_queue.popleft()
+            return self._decode_message(self._message_queue.popleft())
         return fallback
 
-    def wait(self):
+    def read_bytes(self, fallback=None):
         '''
-        Waits for and deserializes messages. Returns a single message; the
-        oldest not yet processed.
+        Like :meth:`read`, but returns text messages as utf-8 encoded byte
+        string without decoding them.
         '''
+        if self.has_messages():
+            return self._message_queue.popleft()[1]
+        return fallback
+
+    def _wait(self):
         while not self._message_queue:
             # Websocket might be closed already.
             if self.closed:
                 return None
             # no parsed messages, must mean buf needs more data
-            new_data = self._socket_recv()
+            new_data = self._throttled_recv()
             if not new_data:
                 return None
         return self._message_queue.popleft()
 
+    def wait(self):
+        '''
+        Waits for and deserializes messages. Returns a single message; the
+        oldest not yet processed.
+        '''
+        message = self._wait()
+        if message is None:
+            return None
+        return self._decode_message(message)
+
+    def wait_bytes(self):
+        '''
+        Like :meth:`wait`, but returns text messages as utf-8 encoded byte
+        string without decoding them. Useful for views that pass messages on
+        to ``json.loads`` or another websocket.
+        '''
+        message = self._wait()
+        if message is None:
+            return None
+        return message[1]
+
+    def wait_stream(self):
+        '''
+        Waits for the next message and yields its payload in chunks as they
+        are received, so that large messages never have to be in memory as
+        a whole. Text messages are yielded as utf-8 encoded byte strings,
+        like by :meth:`wait_bytes`. Nothing is yielded if the websocket gets
+        closed; check ``closed`` to tell that from an empty message.
+
+        A message that was received completely before is yielded as one
+        chunk. If the iteration is stopped early, the rest of the message is
+        read and dropped. Streamed messages aren't limited by
+        ``max_message_size``.
+        '''
+        if self._message_queue:
+            yield self._message_queue.popleft()[1]
+            return
+        self._parser.streaming = True
+        try:
+            while True:
+                while not self._message_queue:
+                    if self.closed or not self._throttled_recv():
+                        return
+                opcode, chunk, final = self._message_queue.popleft()
+                if chunk:
+                    yield chunk
+                if final:
+                    return
+        finally:
+            self._skip_stream()
+
+    def _skip_stream(self):
+        '''
+        Drops the rest of a streamed message that wasn't read to the end
+        and switches streaming off.
+        '''
+        queue = self._message_queue
+        while True:
+            while queue and len(queue[0]) == 3:
+                if queue.popleft()[2]:
+                    return
+            if not self._parser.in_stream:
+                self._parser.streaming = False
+                return
+            if self.closed or not self._throttled_recv():
+                return
+
     def __iter__(self):
         '''
         Use ``WebSocket`` as iterator. Iteration only stops when the websocket
@@ -276,16 +1096,165 @@ class WebSocket(object):
         '''
         if self.version == 76 and not self.closed:
             try:
-                self.socket.sendall("\xff\x00")
+                self._write("\xff\x00")
             except SocketError:
                 # Sometimes, like when the remote side cuts off the connection,
                 # we don't care about this.
                 if not ignore_send_errors:
                     raise
             self.closed = True
+        self._drain_write_buffer(ignore_send_errors)
 
     def close(self):
         '''
         Forcibly close the websocket.
         '''
         self._send_closing_frame()
+
+
+class HybiWebSocket(WebSocket):
+    """
+    A :class:`WebSocket` that uses the framing of RFC 6455, which is spoken
+    by all current browsers. Pings are answered automatically and a close
+    frame of the client is echoed before the websocket is marked as closed.
+    """
+
+    def __init__(self, socket, protocol, version=13,
+        handshake_reply=None, handshake_sent=None, deflate=None, **kwargs):
+        '''
+        Takes the same arguments as :class:`WebSocket`, plus:
+
+        - ``deflate``: A :class:`~django_websocket.deflate.PerMessageDeflate`
+          instance if the permessage-deflate extension was negotiated.
+        '''
+        self.deflate = deflate
+        super(HybiWebSocket, self).__init__(socket, protocol, version,
+            handshake_reply, handshake_sent, **kwargs)
+        self.close_code = None
+
+    def _create_parser(self):
+        return HybiParser(deflate=self.deflate,
+            max_message_size=self.max_message_size,
+            max_buffer_size=self.max_buffer_size)
+
+    @classmethod
+    def _pack_message(cls, message):
+        """Pack the message into a single text frame.
+
+        As per the base framing protocol section (5.2) of RFC 6455.
+        """
+        return pack_hybi_frame(OPCODE_TEXT, _encode_message(message))
+
+    def _frame_buffers(self, opcode, payload):
+        '''
+        Returns header and payload of a frame for *payload*, which is
+        compressed if the permessage-deflate extension is in use and the
+        payload is not below its minimum size.
+        '''
+        compressed = False
+        if self.deflate is not None and len(payload) >= self.deflate.min_size:
+            payload = self.deflate.compress(payload)
+            compressed = True
+        return [pack_hybi_header(opcode, len(payload), rsv1=compressed),
+            payload]
+
+    def _pack_frame(self, opcode, payload):
+        return b''.join(self._frame_buffers(opcode, payload))
+
+    def _message_buffers(self, message, binary=False):
+        opcode = OPCODE_BINARY if binary else OPCODE_TEXT
+        return self._frame_buffers(opcode, _encode_message(message))
+
+    def send(self, message, binary=False):
+        '''
+        Send a message to the client. *message* should be convertable to a
+        string; unicode objects should be encodable as utf-8.
+
+        Pass ``binary=True`` to send *message* as binary message.
+        '''
+        opcode = OPCODE_BINARY if binary else OPCODE_TEXT
+        self._write(self._pack_frame(opcode, _encode_message(message)))
+
+    def send_stream(self, data, binary=False, chunk_size=STREAM_CHUNK_SIZE):
+        '''
+        Send a message whose payload is read from the file-like object
+        *data*, *chunk_size* bytes at a time, or made up of the chunks of
+        the iterable *data*. Every chunk is sent as a frame of a fragmented
+        message as soon as it's read, so the payload never has to be in
+        memory as a whole. Unicode chunks are encoded as utf-8.
+
+        Other threads can't send messages until the whole message is sent.
+        If reading *data* fails, the connection is closed with status code
+        1011 and the exception is raised.
+        '''
+        opcode = OPCODE_BINARY if binary else OPCODE_TEXT
+        compressed = self.deflate is not None
+        chunks = _stream_chunks(data, chunk_size)
+        with self._write_lock:
+            try:
+                chunk = next(chunks, b'')
+                while True:
+                    following = next(chunks, None)
+                    final = following is None
+                    if compressed:
+                        chunk = self.deflate.compress_stream(chunk, final)
+                    self._write_batch([
+                        pack_hybi_header(opcode, len(chunk), fin=final,
+                            rsv1=compressed and opcode != OPCODE_CONTINUATION),
+                        chunk], 1)
+                    if final:
+                        return
+                    opcode = OPCODE_CONTINUATION
+                    chunk = following
+            except SocketError:
+                raise
+            except Exception:
+                self._abort_stream()
+                raise
+
+    def _file_frame(self, count, binary):
+        opcode = OPCODE_BINARY if binary else OPCODE_TEXT
+        return pack_hybi_header(opcode, count), b''
+
+    def _abort_stream(self):
+        self._fail_connection(CLOSE_INTERNAL_ERROR)
+
+    def _keepalive_frame(self, message):
+        return pack_hybi_frame(OPCODE_PING, b'')
+
+    def release_compression(self):
+        '''
+        Frees the memory of the compression contexts as far as possible. Call
+        it for connections that are idle.
+        '''
+        if self.deflate is not None:
+            self.deflate.release()
+
+    def _handle_control_frame(self, opcode, payload):
+        if opcode == OPCODE_PING:
+            self._write(pack_hybi_frame(OPCODE_PONG, payload))
+        elif opcode == OPCODE_CLOSE:
+            self.close_code, reason = unpack_close_payload(payload)
+            self._send_closing_frame(True, code=self.close_code)
+
+    def _fail_connection(self, code):
+        self._send_closing_frame(True, code=code)
+
+    def _send_closing_frame(self, ignore_send_errors=False,
+        code=CLOSE_NORMAL, reason=''):
+        '''
+        Sends a close frame with status *code* to the client, if required.
+        No status is included if *code* is ``None``.
+        '''
+        if not self.closed:
+            if code is None:
+                payload = ''
+            else:
+                payload = pack_close_payload(code, reason)
+            try:
+                self._write(pack_hybi_frame(OPCODE_CLOSE, payload))
+            except SocketError:
+                if not ignore_send_errors:
+                    raise
+            self.closed = True
+        self._drain_write_buffer(ignore_send_errors)
@@ -0,0 +1,291 @@
+'''
+Tests of the modules for asyncio, which need Python 3 and a Django version
+that runs on it. The Django test runner of the other tests doesn't find
+them, run them with::
+
+    python3 -m django_websocket_tests.asynctests
+'''
+import os
+import socket
+import sys
+import unittest
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE',
+    'django_websocket_tests.settings')
+
+if sys.version_info >= (3, 4):
+    import asyncio
+    from django_websocket.aio import AsyncWebSocket
+    from django_websocket.asgi import ASGIWebSocket, WebSocketASGIHandler
+    from django_websocket.broadcast import Broadcaster
+    from django_websocket.framing import OPCODE_TEXT as TEXT, \
+        OPCODE_BINARY as BINARY, OPCODE_CLOSE as CLOSE, pack_hybi_frame, \
+        pack_close_payload
+    try:
+        from asgiref.compatibility import guarantee_single_callable, \
+            is_double_callable
+    except ImportError: #pragma NO COVER
+        is_double_callable = None
+
+
+class ASGIServer(object):
+    '''
+    Plays the server in the ASGI websocket protocol for one connection to
+    *application*.
+    '''
+
+    def __init__(self, loop, application, path, type='websocket'):
+        self.loop = loop
+        self.incoming = asyncio.Queue()
+        self.outgoing = asyncio.Queue()
+        scope = {
+            'type': type,
+            'path': path,
+            'query_string': b'',
+            'headers': [(b'host', b'testserver')],
+            'subprotocols': [],
+        }
+        self.task = asyncio.ensure_future(
+            application(scope, self.incoming.get, self.outgoing.put))
+
+    def send(self, event):
+        self.incoming.put_nowait(event)
+
+    def receive(self, timeout=5):
+        return self.loop.run_until_complete(
+            asyncio.wait_for(self.outgoing.get(), timeout))
+
+    def finish(self, timeout=5):
+        return self.loop.run_until_complete(
+            asyncio.wait_for(self.task, timeout))
+
+
+@unittest.skipIf(sys.version_info < (3, 4), 'asyncio is needed')
+class AsyncTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+
+def client_frame(opcode, payload):
+    return pack_hybi_frame(opcode, payload, mask=b'\x37\xfa\x21\x3d')
+
+
+class AsyncWebSocketTests(AsyncTestCase):
+    def setUp(self):
+        super(AsyncWebSocketTests, self).setUp()
+        self.errors = []
+        self.loop.set_exception_handler(
+            lambda loop, context: self.errors.append(context))
+        self.websocket = self.connect()
+
+    def connect(self, **kwargs):
+        if hasattr(self, 'websocket'):
+            self.resolve(self.websocket.close())
+            self.client.close()
+        server, self.client = socket.socketpair()
+        self.client.settimeout(5)
+        reader, writer = self.loop.run_until_complete(
+            asyncio.open_connection(sock=server))
+        return AsyncWebSocket(reader, writer, **kwargs)
+
+    def tearDown(self):
+        self.resolve(self.websocket.close())
+        self.client.close()
+        self.assertEqual(self.errors, [])
+        super(AsyncWebSocketTests, self).tearDown()
+
+    def resolve(self, awaitable, timeout=5):
+        return self.loop.run_until_complete(
+            asyncio.wait_for(awaitable, timeout))
+
+    def test_echo(self):
+        self.client.sendall(client_frame(TEXT, u'K\xfcss'.encode('utf-8')) +
+            client_frame(BINARY, b'\x00\xff'))
+        message = self.resolve(self.websocket.wait())
+        self.assertEqual(message, u'K\xfcss')
+        self.resolve(self.websocket.send(message))
+        message = self.resolve(self.websocket.__anext__())
+        self.assertEqual(message, b'\x00\xff')
+        self.resolve(self.websocket.send(message, binary=True))
+        self.assertEqual(self.client.recv(1024),
+            pack_hybi_frame(TEXT, u'K\xfcss'.encode('utf-8')) +
+            pack_hybi_frame(BINARY, b'\x00\xff'))
+
+    def test_iteration_stops_when_closed(self):
+        self.client.sendall(client_frame(TEXT, b'spam') +
+            client_frame(CLOSE, pack_close_payload(1000)))
+        self.assertEqual(self.resolve(self.websocket.__anext__()), u'spam')
+        self.assertRaises(StopAsyncIteration, self.resolve,
+            self.websocket.__anext__())
+        self.assertTrue(self.websocket.closed)
+        self.assertEqual(self.websocket.close_code, 1000)
+        self.assertEqual(self.client.recv(1024),
+            pack_hybi_frame(CLOSE, pack_close_payload(1000)))
+        # Iterating again stops right away, wait() resolves to None.
+        self.assertRaises(StopAsyncIteration, self.resolve,
+            self.websocket.__anext__())
+        self.assertEqual(self.resolve(self.websocket.wait()), None)
+
+    def test_iteration_stops_on_eof(self):
+        waiter = self.websocket.__anext__()
+        self.client.close()
+        self.assertRaises(StopAsyncIteration, self.resolve, waiter)
+
+    def test_invalid_frame(self):
+        self.websocket = self.connect(version=76)
+        # a frame of an unknown type
+        self.client.sendall(b'\x00spam\xff\x80\x05hello')
+        self.assertEqual(self.resolve(self.websocket.wait()), None)
+        self.assertTrue(self.websocket.closed)
+        # the closing frame is sent and the connection closed
+        self.assertEqual(self.client.recv(1024), b'\xff\x00')
+        self.assertEqual(self.client.recv(1024), b'')
+
+    def test_reading_pauses_while_messages_are_queued(self):
+        self.websocket = self.connect(max_queued_messages=2)
+        self.client.sendall(client_frame(TEXT, b'one') +
+            client_frame(TEXT, b'two'))
+        self.assertEqual(self.resolve(self.websocket.wait()), u'one')
+        self.client.sendall(client_frame(TEXT, b'three'))
+        self.resolve(asyncio.sleep(0.05))
+        self.client.sendall(client_frame(TEXT, b'four'))
+        self.resolve(asyncio.sleep(0.05))
+        self.assertEqual(self.resolve(self.websocket.count_messages()), 2)
+        self.assertTrue(self.websocket._reading is None)
+        # the application reads, so reading resumes
+        self.assertEqual(self.resolve(self.websocket.read()), u'two')
+        self.resolve(asyncio.sleep(0.05))
+        self.assertEqual(self.resolve(self.websocket.count_messages()), 2)
+        self.assertEqual([self.resolve(self.websocket.wait())
+            for i in range(2)], [u'three', u'four'])
+        self.assertFalse(self.websocket.closed)
+
+    def test_cancelled_iteration(self):
+        for wait in (self.websocket.__anext__, self.websocket.wait):
+            self.assertRaises(asyncio.TimeoutError, self.resolve, wait(),
+                timeout=0.01)
+            # The message goes to the next waiter, not the cancelled one.
+            self.client.sendall(client_frame(TEXT, b'spam'))
+            self.assertEqual(self.resolve(wait()), u'spam')
+            self.assertEqual(self.resolve(self.websocket.count_messages()), 0)
+
+
+class WebSocketASGIHandlerTests(AsyncTestCase):
+    def setUp(self):
+        super(WebSocketASGIHandlerTests, self).setUp()
+        self.handler = WebSocketASGIHandler(max_workers=2)
+
+    def tearDown(self):
+        self.handler.executor.shutdown()
+        super(WebSocketASGIHandlerTests, self).tearDown()
+
+    def test_echo(self):
+        server = ASGIServer(self.loop, self.handler, '/echo/')
+        server.send({'type': 'websocket.connect'})
+        self.assertEqual(server.receive(), {'type': 'websocket.accept'})
+        server.send({'type': 'websocket.receive', 'text': u'K\xfcss'})
+        self.assertEqual(server.receive(),
+            {'type': 'websocket.send', 'text': u'K\xfcss'})
+        server.send({'type': 'websocket.receive', 'bytes': b'\x00\xff'})
+        self.assertEqual(server.receive(),
+            {'type': 'websocket.send', 'bytes': b'\x00\xff'})
+        server.send({'type': 'websocket.disconnect', 'code': 1000})
+        self.assertEqual(server.finish(), None)
+        self.assertTrue(server.outgoing.empty())
+
+    def test_view_closes(self):
+        server = ASGIServer(self.loop, self.handler, '/echo-once/')
+        server.send({'type': 'websocket.connect'})
+        self.assertEqual(server.receive(), {'type': 'websocket.accept'})
+        server.send({'type': 'websocket.receive', 'text': u'spam'})
+        self.assertEqual(server.receive(),
+            {'type': 'websocket.send', 'text': u'spam'})
+        self.assertEqual(server.receive(),
+            {'type': 'websocket.close', 'code': 1000})
+        self.assertEqual(server.finish(), None)
+
+    def test_streams(self):
+        server = ASGIServer(self.loop, self.handler, '/stream/')
+        server.send({'type': 'websocket.connect'})
+        self.assertEqual(server.receive(), {'type': 'websocket.accept'})
+        server.send({'type': 'websocket.receive', 'text': u'K\xfcss'})
+        self.assertEqual(server.receive(),
+            {'type': 'websocket.send', 'bytes': b'K\xc3\xbcss'})
+        self.assertEqual(server.receive(),
+            {'type': 'websocket.send', 'bytes': b'\xc3\xbcss'})
+        self.assertEqual(server.receive(),
+            {'type': 'websocket.close', 'code': 1000})
+        self.assertEqual(server.finish(), None)
+
+    def test_rejected(self):
+        # the view doesn't accept websockets
+        server = ASGIServer(self.loop, self.handler, '/plain/')
+        server.send({'type': 'websocket.connect'})
+        self.assertEqual(server.receive(),
+            {'type': 'websocket.close', 'code': 1001})
+        self.assertEqual(server.finish(), None)
+
+    def test_disconnect_before_connect(self):
+        server = ASGIServer(self.loop, self.handler, '/echo/')
+        server.send({'type': 'websocket.disconnect', 'code': 1006})
+        self.assertEqual(server.finish(), None)
+        self.assertTrue(server.outgoing.empty())
+
+    def test_other_scopes(self):
+        calls = []
+        self.handler.application = lambda scope, receive, send: \
+            calls.append(scope['type'])
+        self.handler({'type': 'http'}, None, None)
+        self.assertEqual(calls, ['http'])
+        self.handler.application = None
+        self.assertRaises(ValueError, self.handler, {'type': 'http'},
+            None, None)
+
+    @unittest.skipIf(sys.version_info >= (3, 4) and is_double_callable is None,
+        'asgiref is needed')
+    def test_protocol_detection(self):
+        self.assertFalse(is_double_callable(self.handler))
+        application = guarantee_single_callable(self.handler)
+        self.assertTrue(application is self.handler)
+        server = ASGIServer(self.loop, application, '/echo/')
+        server.send({'type': 'websocket.connect'})
+        self.assertEqual(server.receive(), {'type': 'websocket.accept'})
+        server.send({'type': 'websocket.disconnect', 'code': 1000})
+        self.assertEqual(server.finish(), None)
+
+
+class ASGIWebSocketTests(AsyncTestCase):
+    def test_broadcast(self):
+        outgoing = asyncio.Queue()
+        websocket = ASGIWebSocket(self.loop, None, outgoing.put)
+        websocket.max_queued_sends = 2
+        broadcaster = Broadcaster()
+        broadcaster.add('news', websocket)
+        # the events are sent by the event loop
+        for message in (u'K\xfcss', u'spam'):
+            self.assertEqual(broadcaster.broadcast('news', message), 1)
+        # the server didn't take the other events yet
+        self.assertEqual(broadcaster.broadcast('news', u'eggs'), 0)
+        self.assertTrue(websocket.closed)
+        self.assertEqual(broadcaster.members('news'), [])
+        for message in (u'K\xfcss', u'spam'):
+            self.assertEqual(self.loop.run_until_complete(
+                asyncio.wait_for(outgoing.get(), 5)),
+                {'type': 'websocket.send', 'text': message})
+        self.assertTrue(outgoing.empty())
+
+
+def main():
+    import django
+    if hasattr(django, 'setup'):
+        django.setup()
+    unittest.main(module=__name__)
+
+
+if __name__ == '__main__':
+    main()
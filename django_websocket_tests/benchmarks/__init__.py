@@ -0,0 +1,102 @@
+'''
+Micro-benchmarks for django-websocket. Every module in this package can be
+run on its own, e.g.::
+
+    python -m django_websocket_tests.benchmarks.parser
+
+or all of them, or a selection, with the results written to a JSON file as
+well, to compare them between revisions::
+
+    python -m django_websocket_tests.benchmarks --json results.json echo
+    python manage.py websocket_benchmark --json results.json echo
+'''
+import json
+import os
+import platform
+import sys
+import time
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'django_websocket_tests.settings')
+
+from django_websocket.loadtest import percentile
+
+
+BENCHMARKS = ('parser', 'unmask', 'messages', 'handshake', 'recv', 'echo',
+    'deflate', 'broadcast', 'timers', 'middleware', 'coalesce', 'sendfile',
+    'pubsub', 'replay', 'ratelimit', 'sendmany')
+
+# Results of all ``report()`` calls, collected by ``run()``.
+results = []
+_current = None
+
+
+def measure(func, repeat=3):
+    '''
+    Calls ``func`` ``repeat`` times and returns the best wall clock time in
+    seconds.
+    '''
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def report(name, seconds, items=None, nbytes=None, latencies=None):
+    '''
+    Writes one result line with the elapsed time and, if given, the item and
+    byte throughput and the median and 99th percentile of the list
+    *latencies* in seconds to stdout.
+    '''
+    result = {'benchmark': _current, 'name': name, 'seconds': seconds}
+    line = '%-60s %10.2f ms' % (name, seconds * 1000)
+    if items is not None:
+        result['items_per_second'] = items / seconds
+        line += '  %12.0f items/s' % (items / seconds)
+    if nbytes is not None:
+        result['mb_per_second'] = nbytes / seconds / 1024 / 1024
+        line += '  %9.1f MB/s' % (nbytes / seconds / 1024 / 1024)
+    if latencies:
+        result['p50_ms'] = percentile(latencies, 50) * 1000
+        result['p99_ms'] = percentile(latencies, 99) * 1000
+        line += '  p50 %7.3f ms  p99 %7.3f ms' % (
+            result['p50_ms'], result['p99_ms'])
+    results.append(result)
+    sys.stdout.write(line + '\n')
+
+
+def run(names=None, output=None):
+    '''
+    Runs the benchmark modules *names*, all of :data:`BENCHMARKS` by
+    default, and returns their results. If *output* is a file object, the
+    results are written to it as JSON, together with the Python version and
+    platform they were measured on.
+    '''
+    global _current
+    if not names:
+        names = BENCHMARKS
+    del results[:]
+    for name in names:
+        if name not in BENCHMARKS:
+            raise ValueError('Unknown benchmark: %s' % name)
+        module = __import__('django_websocket_tests.benchmarks.' + name,
+            fromlist=['main'])
+        _current = name
+        sys.stdout.write('# %s\n' % name)
+        try:
+            module.main()
+        finally:
+            _current = None
+    if output is not None:
+        json.dump({
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'results': results,
+        }, output, indent=2, sort_keys=True)
+        output.write('\n')
+    return list(results)
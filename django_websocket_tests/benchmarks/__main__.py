@@ -0,0 +1,27 @@
+'''
+Runs the benchmarks given on the command line, or all of them::
+
+    python -m django_websocket_tests.benchmarks [--json FILE] [name ...]
+'''
+from optparse import OptionParser
+from django_websocket_tests.benchmarks import BENCHMARKS, run
+
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [--json FILE] [benchmark ...]',
+        description='Available benchmarks: %s' % ', '.join(BENCHMARKS))
+    parser.add_option('--json', dest='json', metavar='FILE',
+        help='Write the results as JSON to FILE.')
+    options, names = parser.parse_args(argv)
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error('Unknown benchmark: %s' % name)
+    if options.json is None:
+        run(names)
+    else:
+        with open(options.json, 'w') as output:
+            run(names, output)
+
+
+if __name__ == '__main__':
+    main()
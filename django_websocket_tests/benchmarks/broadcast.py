@@ -0,0 +1,55 @@
+'''
+Measures the fan-out rate of :class:`~django_websocket.broadcast.Broadcaster`
+for a group of 10,000 members, compared with calling ``send()`` on every
+member. The sockets only count the written bytes, so the numbers show the
+overhead of encoding, framing and bookkeeping.
+'''
+from django_websocket_tests.benchmarks import measure, report
+from django_websocket.broadcast import Broadcaster
+from django_websocket.websocket import WebSocket, HybiWebSocket
+
+
+class NullSocket(object):
+    def __init__(self):
+        self.bytes_sent = 0
+
+    def sendall(self, data):
+        self.bytes_sent += len(data)
+
+    def gettimeout(self):
+        return None
+
+    def send(self, data, flags=0):
+        self.bytes_sent += len(data)
+        return len(data)
+
+
+MEMBERS = 10000
+MESSAGES = 10
+MESSAGE = u'{"event": "notification", "text": "Gr\xfc\xdfe aus Wien"}'
+
+
+def main():
+    for cls in (WebSocket, HybiWebSocket):
+        websockets = [cls(NullSocket(), None) for i in range(MEMBERS)]
+        broadcaster = Broadcaster()
+        for websocket in websockets:
+            broadcaster.add('news', websocket)
+
+        def send_each():
+            for i in range(MESSAGES):
+                for websocket in websockets:
+                    websocket.send(MESSAGE)
+
+        def broadcast():
+            for i in range(MESSAGES):
+                broadcaster.broadcast('news', MESSAGE)
+
+        for func in (send_each, broadcast):
+            report('%s: %s to %d members' % (
+                cls.__name__, func.__name__, MEMBERS),
+                measure(func), items=MEMBERS * MESSAGES)
+
+
+if __name__ == '__main__':
+    main()
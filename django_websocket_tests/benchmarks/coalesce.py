@@ -0,0 +1,76 @@
+'''
+Sends bursts of small messages over a TCP connection on the loopback
+interface, without and with coalescing (see ``WebSocket.enable_coalescing``),
+and reports the message throughput and how many ``recv`` calls the client
+needed, which roughly follows the number of TCP segments.
+'''
+import socket
+import threading
+import time
+from django_websocket_tests.benchmarks import report
+from django_websocket.outbound import flusher
+from django_websocket.websocket import HybiWebSocket
+
+
+MESSAGES = 50000
+SIZES = (16, 128)
+
+MODES = (
+    ('no coalescing', None),
+    ('coalescing', {}),
+    ('coalescing with TCP_CORK', {'cork': True}),
+)
+
+
+def tcp_pair():
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    client = socket.create_connection(listener.getsockname())
+    server, address = listener.accept()
+    listener.close()
+    return server, client
+
+
+def read(sock, size, counts):
+    received = 0
+    calls = 0
+    while received < size:
+        data = sock.recv(256 * 1024)
+        if not data:
+            break
+        received += len(data)
+        calls += 1
+    counts.append(calls)
+
+
+def main():
+    for size in SIZES:
+        message = b'x' * size
+        # Frames of up to 125 bytes have a two byte header.
+        total = MESSAGES * (size + 2)
+        for name, options in MODES:
+            server, client = tcp_pair()
+            websocket = HybiWebSocket(server, None)
+            if options is not None:
+                websocket.enable_coalescing(**options)
+            counts = []
+            reader = threading.Thread(target=read,
+                args=(client, total, counts))
+            reader.start()
+            start = time.time()
+            for i in range(MESSAGES):
+                websocket.send(message, binary=True)
+            websocket.flush(timeout=None)
+            reader.join()
+            seconds = time.time() - start
+            report('%d byte messages, %s (%d recv calls)' % (
+                size, name, counts[0]), seconds, items=MESSAGES,
+                nbytes=total)
+            server.close()
+            client.close()
+    flusher.stop()
+
+
+if __name__ == '__main__':
+    main()
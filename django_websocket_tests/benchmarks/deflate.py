@@ -0,0 +1,77 @@
+'''
+Measures what permessage-deflate saves in bytes and costs in CPU time for a
+stream of JSON push messages, with different window sizes, memory levels and
+with and without context takeover.
+'''
+import json
+import random
+import sys
+from django_websocket_tests.benchmarks import measure, report
+from django_websocket.deflate import PerMessageDeflate
+
+
+CONFIGURATIONS = (
+    ('window 15, takeover', {}),
+    ('window 15, no takeover', {'server_context_takeover': False,
+        'client_context_takeover': False}),
+    ('window 10, mem level 4, takeover', {'server_window_bits': 10,
+        'client_window_bits': 10, 'mem_level': 4}),
+    ('window 10, mem level 4, no takeover', {'server_window_bits': 10,
+        'client_window_bits': 10, 'mem_level': 4,
+        'server_context_takeover': False, 'client_context_takeover': False}),
+)
+
+MESSAGE_SIZES = (100, 1000, 10000)
+COUNT = 2000
+
+
+def make_messages(size, count):
+    rnd = random.Random(size)
+    messages = []
+    for i in range(count):
+        items = []
+        message = ''
+        while len(message) < size:
+            items.append({
+                'id': rnd.randint(1, 100000),
+                'user': 'user%d' % rnd.randint(1, 500),
+                'status': rnd.choice(('online', 'away', 'offline')),
+                'score': round(rnd.random() * 100, 2),
+            })
+            message = json.dumps({'event': 'update', 'items': items})
+        messages.append(message)
+    return messages
+
+
+def main():
+    for size in MESSAGE_SIZES:
+        messages = make_messages(size, COUNT)
+        raw_bytes = sum(len(message) for message in messages)
+        for name, options in CONFIGURATIONS:
+            deflate = PerMessageDeflate(**options)
+            compressed = [deflate.compress(message) for message in messages]
+            compressed_bytes = sum(len(data) for data in compressed)
+
+            def compress():
+                deflate = PerMessageDeflate(**options)
+                for message in messages:
+                    deflate.compress(message)
+
+            def decompress():
+                deflate = PerMessageDeflate(**options)
+                for data in compressed:
+                    deflate.decompress(data)
+
+            label = '%d bytes, %s' % (size, name)
+            report('compress: ' + label, measure(compress),
+                items=COUNT, nbytes=raw_bytes)
+            report('decompress: ' + label, measure(decompress),
+                items=COUNT, nbytes=raw_bytes)
+            sys.stdout.write('%-60s %10.1f %% of raw size, %.1fx\n' % (
+                'saved: ' + label,
+                100.0 * compressed_bytes / raw_bytes,
+                float(raw_bytes) / compressed_bytes))
+
+
+if __name__ == '__main__':
+    main()
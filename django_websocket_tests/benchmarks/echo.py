@@ -0,0 +1,89 @@
+'''
+End-to-end echo over ``socket.socketpair()``: every connection is served by
+a ``HybiWebSocket`` in its own thread, the way a view serves it, which sends
+back every message it receives. One client thread sends a masked frame on
+every connection, then reads all echoes, and repeats.
+
+Reports the echoed messages per second and the median and 99th percentile
+of the round trip time of a message, for a range of message sizes and
+connection counts.
+'''
+import socket
+import threading
+import time
+from django_websocket_tests.benchmarks import report
+from django_websocket.framing import HybiParser, OPCODE_TEXT, OPCODE_CLOSE, \
+    pack_hybi_frame, pack_close_payload
+from django_websocket.websocket import HybiWebSocket
+
+
+SIZES = ((16, 20000), (1024, 20000), (64 * 1024, 1000))
+CONNECTIONS = (1, 10, 100)
+
+
+def serve(websocket):
+    for message in websocket:
+        websocket.send(message)
+
+
+class Client(object):
+    def __init__(self):
+        self.socket, server = socket.socketpair()
+        self.parser = HybiParser(mask_required=False)
+        self.websocket = HybiWebSocket(server, None)
+        self.thread = threading.Thread(target=serve, args=(self.websocket,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def receive(self):
+        while True:
+            frames = self.parser.parse()
+            if frames:
+                return frames
+            if not self.parser.recv_into(self.socket, 64 * 1024):
+                raise EOFError('The server closed the connection.')
+
+    def close(self):
+        self.socket.sendall(pack_hybi_frame(OPCODE_CLOSE,
+            pack_close_payload(1000), mask=b'abcd'))
+        while not any(opcode == OPCODE_CLOSE
+            for opcode, payload in self.receive()):
+            pass
+        self.thread.join()
+        self.socket.close()
+        self.websocket.socket.close()
+
+
+def echo(clients, frame, rounds):
+    latencies = []
+    for i in range(rounds):
+        sent = []
+        for client in clients:
+            sent.append(time.time())
+            client.socket.sendall(frame)
+        for client, begin in zip(clients, sent):
+            client.receive()
+            latencies.append(time.time() - begin)
+    return latencies
+
+
+def main():
+    for size, count in SIZES:
+        frame = pack_hybi_frame(OPCODE_TEXT, b'x' * size, mask=b'abcd')
+        for connections in CONNECTIONS:
+            clients = [Client() for i in range(connections)]
+            rounds = max(count // connections, 1)
+            # Warm up the threads and the receive buffers.
+            echo(clients, frame, 1)
+            start = time.time()
+            latencies = echo(clients, frame, rounds)
+            seconds = time.time() - start
+            for client in clients:
+                client.close()
+            report('echo: %d bytes, %d connections' % (size, connections),
+                seconds, items=len(latencies),
+                nbytes=len(latencies) * size, latencies=latencies)
+
+
+if __name__ == '__main__':
+    main()
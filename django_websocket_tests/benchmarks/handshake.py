@@ -0,0 +1,127 @@
+'''
+Measures the latency of ``setup_websocket`` for upgrade requests of every
+supported protocol version, from the request headers to the websocket with
+its handshake reply. The socket of the request is a real one, so the cost
+of duplicating it is included.
+
+The processing of the keys alone, the hixie-76 key numbers and the RFC 6455
+accept key, is compared to the implementation that built the digits one
+character at a time and validated keys with the ``base64`` module.
+'''
+import base64
+import binascii
+import socket
+import string
+import time
+from hashlib import sha1
+from django.test.client import RequestFactory
+from django_websocket_tests.benchmarks import measure, report
+from django_websocket.websocket import HYBI_GUID, setup_websocket, \
+    _accept_key, _extract_number
+
+
+HANDSHAKES = 5000
+KEYS = 100000
+
+REQUESTS = (
+    ('hixie-75', {
+        'HTTP_CONNECTION': 'Upgrade',
+        'HTTP_UPGRADE': 'WebSocket',
+        'HTTP_ORIGIN': 'http://example.com',
+    }, None),
+    ('hixie-76', {
+        'HTTP_CONNECTION': 'Upgrade',
+        'HTTP_UPGRADE': 'WebSocket',
+        'HTTP_ORIGIN': 'http://example.com',
+        'HTTP_SEC_WEBSOCKET_KEY1': '4 @1  46546xW%0l 1 5',
+        'HTTP_SEC_WEBSOCKET_KEY2': '12998 5 Y3 1  .P00',
+    }, None),
+    ('rfc6455', {
+        'HTTP_CONNECTION': 'keep-alive, Upgrade',
+        'HTTP_UPGRADE': 'websocket',
+        'HTTP_SEC_WEBSOCKET_VERSION': '13',
+        'HTTP_SEC_WEBSOCKET_KEY': 'dGhlIHNhbXBsZSBub25jZQ==',
+    }, None),
+    ('rfc6455 with permessage-deflate', {
+        'HTTP_CONNECTION': 'keep-alive, Upgrade',
+        'HTTP_UPGRADE': 'websocket',
+        'HTTP_SEC_WEBSOCKET_VERSION': '13',
+        'HTTP_SEC_WEBSOCKET_KEY': 'dGhlIHNhbXBsZSBub25jZQ==',
+        'HTTP_SEC_WEBSOCKET_EXTENSIONS':
+            'permessage-deflate; client_max_window_bits',
+    }, {}),
+)
+
+
+class Input(object):
+    '''
+    The ``wsgi.input`` of a request: the socket of the connection plus the
+    eight bytes of the hixie-76 challenge.
+    '''
+    def __init__(self, sock):
+        self._sock = sock
+
+    def read(self, size):
+        return b'^n:ds[4U'[:size]
+
+
+def legacy_extract_number(value):
+    out = ""
+    spaces = 0
+    for char in value:
+        if char in string.digits:
+            out += char
+        elif char == " ":
+            spaces += 1
+    return int(out) // spaces
+
+
+def legacy_accept_key(key):
+    try:
+        if len(base64.b64decode(key)) != 16:
+            return None
+    except (TypeError, binascii.Error):
+        return None
+    return base64.b64encode(sha1(key + HYBI_GUID).digest())
+
+
+def bench_keys():
+    hixie_keys = [REQUESTS[1][1]['HTTP_SEC_WEBSOCKET_KEY1'],
+        REQUESTS[1][1]['HTTP_SEC_WEBSOCKET_KEY2']] * (KEYS // 2)
+    hybi_keys = [REQUESTS[2][1]['HTTP_SEC_WEBSOCKET_KEY']] * KEYS
+    for name, extract_number, accept_key in (
+            ('before', legacy_extract_number, legacy_accept_key),
+            ('now', _extract_number, _accept_key)):
+        report('hixie-76 key numbers: %s' % name,
+            measure(lambda: [extract_number(key) for key in hixie_keys]),
+            items=KEYS)
+        report('rfc6455 accept keys: %s' % name,
+            measure(lambda: [accept_key(key) for key in hybi_keys]),
+            items=KEYS)
+
+
+def main():
+    bench_keys()
+    server, client = socket.socketpair()
+    factory = RequestFactory()
+    for name, headers, deflate in REQUESTS:
+        requests = []
+        for i in range(HANDSHAKES):
+            request = factory.get('/chat/', **headers)
+            request.META['wsgi.input'] = Input(server)
+            requests.append(request)
+        latencies = []
+        start = time.time()
+        for request in requests:
+            begin = time.time()
+            websocket = setup_websocket(request, deflate=deflate)
+            latencies.append(time.time() - begin)
+            websocket.socket.close()
+        report('setup_websocket: %s' % name, time.time() - start,
+            items=HANDSHAKES, latencies=latencies)
+    server.close()
+    client.close()
+
+
+if __name__ == '__main__':
+    main()
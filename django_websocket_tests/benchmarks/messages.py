@@ -0,0 +1,51 @@
+'''
+Measures framing outgoing messages with ``_pack_message`` and parsing
+incoming frames with ``_parse_message_queue``, for both protocols and a
+range of message sizes. Incoming data is fed to the parser in chunks of the
+read size, like ``_socket_recv`` does.
+'''
+from django_websocket_tests.benchmarks import measure, report
+from django_websocket.framing import OPCODE_TEXT, pack_hybi_frame
+from django_websocket.websocket import WebSocket, HybiWebSocket
+
+
+SIZES = ((16, 100000), (1024, 20000), (64 * 1024, 500))
+
+RECV_SIZE = 64 * 1024
+
+
+def client_data(cls, payload, count):
+    if cls is WebSocket:
+        frame = b'\x00' + payload + b'\xff'
+    else:
+        frame = pack_hybi_frame(OPCODE_TEXT, payload, mask=b'abcd')
+    data = frame * count
+    return [data[i:i + RECV_SIZE] for i in range(0, len(data), RECV_SIZE)]
+
+
+def main():
+    for cls in (WebSocket, HybiWebSocket):
+        for size, count in SIZES:
+            message = u'x' * size
+
+            def pack():
+                for i in range(count):
+                    cls._pack_message(message)
+            report('%s: pack %d bytes' % (cls.__name__, size), measure(pack),
+                items=count, nbytes=count * size)
+
+            chunks = client_data(cls, b'x' * size, count)
+            websocket = cls(None, None)
+
+            def parse():
+                parsed = 0
+                for chunk in chunks:
+                    websocket._parser.feed(chunk)
+                    parsed += len(websocket._parse_message_queue())
+                assert parsed == count
+            report('%s: parse %d bytes' % (cls.__name__, size),
+                measure(parse), items=count, nbytes=count * size)
+
+
+if __name__ == '__main__':
+    main()
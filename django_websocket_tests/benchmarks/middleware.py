@@ -0,0 +1,92 @@
+'''
+Measures the overhead that ``WebSocketMiddleware`` adds to plain HTTP
+requests, i.e. the calls of ``process_request``, ``process_view`` and
+``process_response`` for a request without an upgrade, compared to the code
+path before the fast path for such requests was added.
+'''
+import time
+from django.http import HttpResponse
+from django.test.client import RequestFactory
+from django_websocket_tests.benchmarks import report
+from django_websocket.decorators import accept_websocket
+from django_websocket.middleware import WebSocketMiddleware
+from django_websocket.websocket import setup_websocket
+
+
+REQUESTS = 100000
+
+
+class LegacyMiddleware(object):
+    '''
+    The handling of plain requests before the fast path: the full upgrade
+    detection, a new lambda per request and a lookup of the view flags per
+    request.
+    '''
+    def process_request(self, request):
+        if getattr(request, 'websocket', None) is not None:
+            request.is_websocket = lambda: True
+            return
+        request.websocket = setup_websocket(request)
+        if request.websocket is None:
+            request.is_websocket = lambda: False
+        else:
+            request.is_websocket = lambda: True
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if request.is_websocket():
+            pass
+        elif getattr(view_func, 'require_websocket', False):
+            return HttpResponse(status=400)
+
+    def process_response(self, request, response):
+        if request.is_websocket() and request.websocket._handshake_sent:
+            pass
+        return response
+
+
+@accept_websocket
+def view(request):
+    return HttpResponse()
+
+
+def bench(middleware, requests, response):
+    if middleware is None:
+        def func():
+            for request in requests:
+                pass
+    else:
+        process_request = middleware.process_request
+        process_view = middleware.process_view
+        process_response = middleware.process_response
+        def func():
+            for request in requests:
+                process_request(request)
+                process_view(request, view, (), {})
+                process_response(request, response)
+    start = time.time()
+    func()
+    return time.time() - start
+
+
+def main():
+    factory = RequestFactory()
+    response = HttpResponse()
+    baseline = None
+    for name, middleware in (
+            ('no middleware', None),
+            ('before the fast path', LegacyMiddleware()),
+            ('WebSocketMiddleware', WebSocketMiddleware())):
+        requests = [factory.get('/page/', HTTP_CONNECTION='keep-alive')
+            for i in range(REQUESTS)]
+        seconds = bench(middleware, requests, response)
+        if baseline is None:
+            baseline = seconds
+        report('plain request: %s' % name, seconds, items=REQUESTS)
+        if middleware is not None:
+            overhead = (seconds - baseline) / REQUESTS
+            report('plain request overhead: %s (%.2f us/request)' % (
+                name, overhead * 1000000), seconds - baseline)
+
+
+if __name__ == '__main__':
+    main()
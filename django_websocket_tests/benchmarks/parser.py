@@ -0,0 +1,69 @@
+'''
+Compares the incremental :class:`~django_websocket.framing.HixieParser` with
+the string based parser that was used before. Two workloads are measured:
+lots of tiny chat-like frames, and a few huge frames that arrive over
+hundreds of ``recv()`` calls.
+'''
+from django_websocket_tests.benchmarks import measure, report
+from django_websocket.framing import HixieParser
+
+
+class LegacyParser(object):
+    '''
+    The old ``WebSocket._parse_message_queue`` logic: concatenates every
+    received chunk to an immutable string and re-slices it for every frame.
+    '''
+    def __init__(self):
+        self.buffer = b''
+
+    def feed(self, data):
+        self.buffer += data
+
+    def parse(self):
+        msgs = []
+        buf = self.buffer
+        while buf[:1] == b'\x00':
+            end_idx = buf.find(b'\xff')
+            if end_idx == -1:
+                break
+            msgs.append(buf[1:end_idx])
+            buf = buf[end_idx + 1:]
+        self.buffer = buf
+        return msgs
+
+
+WORKLOADS = (
+    ('many small frames', 200000, 20),
+    ('few huge frames', 2, 2 * 1024 * 1024),
+)
+
+RECV_SIZE = 4096
+
+
+def chunked(data, size=RECV_SIZE):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def parse_all(parser_class, chunks):
+    parser = parser_class()
+    count = 0
+    for chunk in chunks:
+        parser.feed(chunk)
+        count += len(parser.parse())
+    return count
+
+
+def main():
+    for name, count, size in WORKLOADS:
+        frame = b'\x00' + b'x' * size + b'\xff'
+        data = frame * count
+        chunks = chunked(data)
+        for parser_class in (LegacyParser, HixieParser):
+            assert parse_all(parser_class, chunks) == count
+            seconds = measure(lambda: parse_all(parser_class, chunks))
+            report('%s: %s' % (name, parser_class.__name__),
+                seconds, items=count, nbytes=len(data))
+
+
+if __name__ == '__main__':
+    main()
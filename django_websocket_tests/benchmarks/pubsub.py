@@ -0,0 +1,85 @@
+'''
+Measures the rate at which :class:`~django_websocket.pubsub.SharedRing`
+passes messages from a publisher in a child process to a reader in this
+process, and the time from publishing a message until the reader woke up
+and read it.
+'''
+import os
+import shutil
+import struct
+import tempfile
+import time
+from django_websocket_tests.benchmarks import measure, report
+from django_websocket.pubsub import SharedRing
+from django_websocket.websocket import HybiWebSocket
+
+
+MESSAGES = 100000
+ROUND_TRIPS = 2000
+MESSAGE = u'{"event": "notification", "text": "Gr\xfc\xdfe aus Wien"}'
+
+
+def publish_from_child(ring, count):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            frame = HybiWebSocket._pack_message(MESSAGE)
+            for i in range(count):
+                ring.publish('news', frame)
+        finally:
+            os._exit(0)
+    return pid
+
+
+def throughput(ring):
+    reader = ring.reader()
+
+    def consume():
+        received = 0
+        lost = reader.lost
+        pid = publish_from_child(ring, MESSAGES)
+        while received + reader.lost - lost < MESSAGES:
+            received += len(reader.wait(0.1))
+        os.waitpid(pid, 0)
+
+    seconds = measure(consume)
+    report('SharedRing: child publishes, parent reads (%d lost)' % (
+        reader.lost), seconds, items=MESSAGES)
+    reader.close()
+
+
+def latency(ring):
+    reader = ring.reader()
+    latencies = []
+    pid = os.fork()
+    if pid == 0:
+        try:
+            for i in range(ROUND_TRIPS):
+                ring.publish('news', struct.pack('=d', time.time()))
+                time.sleep(0.0005)
+        finally:
+            os._exit(0)
+    start = time.time()
+    while len(latencies) < ROUND_TRIPS:
+        for group, frame in reader.wait(1):
+            latencies.append(time.time() - struct.unpack('=d', frame)[0])
+    report('SharedRing: publish to wakeup', time.time() - start,
+        items=ROUND_TRIPS, latencies=latencies)
+    os.waitpid(pid, 0)
+    reader.close()
+
+
+def main():
+    directory = tempfile.mkdtemp(dir='/dev/shm' if os.path.isdir('/dev/shm')
+        else None)
+    try:
+        ring = SharedRing(os.path.join(directory, 'ring'))
+        throughput(ring)
+        latency(ring)
+        ring.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
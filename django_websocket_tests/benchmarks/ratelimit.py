@@ -0,0 +1,50 @@
+'''
+Measures how long a view takes to get through a flood of 50,000 small text
+messages from one client, reading every message with ``read()``, without
+and with a rate limit that drops what exceeds 1,000 messages per second.
+The limiter is charged once per read from the socket, so the overhead for
+well-behaved clients is small as well.
+'''
+import socket
+import threading
+from django_websocket_tests.benchmarks import measure, report
+from django_websocket.framing import OPCODE_TEXT, pack_hybi_frame
+from django_websocket.websocket import HybiWebSocket
+
+
+MESSAGES = 50000
+MESSAGE = u'{"spam": "Gr\xfc\xdfe"}'.encode('utf-8')
+FRAME = pack_hybi_frame(OPCODE_TEXT, MESSAGE, mask=b'abcd')
+
+
+def drain(limit):
+    server, client = socket.socketpair()
+    sender = threading.Thread(target=lambda: (
+        client.sendall(FRAME * MESSAGES), client.close()))
+    sender.start()
+    websocket = HybiWebSocket(server, None)
+    if limit is not None:
+        websocket.enable_rate_limit(**limit)
+    handled = 0
+    while websocket._socket_recv():
+        while websocket._message_queue:
+            websocket.read()
+            handled += 1
+    sender.join()
+    server.close()
+    return handled
+
+
+def main():
+    for name, limit in (
+            ('no limit', None),
+            ('1000 messages/s, drop', {'messages_per_second': 1000}),
+            ('generous limit', {'messages_per_second': 10 ** 9})):
+        handled = []
+        seconds = measure(lambda: handled.append(drain(limit)))
+        report('flood of %d messages: %s (%d handled)' % (
+            MESSAGES, name, handled[-1]), seconds, items=MESSAGES)
+
+
+if __name__ == '__main__':
+    main()
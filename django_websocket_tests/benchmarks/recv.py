@@ -0,0 +1,58 @@
+'''
+Compares reading frames from a socket with ``recv()`` into a new string per
+read, as :class:`~django_websocket.websocket.WebSocket` used to do, with
+``recv_into()`` into the reusable buffer of the parser and an adaptive read
+size.
+'''
+import socket
+import threading
+from django_websocket_tests.benchmarks import measure, report
+from django_websocket.framing import OPCODE_BINARY, pack_hybi_frame
+from django_websocket.websocket import HybiWebSocket
+
+
+WORKLOADS = (
+    ('small frames', 50000, 100),
+    ('large frames', 50, 1024 * 1024),
+)
+
+
+class RecvSocket(object):
+    '''
+    Hides ``recv_into`` of a socket, so that the websocket falls back to
+    ``recv``.
+    '''
+    def __init__(self, sock):
+        self.recv = sock.recv
+
+
+def receive_all(websocket_class, data, count, use_recv_into):
+    server, client = socket.socketpair()
+    sender = threading.Thread(target=client.sendall, args=(data,))
+    sender.start()
+    if use_recv_into:
+        websocket = websocket_class(server, None)
+    else:
+        websocket = websocket_class(RecvSocket(server), None)
+    received = 0
+    while received < count:
+        websocket._socket_recv()
+        received += len(websocket._message_queue)
+        websocket._message_queue.clear()
+    sender.join()
+    server.close()
+    client.close()
+
+
+def main():
+    for name, count, size in WORKLOADS:
+        data = pack_hybi_frame(OPCODE_BINARY, 'x' * size, mask='abcd') * count
+        for use_recv_into in (False, True):
+            seconds = measure(
+                lambda: receive_all(HybiWebSocket, data, count, use_recv_into))
+            report('%s: %s' % (name, 'recv_into' if use_recv_into else 'recv'),
+                seconds, items=count, nbytes=len(data))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+'''
+Measures a reconnect storm: 10,000 clients resume a group of a
+:class:`~django_websocket.broadcast.Broadcaster` with a replay buffer, each
+missing the last 50 messages, which are replayed from memory. The sockets
+only count the written bytes.
+'''
+from django_websocket_tests.benchmarks import measure, report
+from django_websocket_tests.benchmarks.broadcast import NullSocket, MESSAGE
+from django_websocket.broadcast import Broadcaster
+from django_websocket.replay import ReplayBuffer
+from django_websocket.websocket import HybiWebSocket
+
+
+CLIENTS = 10000
+MISSED = 50
+
+
+def main():
+    broadcaster = Broadcaster(replay=ReplayBuffer())
+    for i in range(1000):
+        broadcaster.broadcast('news', MESSAGE)
+    topic = broadcaster.replay.topic('news')
+    last_id = topic.make_id(topic.next_sequence - 1 - MISSED)
+
+    def since():
+        for i in range(CLIENTS):
+            broadcaster.replay.since('news', last_id)
+
+    def resume():
+        for i in range(CLIENTS):
+            broadcaster.resume('news', HybiWebSocket(NullSocket(), None),
+                last_id)
+
+    report('ReplayBuffer.since: %d of 1000 messages' % MISSED,
+        measure(since), items=CLIENTS)
+    report('Broadcaster.resume: %d missed messages' % MISSED,
+        measure(resume), items=CLIENTS)
+
+
+if __name__ == '__main__':
+    main()
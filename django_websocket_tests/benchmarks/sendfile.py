@@ -0,0 +1,66 @@
+'''
+Sends the contents of a file as binary message over ``socket.socketpair()``,
+with ``WebSocket.send_file`` and by reading the file into memory and calling
+``WebSocket.send``. ``send_file`` uses ``socket.sendfile`` on Python 3.5 and
+later and falls back to reading and sending chunks of the file before.
+'''
+import socket
+import tempfile
+import threading
+import time
+from django_websocket_tests.benchmarks import report
+from django_websocket.websocket import HybiWebSocket
+
+
+SIZES = ((64 * 1024, 200), (4 * 1024 * 1024, 20), (32 * 1024 * 1024, 3))
+
+
+def drain(sock, size):
+    buf = bytearray(256 * 1024)
+    received = 0
+    while received < size:
+        count = sock.recv_into(buf)
+        if not count:
+            break
+        received += count
+
+
+def read_and_send(websocket, fileobj):
+    fileobj.seek(0)
+    websocket.send(fileobj.read(), binary=True)
+
+
+def send_file(websocket, fileobj):
+    websocket.send_file(fileobj)
+
+
+def main():
+    if hasattr(socket.socket, 'sendfile'):
+        method = 'socket.sendfile'
+    else:
+        method = 'read and send chunks'
+    for size, repeat in SIZES:
+        fileobj = tempfile.TemporaryFile()
+        fileobj.write(b'x' * size)
+        fileobj.flush()
+        for name, func in (('read + send', read_and_send),
+                ('send_file (%s)' % method, send_file)):
+            server, client = socket.socketpair()
+            websocket = HybiWebSocket(server, None)
+            # Frames of more than 64 KB have a ten byte header.
+            total = repeat * (size + 10)
+            reader = threading.Thread(target=drain, args=(client, total))
+            reader.start()
+            start = time.time()
+            for i in range(repeat):
+                func(websocket, fileobj)
+            reader.join()
+            report('%d KB file, %s' % (size // 1024, name),
+                time.time() - start, items=repeat, nbytes=total)
+            server.close()
+            client.close()
+        fileobj.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+'''
+Sends batches of messages over ``socket.socketpair()`` with one
+``WebSocket.send`` per message and with ``WebSocket.send_many``. On Python 3
+``send_many`` hands the frames to ``socket.sendmsg`` without joining them.
+Python 2 has no ``sendmsg``, there the frames of a batch are joined and
+written with one ``sendall``.
+'''
+import socket
+import threading
+import time
+from django_websocket_tests.benchmarks import report
+from django_websocket_tests.benchmarks.sendfile import drain
+from django_websocket.framing import OPCODE_BINARY, pack_hybi_header
+from django_websocket.websocket import HybiWebSocket
+
+
+SIZES = ((16, 100000), (1024, 50000), (16 * 1024, 5000))
+
+
+def send(websocket, messages):
+    for message in messages:
+        websocket.send(message, binary=True)
+
+
+def send_many(websocket, messages):
+    websocket.send_many(messages, binary=True)
+
+
+def main():
+    if hasattr(socket.socket, 'sendmsg'):
+        method = 'sendmsg'
+    else:
+        method = 'joined'
+    for size, count in SIZES:
+        messages = [b'x' * size] * count
+        total = count * (len(pack_hybi_header(OPCODE_BINARY, size)) + size)
+        for name, func in (('send', send),
+                ('send_many (%s)' % method, send_many)):
+            server, client = socket.socketpair()
+            websocket = HybiWebSocket(server, None)
+            reader = threading.Thread(target=drain, args=(client, total))
+            reader.start()
+            start = time.time()
+            func(websocket, messages)
+            reader.join()
+            report('%d x %d bytes, %s' % (count, size, name),
+                time.time() - start, items=count, nbytes=total)
+            server.close()
+            client.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+'''
+Measures the :class:`~django_websocket.keepalive.TimerWheel` with one timer
+per connection, the way :class:`~django_websocket.keepalive.KeepAlive` uses
+it. The cost of a tick should depend on the number of due timers, not on the
+number of connections.
+'''
+import random
+from django_websocket_tests.benchmarks import measure, report
+from django_websocket.keepalive import TimerWheel
+
+
+CONNECTIONS = (1000, 10000, 50000)
+TICKS = 100
+
+
+def noop():
+    pass
+
+
+def main():
+    for connections in CONNECTIONS:
+        wheel = TimerWheel(tick=1.0)
+        seconds = measure(lambda: [wheel.schedule(random.uniform(1, 60), noop)
+            for i in range(connections)], repeat=1)
+        report('schedule: %d timers' % connections, seconds,
+            items=connections)
+
+        # Timers that fire are rescheduled, like KeepAlive does.
+        def reschedule():
+            wheel.schedule(random.uniform(1, 60), reschedule)
+        wheel = TimerWheel(tick=1.0)
+        for i in range(connections):
+            wheel.schedule(random.uniform(1, 60), reschedule)
+        ticks = [0]
+
+        def advance():
+            ticks[0] += TICKS
+            wheel.advance(wheel._epoch + ticks[0])
+        seconds = measure(advance)
+        report('advance: %d ticks, %d timers' % (TICKS, connections),
+            seconds, items=TICKS)
+
+
+if __name__ == '__main__':
+    main()
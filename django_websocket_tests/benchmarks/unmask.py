@@ -0,0 +1,44 @@
+'''
+Compares :func:`~django_websocket.framing.unmask` with a naive loop that
+XORs one byte at a time, for payloads between 1 KB and 1 MB.
+``unmask_into`` is how the parser unmasks payloads in its receive buffer.
+'''
+import os
+from django_websocket_tests.benchmarks import measure, report
+from django_websocket.framing import unmask, unmask_into
+
+
+def naive_unmask(mask, data):
+    mask = bytearray(mask)
+    out = bytearray(data)
+    for i in range(len(out)):
+        out[i] ^= mask[i & 3]
+    return bytes(out)
+
+
+SIZES = (1024, 16 * 1024, 64 * 1024, 1024 * 1024)
+TOTAL_BYTES = 4 * 1024 * 1024
+
+
+def main():
+    mask = os.urandom(4)
+    for size in SIZES:
+        data = os.urandom(size)
+        assert unmask(mask, data) == naive_unmask(mask, data)
+        count = TOTAL_BYTES // size
+        for func in (naive_unmask, unmask):
+            def run():
+                for i in range(count):
+                    func(mask, data)
+            report('%s: %d bytes' % (func.__name__, size),
+                measure(run), items=count, nbytes=count * size)
+        buf = bytearray(data)
+        def run():
+            for i in range(count):
+                unmask_into(mask, buf)
+        report('unmask_into: %d bytes' % size, measure(run), items=count,
+            nbytes=count * size)
+
+
+if __name__ == '__main__':
+    main()
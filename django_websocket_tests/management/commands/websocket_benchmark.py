@@ -0,0 +1,23 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django_websocket_tests.benchmarks import BENCHMARKS, run
+
+
+class Command(BaseCommand):
+    help = ('Runs the given benchmarks of django_websocket_tests.benchmarks, '
+        'or all of them: %s.' % ', '.join(BENCHMARKS))
+    args = '[benchmark ...]'
+    option_list = BaseCommand.option_list + (
+        make_option('--json', dest='json', metavar='FILE',
+            help='Write the results as JSON to FILE.'),
+    )
+
+    def handle(self, *names, **options):
+        for name in names:
+            if name not in BENCHMARKS:
+                raise CommandError('Unknown benchmark: %s' % name)
+        if options.get('json') is None:
+            run(names)
+        else:
+            with open(options['json'], 'w') as output:
+                run(names, output)
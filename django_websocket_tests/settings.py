@@ -57,7 +57,7 @@ MEDIA_URL = ''
 ADMIN_MEDIA_PREFIX = '/media/'
 
 # Make this unique, and don't share it with anybody.
-SECRET_KEY = ''
+SECRET_KEY = 'django-websocket-tests'
 
 # List of callables that know how to import templates from various sources.
 TEMPLATE_LOADERS = (
@@ -1,17 +1,76 @@
 # -*- coding: utf-8 -*-
+import gc
+import json
+import os
+import shutil
+import socket
+import stat
+import struct
+import tempfile
+import threading
+import time
+from SocketServer import ThreadingMixIn
+from StringIO import StringIO
 from mock import Mock
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management import call_command
+from django.core.servers.basehttp import WSGIServer, WSGIRequestHandler
 from django.core.urlresolvers import reverse
 from django.contrib.auth.models import User
-from django.http import HttpResponse
 from django.test import TestCase
 from django.test.client import RequestFactory
-from django_websocket.decorators import accept_websocket, require_websocket
-from django_websocket.websocket import WebSocket
+from django_websocket.decorators import require_websocket
+from django_websocket.deflate import PerMessageDeflate
+from django_websocket.handoff import WebSocketHandler, WebSocketService, \
+    detach_connection, handoff
+from django_websocket.keepalive import KeepAlive, TimerWheel
+from django_websocket.loadtest import LoadTest, percentile
+from django_websocket.metrics import Histogram, MetricsRegistry
+from django_websocket.middleware import WebSocketMiddleware, view_flags
+from django_websocket.broadcast import Broadcaster
+from django_websocket.outbound import Flusher, SlowConsumer, flusher
+from django_websocket.pubsub import SharedBroadcaster, SharedRing, \
+    _GENERATION
+from django_websocket.ratelimit import RateLimiter, TokenBucket
+from django_websocket.replay import ReplayBuffer, last_seen_id
+from django_websocket.poller import WebSocketPoller, _PollSelector
+from django_websocket.framing import HixieParser, HybiParser, FrameError, \
+    OPCODE_CONTINUATION as CONTINUATION, OPCODE_TEXT as TEXT, \
+    OPCODE_BINARY as BINARY, OPCODE_CLOSE as CLOSE, OPCODE_PING as PING, \
+    OPCODE_PONG as PONG, pack_hybi_frame, pack_close_payload, unmask, \
+    unmask_into
+from django_websocket.websocket import WebSocket, HybiWebSocket, \
+    MalformedWebSocket, setup_websocket
+from django_websocket.testing import WebSocketClient, HandshakeError
+from django_websocket_tests.utils import WebsocketFactory
+from django_websocket_tests.views import add_one, echo_once
+
+
+def mock_socket():
+    '''
+    A mocked socket without ``recv_into``, so that received data can be
+    faked with ``recv``.
+    '''
+    return Mock(spec=['recv', 'sendall', 'shutdown', 'close', 'fileno'])
+
+
+def recv_exactly(sock, size, timeout=1):
+    '''
+    Receives *size* bytes from *sock*, or less if it gets closed.
+    '''
+    sock.settimeout(timeout)
+    data = ''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
 
 
 class WebSocketTests(TestCase):
     def setUp(self):
-        self.socket = Mock()
+        self.socket = mock_socket()
         self.protocol = '1'
 
     def test_send_handshake(self):
@@ -96,20 +155,1805 @@ class WebSocketTests(TestCase):
             self.assertEquals(message, expected_results[i])
 
 
-@accept_websocket
-def add_one(request):
-    if request.is_websocket():
-        for message in request.websocket:
-            request.websocket.send(int(message) + 1)
-    else:
-        value = int(request.GET['value'])
-        value += 1
-        return HttpResponse(unicode(value))
+class SendmsgSocket(object):
+    '''
+    Records the data written with ``sendmsg``, but accepts at most
+    *chunk_size* bytes per call.
+    '''
+    def __init__(self, chunk_size=None):
+        self.chunk_size = chunk_size
+        self.data = ''
+        self.calls = 0
+
+    def sendmsg(self, buffers):
+        self.calls += 1
+        data = ''.join(str(bytearray(buf)) for buf in buffers)
+        if self.chunk_size is not None:
+            data = data[:self.chunk_size]
+        self.data += data
+        return len(data)
+
+
+class SendManyTests(TestCase):
+    def test_partial_writes(self):
+        socket = SendmsgSocket(chunk_size=7)
+        ws = WebSocket(socket, None)
+        messages = ['spam', u'K\xfcss', '', 'eggs' * 10]
+        ws.send_many(messages)
+        self.assertEquals(socket.data,
+            ''.join(WebSocket._pack_message(message) for message in messages))
+        self.assertEquals(socket.calls, len(socket.data) // 7 + 1)
+
+    def test_batches(self):
+        socket = SendmsgSocket()
+        ws = HybiWebSocket(socket, None)
+        ws.send_many(str(i) for i in range(1000))
+        self.assertEquals(socket.data, ''.join(
+            HybiWebSocket._pack_message(str(i)) for i in range(1000)))
+        self.assertEquals(socket.calls, 2)
+
+    def test_fallback_to_sendall(self):
+        socket = Mock(spec=['sendall'])
+        ws = HybiWebSocket(socket, None)
+        ws.send_many(['spam', 'eggs'])
+        self.assertEquals(socket.sendall.call_count, 1)
+        self.assertEquals(socket.sendall.call_args, ((
+            pack_hybi_frame(TEXT, 'spam') + pack_hybi_frame(TEXT, 'eggs'),),
+            {}))
+
+
+class WebSocketPollerTests(TestCase):
+    def setUp(self):
+        self.pairs = [socket.socketpair() for i in range(3)]
+        self.websockets = [WebSocket(server, None)
+            for server, client in self.pairs]
+
+    def tearDown(self):
+        for server, client in self.pairs:
+            server.close()
+            client.close()
+
+    def check_poller(self, poller):
+        for websocket in self.websockets:
+            poller.register(websocket)
+        self.assertEquals(len(poller), 3)
+        self.assertEquals(poller.poll(0), [])
+
+        self.pairs[0][1].sendall('\x00spam\xff\x00eggs\xff')
+        self.pairs[2][1].sendall('\x00ham\xff\x00sp')
+        results = dict(poller.poll(1))
+        self.assertEquals(results, {
+            self.websockets[0]: [u'spam', u'eggs'],
+            self.websockets[2]: [u'ham']})
+
+        self.pairs[2][1].sendall('am\xff\xff\x00')
+        self.pairs[1][1].close()
+        results = dict(poller.poll(1))
+        self.assertEquals(results, {
+            self.websockets[1]: [],
+            self.websockets[2]: [u'spam']})
+        self.assertTrue(self.websockets[1].closed)
+        self.assertTrue(self.websockets[2].closed)
+        self.assertEquals(len(poller), 1)
+        poller.close()
+        self.assertEquals(len(poller), 0)
+
+    def test_poll(self):
+        self.check_poller(WebSocketPoller())
+
+    def test_poll_without_selectors_module(self):
+        self.check_poller(WebSocketPoller(_PollSelector()))
+
+    def test_queued_messages_are_reported(self):
+        websocket = self.websockets[0]
+        websocket._message_queue.append((TEXT, 'spam'))
+        poller = WebSocketPoller()
+        poller.register(websocket)
+        self.assertEquals(poller.poll(), [(websocket, [u'spam'])])
+        self.assertEquals(len(websocket._message_queue), 0)
+
+    def test_iteration(self):
+        poller = WebSocketPoller()
+        poller.register(self.websockets[0])
+        self.pairs[0][1].sendall('\x00spam\xff\xff\x00')
+        self.assertEquals(list(poller), [(self.websockets[0], [u'spam'])])
+
+
+class BroadcasterTests(TestCase):
+    def setUp(self):
+        self.pairs = []
+        # the thread of the shared flusher mustn't outlive the tests
+        self.addCleanup(flusher.stop)
+
+    def tearDown(self):
+        for server, client in self.pairs:
+            server.close()
+            client.close()
+
+    def websocket(self, cls=WebSocket):
+        server, client = socket.socketpair()
+        self.pairs.append((server, client))
+        return cls(server, None), client
+
+    def test_broadcast(self):
+        hixie = [self.websocket() for i in range(2)]
+        hybi = self.websocket(HybiWebSocket)
+        broadcaster = Broadcaster()
+        for websocket, client in hixie + [hybi]:
+            websocket._queue_frame = Mock(wraps=websocket._queue_frame)
+            broadcaster.add('news', websocket)
+            # broadcasts are queued in a write buffer
+            self.assertTrue(websocket.write_buffer is not None)
+        broadcaster.add('other', hixie[0][0])
+        self.assertEquals(broadcaster.broadcast('news', u'K\xfcss'), 3)
+        for websocket, client in hixie:
+            self.assertEquals(client.recv(100), '\x00K\xc3\xbcss\xff')
+        # the frame is shared
+        self.assertTrue(hixie[0][0]._queue_frame.call_args[0][0] is
+            hixie[1][0]._queue_frame.call_args[0][0])
+        self.assertEquals(hybi[1].recv(100),
+            pack_hybi_frame(TEXT, 'K\xc3\xbcss'))
+        self.assertEquals(broadcaster.broadcast('unknown', 'spam'), 0)
+
+    def test_dead_websockets_are_pruned(self):
+        (alive, client), (broken, gone), (closed, unused) = [
+            self.websocket() for i in range(3)]
+        gone.close()
+        closed.closed = True
+        broadcaster = Broadcaster()
+        for websocket in (alive, broken, closed):
+            broadcaster.add('news', websocket)
+        broadcaster.add('other', broken)
+        self.assertEquals(broadcaster.broadcast('news', 'spam'), 1)
+        self.assertEquals(broadcaster.members('news'), [alive])
+        self.assertEquals(broadcaster.groups(), ['news'])
+        self.assertEquals(client.recv(100), '\x00spam\xff')
+        unused.setblocking(False)
+        self.assertRaises(socket.error, unused.recv, 100)
+
+    def test_slow_client_does_not_block(self):
+        (fast, client), (slow, stalled) = [self.websocket() for i in range(2)]
+        slow.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        slow.enable_write_buffer(high_watermark=100000)
+        broadcaster = Broadcaster()
+        broadcaster.add('news', fast)
+        broadcaster.add('news', slow)
+        message = 'x' * 998
+        reader = threading.Thread(target=recv_exactly,
+            args=(client, 200 * 1000, 5))
+        reader.start()
+        for i in range(200):
+            broadcaster.broadcast('news', message)
+        reader.join()
+        # the client that doesn't read fell too far behind
+        self.assertTrue(slow.closed)
+        self.assertEquals(broadcaster.members('news'), [fast])
+        self.assertEquals(broadcaster.broadcast('news', 'spam'), 1)
+
+    def test_busy_websocket(self):
+        websocket, client = self.websocket()
+        broadcaster = Broadcaster()
+        broadcaster.add('news', websocket)
+        # another thread, e.g. the view, is writing
+        locked, release = threading.Event(), threading.Event()
+        def write():
+            with websocket._write_lock:
+                locked.set()
+                release.wait()
+        writer = threading.Thread(target=write)
+        writer.start()
+        locked.wait()
+        try:
+            self.assertEquals(broadcaster.broadcast('news', 'spam'), 1)
+            self.assertEquals(broadcaster.broadcast('news', 'eggs'), 1)
+            self.assertEquals(websocket.buffered_amount, 12)
+        finally:
+            release.set()
+            writer.join()
+        # the flusher sends them once the lock is free
+        self.assertEquals(recv_exactly(client, 12),
+            '\x00spam\xff\x00eggs\xff')
+
+    def test_remove(self):
+        websocket = WebSocket(Mock(), None)
+        broadcaster = Broadcaster()
+        broadcaster.add('news', websocket)
+        broadcaster.remove('news', websocket)
+        broadcaster.remove('news', websocket)
+        self.assertEquals(broadcaster.groups(), [])
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def get_stderr(self):
+        return StringIO()
+
+
+class ThreadedServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Writing the response of a websocket view fails once the client
+        # closed the connection.
+        pass
+
+
+class LoadTestTests(TestCase):
+    def setUp(self):
+        self.server = ThreadedServer(('127.0.0.1', 0), QuietRequestHandler)
+        self.server.set_app(WSGIHandler())
+        self.thread = threading.Thread(target=self.server.serve_forever,
+            args=(0.01,))
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'ws://127.0.0.1:%d/echo/' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def test_percentile(self):
+        values = [40, 15, 50, 35, 20]
+        for percent, expected in ((0, 15), (5, 15), (30, 20), (40, 20),
+            (50, 35), (90, 50), (100, 50)):
+            self.assertEquals(percentile(values, percent), expected)
+        values = range(1, 101)
+        for percent in (1, 7, 29, 50, 57, 99, 100):
+            self.assertEquals(percentile(values, percent), percent)
+        self.assertEquals(percentile(values, 99.5), 100)
+        self.assertEquals(percentile([], 50), None)
+
+    def test_load_test(self):
+        for version in (13, 76):
+            results = LoadTest(self.url, clients=3, messages=5, size=10,
+                version=version, timeout=5).run()
+            self.assertEquals(results['first_errors'], [])
+            self.assertEquals((results['connections'], results['messages']),
+                (3, 15))
+            for key in ('connect_time', 'round_trip_time'):
+                self.assertEquals(sorted(results[key]), ['p50', 'p90', 'p99'])
+                self.assertTrue(results[key]['p50'] <= results[key]['p99'])
+
+    def test_connection_errors(self):
+        url = self.url.replace('/echo/', '/plain/')
+        results = LoadTest(url, clients=2, messages=5, timeout=5).run()
+        self.assertEquals((results['connections'], results['errors']), (0, 2))
+        self.assertEquals(results['round_trip_time'],
+            {'p50': None, 'p90': None, 'p99': None})
+
+    def test_command(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'results.json')
+            stdout = StringIO()
+            call_command('websocket_loadtest', self.url, clients=2,
+                messages=3, json=path, stdout=stdout)
+            self.assertTrue('Connections: 2 of 2 in' in stdout.getvalue())
+            self.assertTrue('Messages: 6 in' in stdout.getvalue())
+            self.assertTrue('Errors: 0' in stdout.getvalue())
+            with open(path) as results:
+                self.assertEquals(json.load(results)['messages'], 6)
+        finally:
+            shutil.rmtree(directory)
+
+
+class ReplayBufferTests(TestCase):
+    def test_since(self):
+        replay = ReplayBuffer(max_messages=3)
+        self.assertEquals(replay.last_id('news'), None)
+        topic = replay.topic('news')
+        id = topic.make_id
+        self.assertEquals(replay.append('news', u'K\xfcss'), id(1))
+        self.assertEquals(replay.since('news', id(0)), ['K\xc3\xbcss'])
+        self.assertEquals(replay.since('news', id(1)), [])
+        self.assertEquals(replay.since('news', id(2)), None)
+        for i in range(2, 6):
+            self.assertEquals(replay.append('news', str(i)), id(i))
+        self.assertEquals(replay.last_id('news'), id(5))
+        self.assertEquals(replay.since('news', id(2)), ['3', '4', '5'])
+        self.assertEquals(replay.since('news', id(4)), ['5'])
+        # evicted
+        self.assertEquals(replay.since('news', id(1)), None)
+        self.assertEquals(replay.since('news', id(0)), None)
+        self.assertEquals(replay.topics(), ['news'])
+
+    def test_ids_of_other_epochs(self):
+        replay = ReplayBuffer()
+        replay.append('news', 'spam')
+        topic = replay.topic('news')
+        self.assertEquals(replay.since('news', topic.make_id(0)), ['spam'])
+        # e.g. from a worker that was started at the same time
+        other = ReplayBuffer().topic('news')
+        self.assertNotEquals(other.epoch, topic.epoch)
+        for last_id in (other.make_id(0), 'x', '1-2-3', 42):
+            self.assertEquals(replay.since('news', last_id), None)
+
+    def test_eviction_by_size(self):
+        replay = ReplayBuffer(max_bytes=10)
+        topic = replay.topic('news')
+        first = replay.append('news', 'x' * 4)
+        replay.append('news', 'y' * 4)
+        replay.append('news', 'z' * 4)
+        self.assertEquals((len(topic), topic.nbytes), (2, 8))
+        self.assertEquals(replay.since('news', first), ['yyyy', 'zzzz'])
+        # too large to be kept at all
+        last = replay.append('news', 'x' * 11)
+        self.assertEquals((len(topic), topic.nbytes), (0, 0))
+        self.assertEquals(replay.last_id('news'), last)
+        self.assertEquals(replay.since('news', topic.make_id(3)), None)
+        self.assertEquals(replay.since('news', last), [])
+
+    def test_format(self):
+        replay = ReplayBuffer(format=lambda id, message: '%s:%s' % (
+            id, message))
+        id = replay.append('news', 'spam')
+        self.assertEquals(replay.since('news', replay.topic('news').make_id(0)),
+            ['%s:spam' % id])
+
+    def test_frames_are_cached(self):
+        topic = ReplayBuffer().topic('news')
+        topic.append('spam')
+        frames = topic.frames(HybiWebSocket, topic.make_id(0))
+        self.assertEquals(frames, pack_hybi_frame(TEXT, 'spam'))
+        self.assertTrue(topic.frames(HybiWebSocket, topic.make_id(0)) is
+            frames)
+        self.assertEquals(topic.frames(WebSocket, topic.make_id(0)),
+            '\x00spam\xff')
+        topic.append('eggs')
+        self.assertEquals(topic.frames(WebSocket, topic.make_id(0)),
+            '\x00spam\xff\x00eggs\xff')
+        self.assertEquals(topic.frames(WebSocket, topic.make_id(3)), None)
+
+    def test_resume(self):
+        self.addCleanup(flusher.stop)
+        pairs = [socket.socketpair() for i in range(4)]
+        for pair in pairs:
+            self.addCleanup(pair[0].close)
+            self.addCleanup(pair[1].close)
+        broadcaster = Broadcaster(replay=ReplayBuffer())
+        first = HybiWebSocket(pairs[0][0], None)
+        broadcaster.add('news', first)
+        self.assertEquals(broadcaster.broadcast('news', 'one'), 1)
+        last_id = broadcaster.replay.last_id('news')
+        self.assertEquals(broadcaster.broadcast('news', 'two'), 1)
+        reconnected = HybiWebSocket(pairs[1][0], None)
+        self.assertEquals(broadcaster.resume('news', reconnected, last_id), 1)
+        broadcaster.broadcast('news', 'three')
+        self.assertEquals(recv_exactly(pairs[1][1], 12),
+            pack_hybi_frame(TEXT, 'two') + pack_hybi_frame(TEXT, 'three'))
+        # a new client and one whose messages are gone are just added
+        other = ReplayBuffer().topic('news')
+        for last_id, (server, client) in zip((None, other.make_id(1)),
+                pairs[2:]):
+            websocket = WebSocket(server, None)
+            self.assertEquals(broadcaster.resume('news', websocket, last_id),
+                None)
+            self.assertEquals(websocket.buffered_amount, 0)
+            client.setblocking(False)
+            self.assertRaises(socket.error, client.recv, 100)
+            self.assertTrue(websocket in broadcaster.members('news'))
+
+    def test_resume_slow_client(self):
+        broadcaster = Broadcaster(replay=ReplayBuffer())
+        last_id = broadcaster.replay.topic('news').make_id(0)
+        for i in range(10):
+            broadcaster.broadcast('news', 'x' * 1000)
+        websocket = WebSocket(mock_socket(), None)
+        websocket.enable_write_buffer(high_watermark=5000)
+        # the replay doesn't fit in the write buffer
+        self.assertRaises(SlowConsumer, broadcaster.resume, 'news',
+            websocket, last_id)
+        self.assertTrue(websocket.closed)
+        self.assertEquals(broadcaster.members('news'), [])
+        self.assertEquals(websocket.socket.sendall.call_count, 0)
+
+    def test_resume_without_replay_buffer(self):
+        websocket = WebSocket(mock_socket(), None)
+        self.assertRaises(ValueError, Broadcaster().resume, 'news', websocket,
+            None)
+
+    def test_last_seen_id(self):
+        factory = RequestFactory()
+        self.assertEquals(last_seen_id(factory.get('/?last_id=5f3a9c-42')),
+            '5f3a9c-42')
+        self.assertEquals(last_seen_id(factory.get('/?id=5f3a9c-42'), 'id'),
+            '5f3a9c-42')
+        self.assertEquals(last_seen_id(factory.get('/')), None)
+        for value in ('x', '42', '5f3a9c-x', '5f3a9c-42-1'):
+            self.assertEquals(
+                last_seen_id(factory.get('/', {'last_id': value})), None)
+
+
+class SharedRingTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'ring')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def websocket(self, cls):
+        server, client = socket.socketpair()
+        self.addCleanup(server.close)
+        self.addCleanup(client.close)
+        self.addCleanup(flusher.stop)
+        return cls(server, None), client
+
+    def test_publish(self):
+        ring = SharedRing(self.path, capacity=1024)
+        reader = ring.reader()
+        self.assertEquals(reader.read(), [])
+        self.assertEquals(ring.publish(u'n\xe9ws', 'frame 1'), 0)
+        self.assertEquals(ring.publish('other', 'frame 2'), 1)
+        # another mapping of the same file
+        late = SharedRing(self.path).reader()
+        self.assertEquals(reader.wait(0), [(u'n\xe9ws', 'frame 1'),
+            ('other', 'frame 2')])
+        self.assertEquals(reader.next_sequence, 2)
+        self.assertEquals(late.read(), [])
+        ring.publish('news', 'frame 3')
+        self.assertEquals(late.wait(1), [('news', 'frame 3')])
+        self.assertRaises(ValueError, ring.publish, 'news', 'x' * 512)
+        reader.close()
+        late.close()
+        self.assertEquals(os.listdir(ring.wakeup_dir), [])
+
+    def test_stale_wakeup_pipes(self):
+        ring = SharedRing(self.path, capacity=1024)
+        # left behind by processes with the same pid
+        os.mkfifo(os.path.join(ring.wakeup_dir, 'fifo'), 0o600)
+        open(os.path.join(ring.wakeup_dir, 'file'), 'w').close()
+        for name in ('fifo', 'file'):
+            fd = ring._register(name)
+            self.assertTrue(stat.S_ISFIFO(os.fstat(fd).st_mode))
+            ring._unregister(name, fd)
+        self.assertEquals(os.listdir(ring.wakeup_dir), [])
+
+    def test_wrap_around(self):
+        ring = SharedRing(self.path, capacity=100)
+        reader = ring.reader()
+        for i in range(20):
+            frame = 'frame %d' % i
+            ring.publish('news', frame)
+            self.assertEquals(reader.read(), [('news', frame)])
+        self.assertEquals(reader.lost, 0)
+        reader.close()
+
+    def test_slow_reader_notices_gap(self):
+        ring = SharedRing(self.path, capacity=100)
+        reader = ring.reader()
+        for i in range(10):
+            ring.publish('news', 'frame %d' % i)
+        self.assertEquals(reader.read(), [])
+        self.assertEquals(reader.lost, 10)
+        ring.publish('news', 'frame 10')
+        self.assertEquals(reader.read(), [('news', 'frame 10')])
+        self.assertEquals(reader.next_sequence, 11)
+        reader.close()
+
+    def test_publish_from_other_process(self):
+        ring = SharedRing(self.path, capacity=1024)
+        reader = ring.reader()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                for i in range(3):
+                    ring.publish('news', 'from child %d' % i)
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEquals(reader.wait(1), [('news', 'from child %d' % i)
+            for i in range(3)])
+        reader.close()
+
+    def test_header_left_inconsistent(self):
+        ring = SharedRing(self.path, capacity=1024)
+        ring.publish('news', 'frame 1')
+
+        def generation():
+            return struct.unpack_from('=Q', ring._map, _GENERATION)[0]
+
+        def die_while_updating():
+            struct.pack_into('=Q', ring._map, _GENERATION, generation() + 1)
+
+        # repaired by readers, which don't hold the lock
+        die_while_updating()
+        readers = []
+        thread = threading.Thread(target=lambda: readers.append(ring.reader()))
+        thread.daemon = True
+        thread.start()
+        thread.join(5)
+        self.assertEquals(len(readers), 1)
+        self.assertEquals(generation() % 2, 0)
+        reader = readers[0]
+        self.assertEquals(reader.next_sequence, 1)
+        # and by publishers
+        die_while_updating()
+        self.assertEquals(ring.publish('news', 'frame 2'), 1)
+        self.assertEquals(generation() % 2, 0)
+        self.assertEquals(reader.read(), [('news', 'frame 2')])
+        reader.close()
+
+    def test_shared_broadcaster(self):
+        shared = SharedBroadcaster(self.path, capacity=1024,
+            poll_interval=0.01)
+        hixie, hixie_client = self.websocket(WebSocket)
+        hybi, hybi_client = self.websocket(HybiWebSocket)
+        shared.add('news', hixie)
+        shared.add('news', hybi)
+        try:
+            self.assertEquals(shared.broadcast('news', u'K\xfcss'), 0)
+            self.assertEquals(shared.broadcast('news', 'x' * 200), 1)
+            frames = '\x00K\xc3\xbcss\xff' + '\x00' + 'x' * 200 + '\xff'
+            self.assertEquals(recv_exactly(hixie_client, len(frames)), frames)
+            frames = pack_hybi_frame(TEXT, 'K\xc3\xbcss') + \
+                pack_hybi_frame(TEXT, 'x' * 200)
+            self.assertEquals(recv_exactly(hybi_client, len(frames)), frames)
+        finally:
+            shared.stop()
+        self.assertEquals(shared.lost, 0)
+
+    def test_shared_broadcaster_with_replay(self):
+        local = Broadcaster(replay=ReplayBuffer(
+            format=lambda id, message: u'%s %s' % (id, message)))
+        shared = SharedBroadcaster(self.path, capacity=1024, local=local,
+            poll_interval=0.01)
+        websocket, client = self.websocket(HybiWebSocket)
+        shared.add('news', websocket)
+        try:
+            shared.broadcast('news', u'K\xfcss')
+            header = recv_exactly(client, 2)
+            frame = header + recv_exactly(client, ord(header[1]))
+        finally:
+            shared.stop()
+        topic = local.replay.topic('news')
+        payload = (u'%s K\xfcss' % topic.last_id).encode('utf-8')
+        self.assertEquals(frame, pack_hybi_frame(TEXT, payload))
+        self.assertEquals(topic.since(topic.make_id(0)), [payload])
+
+
+class WriteBufferTests(TestCase):
+    def setUp(self):
+        self.server, self.client = socket.socketpair()
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        self.client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        self.ws = WebSocket(self.server, None)
+
+    def tearDown(self):
+        self.server.close()
+        self.client.close()
+
+    def start_reader(self, size):
+        """
+        Reads *size* bytes from the client socket in a separate thread.
+        """
+        received = []
+        def read():
+            self.client.settimeout(1)
+            data = ''
+            while len(data) < size:
+                data += self.client.recv(65536)
+            received.append(data)
+        reader = threading.Thread(target=read)
+        reader.start()
+        return reader, received
+
+    def test_fast_client(self):
+        self.ws.enable_write_buffer()
+        self.ws.send('spam')
+        self.assertEquals(self.ws.buffered_amount, 0)
+        self.assertEquals(self.client.recv(100), '\x00spam\xff')
+
+    def test_drop_policy(self):
+        self.ws.enable_write_buffer(high_watermark=20000, low_watermark=10000,
+            policy='drop')
+        message = 'x' * 998
+        for i in range(1000):
+            self.ws.send(message)
+            self.assertTrue(self.ws.buffered_amount <= 20000)
+        self.assertTrue(self.ws.buffered_amount > 0)
+        dropped = self.ws.write_buffer.dropped_frames
+        self.assertTrue(dropped > 0)
+        reader, received = self.start_reader(
+            1000 * (1000 - dropped) + 2)
+        self.ws.close()
+        reader.join()
+        self.assertEquals(self.ws.buffered_amount, 0)
+        self.assertEquals(received, [
+            ('\x00' + message + '\xff') * (1000 - dropped) + '\xff\x00'])
+
+    def test_close_policy(self):
+        self.ws.enable_write_buffer(high_watermark=20000, policy='close')
+        try:
+            for i in range(1000):
+                self.ws.send('x' * 998)
+        except SlowConsumer:
+            pass
+        else:
+            self.fail('SlowConsumer not raised')
+        self.assertTrue(self.ws.closed)
+        self.assertEquals(self.ws.buffered_amount, 0)
+
+    def test_block_policy(self):
+        self.ws.enable_write_buffer(high_watermark=20000)
+        reader, received = self.start_reader(1000 * 1000 + 2)
+        message = 'x' * 998
+        for i in range(1000):
+            self.ws.send(message)
+            self.assertTrue(self.ws.buffered_amount <= 20000)
+        self.ws.close()
+        reader.join()
+        self.assertEquals(received,
+            [('\x00' + message + '\xff') * 1000 + '\xff\x00'])
+
+    def test_socket_with_timeout(self):
+        # e.g. set by the WSGI server
+        self.server.settimeout(5)
+        self.ws.enable_write_buffer(policy='drop')
+        start = time.time()
+        for i in range(100):
+            self.ws.send('x' * 998)
+        self.assertTrue(time.time() - start < 1)
+        self.assertTrue(self.ws.buffered_amount > 0)
+        self.assertFalse(self.ws.flush())
+
+    def test_flush(self):
+        self.ws.enable_write_buffer()
+        self.ws.send_many(['x' * 998] * 100)
+        self.assertTrue(self.ws.buffered_amount > 0)
+        self.assertFalse(self.ws.flush())
+        self.assertFalse(self.ws.flush(timeout=0.01))
+        reader, received = self.start_reader(100000 + 4)
+        self.ws.send('xx')
+        self.assertTrue(self.ws.flush(timeout=None))
+        reader.join()
+        self.assertEquals(len(received[0]), 100000 + 4)
+
+    def test_coalescing(self):
+        # the thread of the shared flusher mustn't outlive the tests
+        self.addCleanup(flusher.stop)
+        self.ws.enable_coalescing(delay=0.05, max_bytes=100)
+        for i in range(10):
+            self.ws.send('spam')
+        self.assertEquals(self.ws.buffered_amount, 60)
+        self.client.settimeout(1)
+        self.assertEquals(self.client.recv(1000), '\x00spam\xff' * 10)
+        self.assertEquals(self.ws.buffered_amount, 0)
+        # the threshold flushes right away
+        self.ws.send('x' * 98)
+        self.assertEquals(self.ws.buffered_amount, 0)
+        self.assertEquals(len(self.client.recv(1000)), 100)
+        self.ws.send('spam')
+        self.assertTrue(self.ws.flush())
+        self.assertEquals(self.client.recv(1000), '\x00spam\xff')
+
+    def test_flusher(self):
+        scheduler = Flusher()
+        self.addCleanup(scheduler.stop)
+        websocket = Mock()
+        scheduler.schedule(0.5, websocket)
+        self.assertEquals(scheduler.run_pending(), 0)
+        self.assertEquals(scheduler.run_pending(time.time() + 1), 1)
+        websocket._flush_coalesced.assert_called_once_with()
+        self.assertEquals(len(scheduler), 0)
+
+
+class TimerWheelTests(TestCase):
+    def test_timers_fire_in_order(self):
+        wheel = TimerWheel(tick=1.0, slots=8)
+        fired = []
+        for delay in (20, 0.5, 3, 8, 9):
+            wheel.schedule(delay, fired.append, delay)
+        cancelled = wheel.schedule(2, fired.append, 'cancelled')
+        self.assertEquals(len(wheel), 6)
+        wheel.cancel(cancelled)
+        self.assertEquals(len(wheel), 5)
+
+        start = wheel._epoch
+        self.assertEquals(wheel.advance(start + 0.9), 0)
+        self.assertEquals(wheel.advance(start + 1), 1)
+        self.assertEquals(wheel.advance(start + 8), 2)
+        self.assertEquals(fired, [0.5, 3, 8])
+        self.assertEquals(wheel.advance(start + 30), 2)
+        self.assertEquals(fired, [0.5, 3, 8, 9, 20])
+        self.assertEquals(len(wheel), 0)
+
+    def test_failing_callback(self):
+        wheel = TimerWheel(tick=1.0)
+        fired = []
+        wheel.schedule(1, lambda: 1 / 0)
+        wheel.schedule(1, fired.append, True)
+        wheel.advance(wheel._epoch + 1)
+        self.assertEquals(fired, [True])
+
+    def test_thread(self):
+        wheel = TimerWheel(tick=0.01)
+        event = threading.Event()
+        wheel.schedule(0.02, event.set)
+        wheel.start()
+        self.addCleanup(wheel.stop)
+        self.assertTrue(event.wait(5))
+
+
+class KeepAliveTests(TestCase):
+    def setUp(self):
+        self.server, self.client = socket.socketpair()
+        self.addCleanup(self.server.close)
+        self.addCleanup(self.client.close)
+        self.ws = HybiWebSocket(self.server, None)
+        self.keepalive = KeepAlive(ping_interval=10, timeout=30,
+            wheel=TimerWheel())
+        self.keepalive.register(self.ws)
+
+    def test_idle_client_is_pinged(self):
+        self.keepalive._check(self.ws)
+        self.assertFalse(self.ws.closed)
+        self.ws.last_activity -= 15
+        self.keepalive._check(self.ws)
+        self.assertEquals(self.client.recv(100), pack_hybi_frame(PING, ''))
+        self.assertTrue(self.ws in self.keepalive)
+
+    def test_pong_counts_as_activity(self):
+        self.ws.last_activity -= 40
+        self.client.sendall(client_frame(PONG, ''))
+        self.assertEquals(self.ws.read(), None)
+        self.assertTrue(time.time() - self.ws.last_activity < 10)
+        self.keepalive._check(self.ws)
+        self.assertFalse(self.ws.closed)
+
+    def test_incomplete_frames_are_no_activity(self):
+        self.ws.last_activity -= 40
+        self.client.sendall(client_frame(TEXT, 'spam')[:3])
+        self.assertEquals(self.ws.read(), None)
+        self.keepalive._check(self.ws)
+        self.assertTrue(self.ws.closed)
+
+    def test_unregister_while_checked(self):
+        self.ws.last_activity -= 15
+        # e.g. the view unregisters it meanwhile
+        self.ws._write_nowait = Mock(
+            side_effect=lambda frame: self.keepalive.unregister(self.ws))
+        self.keepalive._check(self.ws)
+        self.assertEquals(self.ws._write_nowait.call_count, 1)
+        self.assertFalse(self.ws in self.keepalive)
+        self.assertEquals(len(self.keepalive.wheel), 0)
+
+    def test_dead_client_is_closed(self):
+        result = []
+        thread = threading.Thread(target=lambda: result.append(self.ws.wait()))
+        thread.start()
+        self.ws.last_activity -= 40
+        self.keepalive._check(self.ws)
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEquals(result, [None])
+        self.assertTrue(self.ws.closed)
+        self.assertFalse(self.ws in self.keepalive)
+        self.assertEquals(self.client.recv(100),
+            pack_hybi_frame(CLOSE, pack_close_payload(1001)))
+        self.assertEquals(self.client.recv(100), '')
+
+    def test_hixie_message(self):
+        ws = WebSocket(self.server, None)
+        keepalive = KeepAlive(ping_interval=10, timeout=30,
+            wheel=TimerWheel(), hixie_message='ping')
+        keepalive.register(ws)
+        ws.last_activity -= 15
+        keepalive._check(ws)
+        self.assertEquals(self.client.recv(100), '\x00ping\xff')
+
+    def test_closed_websockets_are_dropped(self):
+        self.ws.close()
+        self.keepalive._check(self.ws)
+        self.assertEquals(len(self.keepalive), 0)
+        self.assertEquals(len(self.keepalive.wheel), 0)
+
+
+class RecordingHandler(WebSocketHandler):
+    def __init__(self):
+        self.events = []
+
+    def on_open(self, websocket):
+        self.events.append('open')
+
+    def on_message(self, websocket, message):
+        self.events.append(message)
+        if message == 'fail':
+            raise ValueError(message)
+        websocket.send(message)
+
+    def on_close(self, websocket):
+        self.events.append('close')
+
+
+class HandoffTests(TestCase):
+    def setUp(self):
+        self.server, self.client = socket.socketpair()
+        self.addCleanup(self.server.close)
+        self.addCleanup(self.client.close)
+        self.client.settimeout(5)
+        self.service = WebSocketService()
+        self.addCleanup(self.service.close)
+        self.handler = RecordingHandler()
+
+    def test_detach_connection(self):
+        websocket_socket = self.server.dup()
+        self.addCleanup(websocket_socket.close)
+        placeholder = detach_connection(self.server)
+        self.addCleanup(placeholder.close)
+        self.server.sendall('HTTP/1.1 200 OK\r\n\r\n')
+        self.assertEquals(self.server.recv(100), '')
+        websocket_socket.sendall('spam')
+        self.assertEquals(self.client.recv(100), 'spam')
+        self.assertEquals(placeholder.recv(100), 'HTTP/1.1 200 OK\r\n\r\n')
+
+    def test_service(self):
+        ws = HybiWebSocket(self.server, None)
+        self.service.adopt(ws, self.handler)
+        self.service.serve_once(0)
+        self.assertTrue(ws in self.service)
+        self.client.sendall(client_frame(TEXT, 'spam'))
+        self.service.serve_once(5)
+        self.assertEquals(self.client.recv(100), pack_hybi_frame(TEXT, 'spam'))
+        self.client.sendall(client_frame(CLOSE, pack_close_payload(1000)))
+        self.service.serve_once(5)
+        self.assertEquals(self.handler.events, ['open', u'spam', 'close'])
+        self.assertEquals(len(self.service), 0)
+        self.assertEquals(self.client.recv(100),
+            pack_hybi_frame(CLOSE, pack_close_payload(1000)))
+        self.assertEquals(self.client.recv(100), '')
+
+    def test_failing_handler(self):
+        ws = HybiWebSocket(self.server, None)
+        self.service.adopt(ws, self.handler)
+        self.client.sendall(client_frame(TEXT, 'fail') +
+            client_frame(TEXT, 'spam'))
+        self.service.serve_once(5)
+        self.assertEquals(self.handler.events, ['open', u'fail', 'close'])
+        self.assertEquals(len(self.service), 0)
+        self.assertEquals(self.client.recv(100),
+            pack_hybi_frame(CLOSE, pack_close_payload(1011)))
+
+    def test_handoff(self):
+        @require_websocket
+        def view(request):
+            handoff(request, self.handler, self.service)
+        request = RequestFactory().get('/chat/',
+            HTTP_CONNECTION='Upgrade',
+            HTTP_UPGRADE='websocket',
+            HTTP_SEC_WEBSOCKET_VERSION='13',
+            HTTP_SEC_WEBSOCKET_KEY='dGhlIHNhbXBsZSBub25jZQ==')
+        request.META['wsgi.input'] = Mock()
+        request.META['wsgi.input']._sock = self.server
+        response = view(request)
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue(request.websocket.handed_off)
+        self.assertFalse(request.websocket.closed)
+        # The server writes its response to the placeholder.
+        self.server.sendall('HTTP/1.1 200 OK\r\n\r\n')
+        self.server.close()
+
+        self.client.sendall(client_frame(TEXT, 'spam'))
+        reply = request.websocket.handshake_reply
+        self.assertEquals(recv_exactly(self.client, len(reply)), reply)
+        self.assertEquals(self.client.recv(100), pack_hybi_frame(TEXT, 'spam'))
+        self.service.stop()
+        self.assertEquals(self.handler.events, ['open', u'spam'])
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        self.server, self.client = socket.socketpair()
+        self.addCleanup(self.server.close)
+        self.addCleanup(self.client.close)
+        self.registry = MetricsRegistry()
+
+    def test_histogram(self):
+        histogram = Histogram((1, 2, 3))
+        for value in (0.5, 1, 1.5, 2.5, 10):
+            histogram.observe(value)
+        self.assertEquals(histogram.counts, [2, 1, 1, 1])
+        self.assertEquals(histogram.quantile(0.5), 2)
+        self.assertEquals(histogram.quantile(0.99), None)
+        other = Histogram((1, 2, 3))
+        other.observe(3)
+        histogram.merge(other)
+        self.assertEquals(histogram.counts, [2, 1, 2, 1])
+        self.assertEquals(histogram.sum, 18.5)
+
+    def test_connection_metrics(self):
+        ws = HybiWebSocket(self.server, None, handshake_reply='HTTP/1.1 101')
+        ws.enable_metrics(self.registry)
+        ws.send_handshake()
+        self.assertTrue(ws.metrics.handshake_time >= 0)
+        frames = client_frame(TEXT, 'spam') + client_frame(PING, '') + \
+            client_frame(TEXT, 'eggs')
+        self.client.sendall(frames)
+        self.assertEquals(ws.wait(), u'spam')
+        self.assertEquals(ws.metrics.bytes_in, len(frames))
+        self.assertEquals(ws.metrics.frames_in, 3)
+        self.assertEquals(ws.metrics.frames_out, 1)
+        ws.send('ham')
+        ws.send_many(['a', 'b'])
+        self.assertEquals(ws.metrics.frames_out, 4)
+        self.assertEquals(ws.metrics.bytes_out, len(pack_hybi_frame(PONG, '')) +
+            len(pack_hybi_frame(TEXT, 'ham')) + 2 * len(pack_hybi_frame(TEXT, 'a')))
+        self.assertEquals(ws.metrics.send_latency.count, 3)
+
+        snapshot = self.registry.snapshot(connections=True)
+        self.assertEquals(snapshot['connections'], 1)
+        self.assertEquals(snapshot['frames_in'], 3)
+        self.assertEquals(snapshot['queued_messages'], 1)
+        self.assertEquals(snapshot['handshake_time']['count'], 1)
+        self.assertEquals(snapshot['connection_metrics'][0]['frames_out'], 4)
+
+        ws.close()
+        snapshot = self.registry.snapshot()
+        self.assertEquals(snapshot['connections'], 0)
+        self.assertEquals(snapshot['connections_total'], 1)
+        self.assertEquals(snapshot['frames_in'], 3)
+        self.assertEquals(snapshot['frames_out'], 5)
+        self.assertEquals(snapshot['send_latency']['count'], 4)
+        self.assertEquals(snapshot['lifetime']['count'], 1)
+        self.assertEquals(len(self.registry), 0)
+
+    def test_collected_websockets_are_retired(self):
+        ws = HybiWebSocket(self.server, None)
+        ws.enable_metrics(self.registry)
+        ws.send('spam')
+        self.assertTrue(ws in self.registry)
+        del ws
+        gc.collect()
+        self.assertEquals(len(self.registry), 0)
+        snapshot = self.registry.snapshot()
+        self.assertEquals(snapshot['connections'], 0)
+        self.assertEquals(snapshot['frames_out'], 1)
+        self.assertEquals(snapshot['bytes_out'],
+            len(pack_hybi_frame(TEXT, 'spam')))
+        self.assertEquals(snapshot['lifetime']['count'], 1)
+
+    def test_websockets_without_metrics(self):
+        ws = HybiWebSocket(self.server, None)
+        ws.send('spam')
+        self.assertEquals(ws.metrics, None)
+        self.assertEquals(self.registry.snapshot()['connections'], 0)
+
+
+class HixieParserTests(TestCase):
+    def test_many_frames_in_one_chunk(self):
+        parser = HixieParser()
+        parser.feed('\x00spam\xFF\x00\xFF\x00eggs\xFF\x00ham')
+        self.assertEquals(parser.parse(),
+            [(TEXT, 'spam'), (TEXT, ''), (TEXT, 'eggs')])
+        self.assertEquals(len(parser), 4)
+        parser.feed('\xFF')
+        self.assertEquals(parser.parse(), [(TEXT, 'ham')])
+        self.assertEquals(len(parser), 0)
+
+    def test_frame_split_at_every_byte(self):
+        data = '\x00spam & eggs\xFF\x00K\xc3\xbcss\xFF\xFF\x00'
+        parser = HixieParser()
+        messages = []
+        for char in data:
+            parser.feed(char)
+            messages.extend(parser.parse())
+        self.assertEquals(messages, [
+            (TEXT, 'spam & eggs'), (TEXT, 'K\xc3\xbcss'), (CLOSE, '')])
+        self.assertTrue(parser.closed)
+
+    def test_terminator_is_not_rescanned(self):
+        parser = HixieParser()
+        parser.feed('\x00' + 'a' * 100)
+        self.assertEquals(parser.parse(), [])
+        self.assertEquals(parser._scanned, 101)
+        parser.feed('b' * 100 + '\xFF')
+        self.assertEquals(parser.parse(), [(TEXT, 'a' * 100 + 'b' * 100)])
+        self.assertEquals(parser._scanned, 0)
+
+    def test_closing_frame_waits_for_second_byte(self):
+        parser = HixieParser()
+        parser.feed('\x00spam\xFF\xFF')
+        self.assertEquals(parser.parse(), [(TEXT, 'spam')])
+        self.assertFalse(parser.closed)
+        parser.feed('\x00')
+        self.assertEquals(parser.parse(), [(CLOSE, '')])
+        self.assertTrue(parser.closed)
+
+    def test_closing_frame_after_messages(self):
+        parser = HixieParser()
+        parser.feed('\x00spam\xFF\x00eggs\xFF\xFF\x00\x00ham\xFF')
+        self.assertEquals(parser.parse(),
+            [(TEXT, 'spam'), (TEXT, 'eggs'), (CLOSE, '')])
+        self.assertTrue(parser.closed)
+
+    def test_invalid_frame_type(self):
+        for data in ('\x01spam\xFF', '\x00spam\xFF\x01eggs\xFF',
+            '\x00spam\xFF\xFF\x01'):
+            parser = HixieParser()
+            parser.feed(data)
+            self.assertRaises(FrameError, parser.parse)
+
+    def test_websocket_closes_on_invalid_frame(self):
+        socket = mock_socket()
+        socket.recv.return_value = '\x00spam\xFF\x80\x05hello'
+        ws = WebSocket(socket, None)
+        self.assertEquals(ws.wait(), None)
+        self.assertTrue(ws.closed)
+
 
+def client_frame(opcode, payload, fin=True):
+    return pack_hybi_frame(opcode, payload, fin=fin, mask='\x37\xfa\x21\x3d')
 
-@require_websocket
-def echo_once(request):
-    request.websocket.send(request.websocket.wait())
+
+class HybiParserTests(TestCase):
+    def test_unmask(self):
+        mask = '\x37\xfa\x21\x3d'
+        for length in (0, 1, 3, 4, 5, 125, 1000):
+            data = ''.join(chr(i % 256) for i in range(length))
+            expected = ''.join(chr(ord(char) ^ ord(mask[i % 4]))
+                for i, char in enumerate(data))
+            self.assertEquals(unmask(mask, data), expected)
+            self.assertEquals(unmask(mask, expected), data)
+            buf = bytearray('head' + data + 'tail')
+            unmask_into(mask, buf, 4, 4 + length)
+            self.assertEquals(str(buf), 'head' + expected + 'tail')
+
+    def test_masked_text_frame(self):
+        # example from section 5.7 of RFC 6455
+        parser = HybiParser()
+        parser.feed('\x81\x85\x37\xfa\x21\x3d\x7f\x9f\x4d\x51\x58')
+        self.assertEquals(parser.parse(), [(TEXT, 'Hello')])
+        self.assertEquals(len(parser), 0)
+
+    def test_payload_lengths(self):
+        for length in (125, 126, 65535, 65536):
+            parser = HybiParser()
+            parser.feed(client_frame(BINARY, 'x' * length))
+            messages = parser.parse()
+            self.assertEquals(messages, [(BINARY, 'x' * length)])
+            self.assertTrue(type(messages[0][1]) is bytes)
+
+    def test_fragments_split_at_every_byte(self):
+        data = (
+            client_frame(TEXT, 'spam', fin=False) +
+            client_frame(PING, 'ping') +
+            client_frame(CONTINUATION, ' & ', fin=False) +
+            client_frame(CONTINUATION, 'eggs') +
+            client_frame(CLOSE, pack_close_payload(1000)))
+        parser = HybiParser()
+        messages = []
+        for char in data:
+            parser.feed(char)
+            messages.extend(parser.parse())
+        self.assertEquals(messages, [
+            (PING, 'ping'),
+            (TEXT, 'spam & eggs'),
+            (CLOSE, '\x03\xe8')])
+        self.assertTrue(parser.closed)
+
+    def test_protocol_errors(self):
+        invalid = (
+            pack_hybi_frame(TEXT, 'unmasked'),
+            client_frame(CONTINUATION, 'no message'),
+            client_frame(PING, 'fragmented', fin=False),
+            client_frame(PING, 'x' * 126),
+            client_frame(0x3, 'reserved opcode'),
+            client_frame(TEXT, 'a', fin=False) + client_frame(TEXT, 'b'),
+        )
+        for data in invalid:
+            parser = HybiParser()
+            parser.feed(data)
+            self.assertRaises(FrameError, parser.parse)
+
+    def test_unmasked_frames_from_server(self):
+        parser = HybiParser(mask_required=False)
+        parser.feed(pack_hybi_frame(TEXT, 'Hello'))
+        self.assertEquals(parser.parse(), [(TEXT, 'Hello')])
+
+
+class ReceiveBufferTests(TestCase):
+    def test_buffer_is_reused(self):
+        parser = HybiParser()
+        frame = client_frame(TEXT, 'a' * 100)
+        data = frame * 1000
+        capacity = len(parser.buffer)
+        messages = []
+        # Chunks end in the middle of frames, so partial frames need to be
+        # moved to the front of the buffer.
+        for i in range(0, len(data), 1337):
+            parser.feed(data[i:i + 1337])
+            messages.extend(parser.parse())
+        self.assertEquals(messages, [(TEXT, 'a' * 100)] * 1000)
+        self.assertEquals(len(parser.buffer), capacity)
+
+    def test_buffer_grows_and_shrinks(self):
+        parser = HixieParser()
+        parser.feed('\x00' + 'a' * 1000000)
+        self.assertEquals(parser.parse(), [])
+        self.assertTrue(len(parser.buffer) >= 1000001)
+        parser.feed('\xff\x00spam')
+        self.assertEquals(parser.parse(), [(TEXT, 'a' * 1000000)])
+        parser.feed('\xff')
+        self.assertEquals(parser.parse(), [(TEXT, 'spam')])
+        self.assertEquals(len(parser), 0)
+        self.assertEquals(len(parser.buffer), 4096)
+
+    def test_recv_into(self):
+        server, client = socket.socketpair()
+        self.addCleanup(server.close)
+        self.addCleanup(client.close)
+        ws = HybiWebSocket(server, None)
+        message = 'x' * 1000000
+        thread = threading.Thread(target=client.sendall,
+            args=(client_frame(BINARY, message),))
+        thread.start()
+        self.assertEquals(ws.wait(), message)
+        thread.join()
+        # The reads grew with the announced size of the frame.
+        self.assertTrue(ws._recv_size > ws._socket_recv_bytes)
+
+        for i in range(10):
+            client.sendall(client_frame(TEXT, 'spam'))
+            self.assertEquals(ws.wait(), u'spam')
+        self.assertEquals(ws._recv_size, ws._socket_recv_bytes)
+
+
+class HybiWebSocketTests(TestCase):
+    def setUp(self):
+        self.socket = mock_socket()
+
+    def receive(self, *chunks):
+        chunks = list(chunks[::-1])
+        self.socket.recv.side_effect = lambda *args, **kwargs: chunks.pop()
+
+    def test_message_sending(self):
+        ws = HybiWebSocket(self.socket, None)
+        ws.send(u'Küss')
+        self.assertEquals(self.socket.sendall.call_args,
+            (('\x81\x05K\xc3\xbcss',), {}))
+
+    def test_message_receiving(self):
+        ws = HybiWebSocket(self.socket, None)
+        self.receive(
+            client_frame(TEXT, 'K\xc3\xbcss') + client_frame(BINARY, '\x00\xff'),
+            client_frame(CLOSE, pack_close_payload(1001)))
+        self.assertEquals(list(ws), [u'Küss', '\x00\xff'])
+        self.assertTrue(ws.closed)
+        self.assertEquals(ws.close_code, 1001)
+        # the close frame is echoed
+        self.assertEquals(self.socket.sendall.call_args,
+            ((pack_hybi_frame(CLOSE, pack_close_payload(1001)),), {}))
+
+    def test_ping_is_answered(self):
+        ws = HybiWebSocket(self.socket, None)
+        self.receive(client_frame(PING, 'hello'), client_frame(TEXT, 'spam'))
+        self.assertEquals(ws.wait(), u'spam')
+        self.assertEquals(self.socket.sendall.call_args,
+            ((pack_hybi_frame(PONG, 'hello'),), {}))
+
+    def test_protocol_error_closes_websocket(self):
+        ws = HybiWebSocket(self.socket, None)
+        self.receive(pack_hybi_frame(TEXT, 'unmasked'))
+        self.assertEquals(ws.wait(), None)
+        self.assertTrue(ws.closed)
+        self.assertEquals(self.socket.sendall.call_args,
+            ((pack_hybi_frame(CLOSE, pack_close_payload(1002)),), {}))
+
+    def test_closing_socket_by_server(self):
+        ws = HybiWebSocket(self.socket, None)
+        ws.close()
+        ws.close()
+        self.assertEquals(self.socket.sendall.call_count, 1)
+        self.assertEquals(self.socket.sendall.call_args,
+            ((pack_hybi_frame(CLOSE, pack_close_payload(1000)),), {}))
+        self.assertEquals(self.socket.close.call_count, 0)
+
+    def test_receiving_bytes(self):
+        ws = HybiWebSocket(self.socket, None)
+        self.receive(client_frame(TEXT, 'K\xc3\xbcss') * 3)
+        message = ws.wait_bytes()
+        self.assertEquals(message, 'K\xc3\xbcss')
+        self.assertEquals(type(message), str)
+        self.assertEquals(ws.read_bytes(), 'K\xc3\xbcss')
+        # decoding is up to the read call, not to the time of receiving
+        self.assertEquals(ws.read(), u'Küss')
+
+        ws = HybiWebSocket(self.socket, None, decode=False)
+        self.receive(client_frame(TEXT, 'K\xc3\xbcss'), '')
+        self.assertEquals(list(ws), ['K\xc3\xbcss'])
+
+    def test_binary_sending(self):
+        ws = HybiWebSocket(self.socket, None)
+        ws.send('\x00\xff', binary=True)
+        self.assertEquals(self.socket.sendall.call_args,
+            ((pack_hybi_frame(BINARY, '\x00\xff'),), {}))
+        ws.send(memoryview('\x00\xff'), binary=True)
+        self.assertEquals(self.socket.sendall.call_args,
+            ((pack_hybi_frame(BINARY, '\x00\xff'),), {}))
+        ws.send_many(['\x00', '\xff'], binary=True)
+        self.assertEquals(self.socket.sendall.call_args,
+            ((pack_hybi_frame(BINARY, '\x00') +
+                pack_hybi_frame(BINARY, '\xff'),), {}))
+
+        ws = WebSocket(self.socket, None)
+        self.assertRaises(ValueError, ws.send, '\x00\xff', binary=True)
+        self.assertRaises(ValueError, ws.send_many, ['\x00'], binary=True)
+
+
+
+class StreamTests(TestCase):
+    def setUp(self):
+        self.socket = mock_socket()
+
+    def receive(self, *chunks):
+        chunks = list(chunks[::-1])
+        self.socket.recv.side_effect = lambda *args, **kwargs: chunks.pop()
+
+    def sent(self):
+        return ''.join(call[0][0] for call in self.socket.sendall.call_args_list)
+
+    def test_send_stream(self):
+        ws = HybiWebSocket(self.socket, None)
+        ws.send_stream(StringIO('x' * 10), chunk_size=4)
+        self.assertEquals(self.sent(),
+            pack_hybi_frame(TEXT, 'xxxx', fin=False) +
+            pack_hybi_frame(CONTINUATION, 'xxxx', fin=False) +
+            pack_hybi_frame(CONTINUATION, 'xx'))
+        parser = HybiParser(mask_required=False)
+        self.socket.sendall.reset_mock()
+        ws.send_stream(iter(['\x00', '', '\xff']), binary=True)
+        ws.send_stream([])
+        parser.feed(self.sent())
+        self.assertEquals(parser.parse(), [(BINARY, '\x00\xff'), (TEXT, '')])
+
+    def test_send_stream_with_deflate(self):
+        ws = HybiWebSocket(self.socket, None, deflate=PerMessageDeflate())
+        message = '{"event": "update", "value": 42}' * 1000
+        ws.send_stream(StringIO(message), chunk_size=1000)
+        parser = HybiParser(mask_required=False, deflate=PerMessageDeflate())
+        parser.feed(self.sent())
+        self.assertEquals(parser.parse(), [(TEXT, message)])
+        self.assertTrue(len(self.sent()) < len(message) // 10)
+
+    def test_failing_send_stream(self):
+        def chunks():
+            yield 'spam'
+            yield 'eggs'
+            raise IOError('broken file')
+        ws = HybiWebSocket(self.socket, None)
+        self.assertRaises(IOError, ws.send_stream, chunks())
+        self.assertTrue(ws.closed)
+        self.assertEquals(self.sent(), pack_hybi_frame(TEXT, 'spam', fin=False) +
+            pack_hybi_frame(CLOSE, pack_close_payload(1011)))
+        ws = WebSocket(self.socket, None)
+        self.assertRaises(IOError, ws.send_stream, chunks())
+        self.assertTrue(ws.closed)
+        self.socket.shutdown.assert_called_once_with(socket.SHUT_RDWR)
+
+    def test_wait_stream(self):
+        ws = HybiWebSocket(self.socket, None, max_message_size=10)
+        frames = client_frame(TEXT, 'a' * 8, fin=False) + \
+            client_frame(PING, '') + client_frame(CONTINUATION, 'b' * 8)
+        # the frames arrive a few bytes at a time
+        self.receive(frames[:5], frames[5:13], frames[13:],
+            client_frame(TEXT, 'spam'))
+        self.assertEquals(list(ws.wait_stream()),
+            ['aaaaaaa', 'a', 'bbbbbbbb'])
+        self.assertEquals(self.socket.sendall.call_args,
+            ((pack_hybi_frame(PONG, ''),), {}))
+        # the next message is read as usual
+        self.assertEquals(ws.wait(), u'spam')
+        self.assertFalse(ws.closed)
+
+    def test_wait_stream_with_deflate(self):
+        deflate = PerMessageDeflate()
+        message = '{"event": "update", "value": 42}' * 10000
+        payload = PerMessageDeflate().compress(message)
+        frame = pack_hybi_frame(TEXT, payload, mask='\x37\xfa\x21\x3d',
+            rsv1=True)
+        ws = HybiWebSocket(self.socket, None, deflate=deflate)
+        self.receive(frame[:100], frame[100:])
+        chunks = list(ws.wait_stream())
+        self.assertTrue(len(chunks) > 1)
+        self.assertEquals(''.join(chunks), message)
+
+    def test_wait_stream_skips_the_rest(self):
+        ws = HybiWebSocket(self.socket, None)
+        self.receive(client_frame(BINARY, 'x' * 10)[:8],
+            client_frame(BINARY, 'x' * 10)[8:] + client_frame(TEXT, 'spam'))
+        for chunk in ws.wait_stream():
+            break
+        self.assertEquals(ws.wait(), u'spam')
+
+    def test_wait_stream_after_complete_message(self):
+        server, client = socket.socketpair()
+        ws = HybiWebSocket(server, None)
+        client.sendall(client_frame(TEXT, 'spam') + client_frame(TEXT, 'eggs'))
+        self.assertTrue(ws.has_messages())
+        self.assertEquals(list(ws.wait_stream()), ['spam'])
+        self.assertEquals(ws.read(), u'eggs')
+        server.close()
+        client.close()
+
+    def test_hixie_stream(self):
+        ws = WebSocket(self.socket, None)
+        ws.send_stream(iter(['spam', u'K\xfcss']))
+        self.assertEquals(self.sent(), '\x00spamK\xc3\xbcss\xff')
+        self.receive('\x00sp', 'am', '\xff\x00eggs\xff', '\xff\x00')
+        self.assertEquals(list(ws.wait_stream()), ['sp', 'am'])
+        self.assertEquals(ws.wait(), u'eggs')
+        self.assertEquals(list(ws.wait_stream()), [])
+        self.assertTrue(ws.closed)
+
+
+class SendFileTests(TestCase):
+    def setUp(self):
+        self.server, self.client = socket.socketpair()
+        self.client.settimeout(1)
+        self.file = tempfile.TemporaryFile()
+        self.file.write(''.join(chr(i % 256) for i in range(100000)))
+        self.file.flush()
+
+    def tearDown(self):
+        self.file.close()
+        self.server.close()
+        self.client.close()
+
+    def receive(self, size):
+        data = ''
+        while len(data) < size:
+            chunk = self.client.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def test_send_file(self):
+        ws = HybiWebSocket(self.server, None)
+        ws.enable_metrics(MetricsRegistry())
+        reader = threading.Thread(target=lambda:
+            received.append(self.receive(10 + 100000 + 2 + 10)))
+        received = []
+        reader.start()
+        ws.send_file(self.file)
+        ws.send_file(self.file, offset=10, count=10, binary=False)
+        reader.join()
+        self.file.seek(0)
+        content = self.file.read()
+        self.assertEquals(received, [pack_hybi_frame(BINARY, content) +
+            pack_hybi_frame(TEXT, content[10:20])])
+        self.assertEquals(ws.metrics.frames_out, 2)
+        self.assertEquals(ws.metrics.bytes_out, 10 + 100000 + 2 + 10)
+
+    def test_send_file_hixie(self):
+        ws = WebSocket(self.server, None)
+        ws.send_file(StringIO('spam and eggs'), offset=5, count=3,
+            binary=False)
+        self.assertEquals(self.receive(5), '\x00and\xff')
+        self.assertRaises(ValueError, ws.send_file, self.file)
+
+    def test_file_ends_early(self):
+        ws = HybiWebSocket(self.server, None)
+        self.assertRaises(IOError, ws.send_file, self.file, 99990, 20)
+        self.assertTrue(ws.closed)
+        self.file.seek(99990)
+        self.assertEquals(self.receive(100), '\x82\x14' + self.file.read())
+
+
+class PerMessageDeflateTests(TestCase):
+    def test_negotiate(self):
+        extension, response = PerMessageDeflate.negotiate(
+            'x-webkit-deflate-frame, '
+            'permessage-deflate; client_max_window_bits')
+        self.assertEquals(response,
+            'permessage-deflate; client_max_window_bits=15')
+        self.assertTrue(extension.server_context_takeover)
+        self.assertTrue(extension.client_context_takeover)
+
+    def test_negotiate_limits(self):
+        extension, response = PerMessageDeflate.negotiate(
+            'permessage-deflate; server_max_window_bits=11; '
+            'client_max_window_bits=14',
+            window_bits=12, context_takeover=False, min_size=10)
+        self.assertEquals(response, 'permessage-deflate; '
+            'server_max_window_bits=11; client_max_window_bits=12; '
+            'server_no_context_takeover; client_no_context_takeover')
+        self.assertEquals(extension.server_window_bits, 11)
+        self.assertEquals(extension.client_window_bits, 12)
+        self.assertEquals(extension.min_size, 10)
+
+    def test_negotiate_smallest_window(self):
+        # zlib compresses with a window of at least 512 bytes
+        for header in ('permessage-deflate; client_max_window_bits',
+            'permessage-deflate; server_max_window_bits=12; '
+            'client_max_window_bits'):
+            extension, response = PerMessageDeflate.negotiate(header,
+                window_bits=8)
+            self.assertEquals(response, 'permessage-deflate; '
+                'server_max_window_bits=9; client_max_window_bits=8')
+            self.assertEquals(extension.server_window_bits, 9)
+            self.assertEquals(extension.client_window_bits, 8)
+
+    def test_negotiate_rejects_invalid_offers(self):
+        for header in (
+            'permessage-deflate; foo=bar',
+            'permessage-deflate; server_max_window_bits=8',
+            'permessage-deflate; client_max_window_bits=16',
+            'x-webkit-deflate-frame'):
+            self.assertEquals(PerMessageDeflate.negotiate(header),
+                (None, None))
+
+    def test_compress_with_context_takeover(self):
+        deflate = PerMessageDeflate()
+        message = '{"event": "update", "value": 42}' * 10
+        first = deflate.compress(message)
+        second = deflate.compress(message)
+        self.assertTrue(len(second) < len(first) < len(message))
+        self.assertEquals(deflate.decompress(first), message)
+        self.assertEquals(deflate.decompress(second), message)
+
+    def test_release(self):
+        deflate = PerMessageDeflate()
+        deflate.decompress(deflate.compress('spam'))
+        deflate.release()
+        self.assertEquals(deflate._compressor, None)
+        # the client may still refer to earlier messages
+        self.assertNotEquals(deflate._decompressor, None)
+
+        deflate = PerMessageDeflate(client_context_takeover=False)
+        deflate.decompress(deflate.compress('spam'))
+        self.assertEquals(deflate._decompressor, None)
+
+    def test_websocket_compression(self):
+        socket = mock_socket()
+        ws = HybiWebSocket(socket, None,
+            deflate=PerMessageDeflate(min_size=10))
+        ws.send('spam')
+        self.assertEquals(socket.sendall.call_args,
+            ((pack_hybi_frame(TEXT, 'spam'),), {}))
+        ws.send('spam' * 10)
+        frame = socket.sendall.call_args[0][0]
+        self.assertEquals(frame[0], '\xc1')
+        self.assertEquals(PerMessageDeflate().decompress(frame[2:]),
+            'spam' * 10)
+
+        compressed = PerMessageDeflate().compress('eggs' * 10)
+        socket.recv.return_value = pack_hybi_frame(TEXT, compressed,
+            mask='abcd', rsv1=True)
+        self.assertEquals(ws.wait(), 'eggs' * 10)
+
+    def test_compressed_frame_without_extension(self):
+        socket = mock_socket()
+        ws = HybiWebSocket(socket, None)
+        socket.recv.return_value = pack_hybi_frame(TEXT,
+            PerMessageDeflate().compress('spam'), mask='abcd', rsv1=True)
+        self.assertEquals(ws.wait(), None)
+        self.assertTrue(ws.closed)
+
+
+class LimitTests(TestCase):
+    def assertFrameError(self, parser, code=1009):
+        try:
+            parser.parse()
+        except FrameError, e:
+            self.assertEquals(e.code, code)
+        else:
+            self.fail('FrameError not raised')
+
+    def test_hixie_message_size(self):
+        parser = HixieParser(max_message_size=10)
+        parser.feed('\x00' + 'a' * 10 + '\xff\x00' + 'a' * 10)
+        self.assertEquals(parser.parse(), [(TEXT, 'a' * 10)])
+        # detected before the terminator arrives
+        parser.feed('a')
+        self.assertFrameError(parser)
+        parser = HixieParser(max_message_size=10)
+        parser.feed('\x00a\xff\x00' + 'a' * 11 + '\xff')
+        self.assertFrameError(parser)
+
+    def test_hixie_buffer_size(self):
+        parser = HixieParser(max_buffer_size=10)
+        parser.feed('\x00' + 'a' * 20 + '\xff\x00aaaa')
+        self.assertEquals(parser.parse(), [(TEXT, 'a' * 20)])
+        parser.feed('a' * 6)
+        self.assertFrameError(parser)
+
+    def test_hybi_message_size(self):
+        parser = HybiParser(max_message_size=10)
+        parser.feed(client_frame(TEXT, 'a' * 10))
+        self.assertEquals(parser.parse(), [(TEXT, 'a' * 10)])
+        # detected as soon as the header is complete
+        parser.feed(client_frame(TEXT, 'a' * 1000)[:8])
+        self.assertFrameError(parser)
+
+    def test_hybi_fragmented_message_size(self):
+        parser = HybiParser(max_message_size=10)
+        parser.feed(client_frame(TEXT, 'a' * 6, fin=False))
+        parser.feed(client_frame(CONTINUATION, 'a' * 6))
+        self.assertFrameError(parser)
+
+    def test_hybi_decompressed_message_size(self):
+        deflate = PerMessageDeflate()
+        parser = HybiParser(max_message_size=1000, deflate=deflate)
+        parser.feed(pack_hybi_frame(TEXT, deflate.compress('a' * 1001),
+            mask='abcd', rsv1=True))
+        self.assertFrameError(parser)
+
+    def test_websocket_closes_on_violation(self):
+        socket = mock_socket()
+        socket.recv.return_value = '\x00' + 'a' * 100
+        ws = WebSocket(socket, None, max_message_size=10)
+        self.assertEquals(ws.wait(), None)
+        self.assertTrue(ws.closed)
+        self.assertEquals(socket.sendall.call_args, (('\xff\x00',), {}))
+
+        socket = mock_socket()
+        socket.recv.return_value = client_frame(TEXT, 'a' * 100)
+        ws = HybiWebSocket(socket, None, max_message_size=10)
+        self.assertEquals(ws.wait(), None)
+        self.assertEquals(socket.sendall.call_args,
+            ((pack_hybi_frame(CLOSE, pack_close_payload(1009)),), {}))
+
+    def test_max_queued_messages(self):
+        socket = mock_socket()
+        socket.recv.return_value = client_frame(TEXT, 'spam') * 3
+        ws = HybiWebSocket(socket, None, max_queued_messages=2)
+        self.assertEquals(list(ws), [u'spam'] * 3)
+        self.assertTrue(ws.closed)
+        self.assertEquals(socket.sendall.call_args,
+            ((pack_hybi_frame(CLOSE, pack_close_payload(1008)),), {}))
+
+
+class RateLimitTests(TestCase):
+    def test_token_bucket(self):
+        bucket = TokenBucket(8, burst=4)
+        # times that add up exactly
+        now = bucket.updated = 1000.0
+        self.assertEquals(bucket.take(3, now), 3)
+        self.assertEquals(bucket.take(3, now), 1)
+        self.assertEquals(bucket.take(1, now + 0.0625), 0)
+        self.assertEquals(bucket.take(1, now + 0.125), 1)
+        # refilled up to the burst
+        self.assertEquals(bucket.take(10, now + 10), 4)
+        bucket.spend(4, now + 10)
+        self.assertEquals(bucket.delay(now + 10), 0.5)
+        self.assertEquals(bucket.delay(now + 10.5), 0)
+        self.assertRaises(ValueError, TokenBucket, 0)
+
+    def test_drop(self):
+        limiter = RateLimiter(messages_per_second=2)
+        now = limiter.messages.updated
+        self.assertEquals(limiter.receive(100, 3, now), 2)
+        self.assertEquals(limiter.receive(100, 1, now), 0)
+        self.assertEquals(limiter.receive(100, 1, now + 0.5), 1)
+        self.assertEquals(limiter.dropped_messages, 2)
+        self.assertEquals(limiter.delay(now + 0.5), 0)
+
+        limiter = RateLimiter(bytes_per_second=100)
+        now = limiter.bytes.updated
+        self.assertEquals(limiter.receive(100, 5, now), 5)
+        # everything is dropped until the debt is paid back
+        self.assertEquals(limiter.receive(50, 5, now), 0)
+        self.assertEquals(limiter.receive(10, 5, now + 0.4), 0)
+        self.assertEquals(limiter.receive(10, 5, now + 1), 5)
+
+    def test_close(self):
+        limiter = RateLimiter(messages_per_second=2, policy='close')
+        now = limiter.messages.updated
+        self.assertEquals(limiter.receive(100, 2, now), 2)
+        self.assertEquals(limiter.receive(100, 1, now), None)
+        limiter = RateLimiter(bytes_per_second=100, policy='close')
+        self.assertEquals(limiter.receive(101, 0, limiter.bytes.updated),
+            None)
+        self.assertRaises(ValueError, RateLimiter, policy='spam')
+
+    def test_delay(self):
+        limiter = RateLimiter(messages_per_second=10, burst_messages=2,
+            policy='delay')
+        now = limiter.messages.updated
+        self.assertEquals(limiter.receive(100, 5, now), 5)
+        self.assertEquals(limiter.delay(now), 0.3)
+        self.assertEquals(limiter.delay(now + 0.31), 0)
+        self.assertEquals(limiter.dropped_messages, 0)
+
+    def test_parent(self):
+        shared = RateLimiter(messages_per_second=3)
+        first = RateLimiter(messages_per_second=2, parent=shared)
+        second = RateLimiter(parent=shared)
+        now = shared.messages.updated
+        self.assertEquals(first.receive(10, 5, now), 2)
+        self.assertEquals(second.receive(10, 5, now), 1)
+        self.assertEquals(shared.dropped_messages, 4)
+        delayed = RateLimiter(messages_per_second=1, policy='delay')
+        child = RateLimiter(parent=delayed)
+        child.receive(10, 3, delayed.messages.updated)
+        self.assertTrue(child.delay() > 1)
+
+    def test_websocket_drops_messages(self):
+        socket = mock_socket()
+        socket.recv.return_value = client_frame(TEXT, 'spam') * 3
+        ws = HybiWebSocket(socket, None)
+        ws.enable_rate_limit(messages_per_second=2)
+        self.assertEquals(ws._socket_recv(), True)
+        self.assertEquals(list(ws._message_queue), [(TEXT, 'spam')] * 2)
+        self.assertEquals(ws.rate_limiter.dropped_messages, 1)
+
+    def test_websocket_closes_on_flood(self):
+        socket = mock_socket()
+        socket.recv.return_value = client_frame(TEXT, 'spam') * 3
+        ws = HybiWebSocket(socket, None)
+        ws.enable_rate_limit(messages_per_second=2, policy='close')
+        self.assertEquals(ws.wait(), None)
+        self.assertTrue(ws.closed)
+        self.assertEquals(socket.sendall.call_args,
+            ((pack_hybi_frame(CLOSE, pack_close_payload(1008)),), {}))
+
+    def test_websocket_delays_reads(self):
+        server, client = socket.socketpair()
+        try:
+            ws = WebSocket(server, None)
+            ws.enable_rate_limit(messages_per_second=20, burst_messages=1,
+                policy='delay')
+            client.sendall('\x00a\xff\x00b\xff')
+            self.assertEquals(ws.wait(), u'a')
+            self.assertEquals(ws.read(), u'b')
+            client.sendall('\x00c\xff')
+            # not read until the limiter allows it
+            self.assertEquals(ws.read(), None)
+            start = time.time()
+            self.assertEquals(ws.wait(), u'c')
+            self.assertTrue(time.time() - start > 0.02)
+        finally:
+            server.close()
+            client.close()
+
+    def test_streamed_message_with_empty_limiter(self):
+        # chunks are never dropped and only the whole message is charged
+        for policy, tokens in (('drop', 0), ('close', 1)):
+            server, client = socket.socketpair()
+            try:
+                sender = WebSocket(client, None)
+                ws = WebSocket(server, None)
+                ws.enable_rate_limit(messages_per_second=1, burst_messages=1,
+                    policy=policy)
+                ws.rate_limiter.messages.tokens = tokens
+                sender.send_stream(StringIO('x' * 10), chunk_size=4)
+                server.settimeout(1)
+                self.assertEquals(''.join(ws.wait_stream()), 'x' * 10)
+                self.assertFalse(ws.closed)
+                self.assertFalse(ws._parser.streaming)
+            finally:
+                server.close()
+                client.close()
+
+    def test_stream_ends_within_one_read(self):
+        socket = mock_socket()
+        socket.recv.return_value = client_frame(TEXT, 'spam', fin=False) + \
+            client_frame(CONTINUATION, 'eggs') + \
+            client_frame(TEXT, 'ham') * 2
+        ws = HybiWebSocket(socket, None)
+        ws.enable_rate_limit(messages_per_second=2, burst_messages=2)
+        ws._parser.streaming = True
+        self.assertEquals(ws._socket_recv(), True)
+        # the complete messages after the stream are charged after it
+        self.assertEquals(list(ws._message_queue), [(TEXT, 'spam', False),
+            (TEXT, 'eggs', True), (TEXT, 'ham')])
+        self.assertEquals(ws.rate_limiter.dropped_messages, 1)
+
+    def test_poller_pauses_delayed_websockets(self):
+        server, client = socket.socketpair()
+        try:
+            ws = WebSocket(server, None)
+            ws.enable_rate_limit(messages_per_second=20, burst_messages=1,
+                policy='delay')
+            poller = WebSocketPoller()
+            poller.register(ws)
+            client.sendall('\x00a\xff\x00b\xff')
+            self.assertEquals(poller.poll(1), [(ws, [u'a', u'b'])])
+            client.sendall('\x00c\xff')
+            self.assertEquals(poller.poll(0), [])
+            self.assertEquals(poller.poll(1), [(ws, [u'c'])])
+            poller.unregister(ws)
+            poller.close()
+        finally:
+            server.close()
+            client.close()
+
+
+class HandshakeTests(TestCase):
+    def setUp(self):
+        self.rf = RequestFactory()
+
+    def test_hybi_handshake(self):
+        # example from section 1.3 of RFC 6455
+        request = self.rf.get('/chat/',
+            HTTP_CONNECTION='keep-alive, Upgrade',
+            HTTP_UPGRADE='websocket',
+            HTTP_SEC_WEBSOCKET_VERSION='13',
+            HTTP_SEC_WEBSOCKET_KEY='dGhlIHNhbXBsZSBub25jZQ==')
+        request.META['wsgi.input'] = Mock()
+        ws = setup_websocket(request)
+        self.assertTrue(isinstance(ws, HybiWebSocket))
+        self.assertEquals(ws.version, 13)
+        self.assertEquals(ws.handshake_reply,
+            'HTTP/1.1 101 Switching Protocols\r\n'
+            'Upgrade: websocket\r\n'
+            'Connection: Upgrade\r\n'
+            'Sec-WebSocket-Accept: s3pPLMBiTxaQ9kYGzzhZRbK+xOo=\r\n\r\n')
+
+    def test_hybi_handshake_with_deflate(self):
+        request = self.rf.get('/chat/',
+            HTTP_CONNECTION='Upgrade',
+            HTTP_UPGRADE='websocket',
+            HTTP_SEC_WEBSOCKET_VERSION='13',
+            HTTP_SEC_WEBSOCKET_KEY='dGhlIHNhbXBsZSBub25jZQ==',
+            HTTP_SEC_WEBSOCKET_EXTENSIONS='permessage-deflate')
+        request.META['wsgi.input'] = Mock()
+        ws = setup_websocket(request)
+        self.assertEquals(ws.deflate, None)
+        ws = setup_websocket(request, deflate={'window_bits': 10},
+            max_message_size=100)
+        self.assertEquals(ws.deflate.server_window_bits, 10)
+        self.assertEquals(ws._parser.max_message_size, 100)
+        self.assertTrue(ws.handshake_reply.endswith(
+            'Sec-WebSocket-Extensions: permessage-deflate; '
+            'server_max_window_bits=10\r\n\r\n'))
+
+    def test_hybi_handshake_errors(self):
+        for version, key in (('7', 'dGhlIHNhbXBsZSBub25jZQ=='), ('13', 'foo')):
+            request = self.rf.get('/chat/',
+                HTTP_CONNECTION='Upgrade',
+                HTTP_UPGRADE='websocket',
+                HTTP_SEC_WEBSOCKET_VERSION=version,
+                HTTP_SEC_WEBSOCKET_KEY=key)
+            self.assertRaises(MalformedWebSocket, setup_websocket, request)
+
+    def test_hixie_handshakes(self):
+        # example from section 1.3 of draft-hixie-thewebsocketprotocol-76
+        request = self.rf.get('/demo', {'a': '1'},
+            HTTP_HOST='example.com',
+            HTTP_CONNECTION='Upgrade',
+            HTTP_UPGRADE='WebSocket',
+            HTTP_ORIGIN='http://example.com',
+            HTTP_SEC_WEBSOCKET_PROTOCOL='sample',
+            HTTP_SEC_WEBSOCKET_KEY1='4 @1  46546xW%0l 1 5',
+            HTTP_SEC_WEBSOCKET_KEY2='12998 5 Y3 1  .P00')
+        request.META['wsgi.input'] = Mock()
+        request.META['wsgi.input'].read.return_value = '^n:ds[4U'
+        ws = setup_websocket(request)
+        self.assertEquals(ws.version, 76)
+        self.assertEquals(ws.handshake_reply,
+            'HTTP/1.1 101 Web Socket Protocol Handshake\r\n'
+            'Upgrade: WebSocket\r\n'
+            'Connection: Upgrade\r\n'
+            'Sec-WebSocket-Origin: http://example.com\r\n'
+            'Sec-WebSocket-Protocol: sample\r\n'
+            'Sec-WebSocket-Location: ws://example.com/demo?a=1\r\n'
+            '\r\n'
+            "8jKS'y:G*Co,Wxa-")
+        del request.META['HTTP_SEC_WEBSOCKET_KEY1']
+        del request.META['HTTP_SEC_WEBSOCKET_KEY2']
+        ws = setup_websocket(request)
+        self.assertEquals(ws.version, 75)
+        self.assertEquals(ws.handshake_reply,
+            'HTTP/1.1 101 Web Socket Protocol Handshake\r\n'
+            'Upgrade: WebSocket\r\n'
+            'Connection: Upgrade\r\n'
+            'WebSocket-Origin: http://example.com\r\n'
+            'WebSocket-Location: ws://example.com/demo?a=1\r\n\r\n')
+
+    def test_hixie_handshake_errors(self):
+        # keys without spaces or digits
+        for key1 in ('123', ' '):
+            request = self.rf.get('/chat/',
+                HTTP_CONNECTION='Upgrade',
+                HTTP_UPGRADE='WebSocket',
+                HTTP_SEC_WEBSOCKET_KEY1=key1,
+                HTTP_SEC_WEBSOCKET_KEY2='12998 5 Y3 1  .P00')
+            self.assertRaises(MalformedWebSocket, setup_websocket, request)
 
 
 class DecoratorTests(TestCase):
@@ -128,6 +1972,99 @@ class DecoratorTests(TestCase):
         self.assertEquals(response.status_code, 200)
         self.assertEquals(response.content, '24')
 
-# TODO: test views with actual websocket connection - not really possible yet
-# with django's test client/request factory. Heavy use of mock objects
-# necessary.
+
+class MiddlewareTests(TestCase):
+    def setUp(self):
+        self.rf = RequestFactory()
+        self.middleware = WebSocketMiddleware()
+
+    def test_plain_requests(self):
+        first = self.rf.get('/add/')
+        second = self.rf.get('/add/')
+        for request in (first, second):
+            self.assertEquals(self.middleware.process_request(request), None)
+            self.assertEquals(request.websocket, None)
+            self.assertFalse(request.is_websocket())
+        # The callable is shared instead of created per request.
+        self.assertTrue(first.is_websocket is second.is_websocket)
+
+    def test_upgrade_requests(self):
+        request = self.rf.get('/echo/', HTTP_CONNECTION='Upgrade',
+            HTTP_UPGRADE='websocket')
+        request.META['wsgi.input'] = Mock(spec=['_sock'])
+        self.middleware.process_request(request)
+        self.assertTrue(request.is_websocket())
+        request = self.rf.get('/add/', HTTP_UPGRADE='h2c')
+        self.middleware.process_request(request)
+        self.assertFalse(request.is_websocket())
+
+    def test_view_flags(self):
+        self.assertEquals(view_flags(echo_once), (True, True))
+        self.assertEquals(view_flags(add_one), (True, False))
+        request = self.rf.get('/echo/')
+        self.middleware.process_request(request)
+        response = self.middleware.process_view(request, echo_once, (), {})
+        self.assertEquals(response.status_code, 400)
+        request = self.rf.get('/add/')
+        self.middleware.process_request(request)
+        self.assertEquals(
+            self.middleware.process_view(request, add_one, (), {}), None)
+
+
+class WebSocketClientTests(TestCase):
+    def setUp(self):
+        self.client = WebSocketClient()
+
+    def check_view(self, version):
+        websocket = self.client.connect('/add/', version=version)
+        for i in range(3):
+            websocket.send(unicode(i))
+            self.assertEquals(websocket.receive(5), unicode(i + 1))
+        websocket.close()
+        websocket.view.join(5)
+        self.assertFalse(websocket.view.is_alive())
+        self.assertEquals(websocket.view.exc_info, None)
+        self.assertEquals(websocket.view.response.status_code, 200)
+
+    def test_hixie_75(self):
+        self.check_view(75)
+
+    def test_hixie_76(self):
+        self.check_view(76)
+
+    def test_rfc6455(self):
+        self.check_view(13)
+
+    def test_binary_messages(self):
+        websocket = self.client.connect('/echo/')
+        websocket.send(u'K\xfcss')
+        websocket.send('\x00\xff', binary=True)
+        self.assertEquals(websocket.receive(5), u'K\xfcss')
+        self.assertEquals(websocket.receive(5), '\x00\xff')
+        websocket.close()
+        self.assertEquals(websocket.close_code, 1000)
+
+    def test_view_closes_websocket(self):
+        websocket = self.client.connect('/echo-once/')
+        websocket.send(u'spam')
+        self.assertEquals(websocket.receive(5), u'spam')
+        self.assertEquals(websocket.receive(5), None)
+        self.assertEquals(websocket.close_code, 1000)
+
+    def test_rejected(self):
+        try:
+            self.client.connect('/plain/')
+        except HandshakeError as e:
+            self.assertEquals(e.status, 200)
+            self.assertEquals(e.content, 'plain')
+        else:
+            self.fail('HandshakeError not raised.')
+
+
+class WebsocketFactoryTests(TestCase):
+    def test_hixie_76(self):
+        request = WebsocketFactory(websocket_version=76).get('/chat/')
+        request.META['wsgi.input']._sock = Mock()
+        ws = setup_websocket(request)
+        self.assertEquals(ws.version, 76)
+        self.assertEquals(len(ws.handshake_reply.split('\r\n\r\n')[1]), 16)
@@ -0,0 +1,14 @@
+try:
+    from django.urls import re_path as url
+except ImportError: #pragma NO COVER
+    from django.conf.urls import url
+from django_websocket_tests import views
+
+
+urlpatterns = [
+    url(r'^add/$', views.add_one),
+    url(r'^echo/$', views.echo),
+    url(r'^echo-once/$', views.echo_once),
+    url(r'^plain/$', views.plain),
+    url(r'^stream/$', views.stream),
+]
@@ -1,5 +1,6 @@
 from django.test import Client
 from django.core.handlers.wsgi import WSGIRequest
+from django_websocket.testing import upgrade_request, _Input
 
 
 class RequestFactory(Client):
@@ -63,7 +64,9 @@ class WebsocketFactory(RequestFactory):
             'HTTP_UPGRADE': 'WebSocket',
         }
         if self.protocol_version == 76:
-            raise NotImplementedError(u'This version is not yet supported.')
+            headers, body, expected = upgrade_request(76)
+            environ.update(headers)
+            environ['wsgi.input'] = _Input(None, body)
         environ.update(self.defaults)
         environ.update(request)
         return WSGIRequest(environ)
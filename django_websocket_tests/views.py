@@ -0,0 +1,38 @@
+from io import BytesIO
+from django.http import HttpResponse
+from django_websocket.decorators import accept_websocket, require_websocket
+from django_websocket.websocket import text_type
+
+
+@accept_websocket
+def add_one(request):
+    if request.is_websocket():
+        for message in request.websocket:
+            request.websocket.send(int(message) + 1)
+    else:
+        value = int(request.GET['value'])
+        value += 1
+        return HttpResponse(text_type(value))
+
+
+@require_websocket
+def echo_once(request):
+    request.websocket.send(request.websocket.wait())
+
+
+@require_websocket
+def echo(request):
+    for message in request.websocket:
+        request.websocket.send(message,
+            binary=not isinstance(message, text_type))
+
+
+@require_websocket
+def stream(request):
+    chunks = list(request.websocket.wait_stream())
+    request.websocket.send_stream(chunks, binary=True)
+    request.websocket.send_file(BytesIO(b''.join(chunks)), offset=1)
+
+
+def plain(request):
+    return HttpResponse('plain')